@@ -3,10 +3,22 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import Editor
-import SimpleITK as sitk
-import sitkUtils as su
+import copy
 import math
-from Resources.atlasSmallIslandCleanup import DustCleanup
+import threading
+import time
+import numpy as np
+from Resources.atlasSmallIslandCleanup import DustCleanup, CleanupCancelled
+from Resources.labelArrayTools import relabelArrayInPlace, getTargetLabelsForIsland, getSeedIslandVoxelIndices
+from Resources.labelStatisticsTable import LabelStatisticsTable
+from Resources.labelMerge import mergeLabelArray
+from Resources.islandScoring import scoreIslands
+from Resources.labelEditJournal import LabelEdit, LabelEditJournal, getArrayDiff
+from Resources.sessionCache import SessionCache
+from Resources.resourceBudget import getResourceBudget
+from Resources.volumeNodeArrays import (getVolumeNodeArray, volumeNodeArrayModified, getVolumeNodeVolume,
+                                        getVolumeNodeByName, getOrAddLabelVolumeNode, updateVolumeNodeFromArray,
+                                        getVolumeNodeVersion)
 
 #
 # LabelAtlasEditor
@@ -277,6 +289,14 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
     self.forceSuspiciousLabelChangeCheckBox.setToolTip("Forces reviewed islands of voxels to change to a different label ")
     automaticCleanupParametersFormLayout.addRow("Force reviewed islands of voxels \nto change to a different label\n", self.forceSuspiciousLabelChangeCheckBox)
 
+    #
+    # check box to profile the stages of the Automatic Cleanup
+    #
+    self.profileCheckBox = qt.QCheckBox()
+    self.profileCheckBox.checked = 0
+    self.profileCheckBox.setToolTip("Prints the calls, time and memory of every stage of the cleanup when it is done")
+    automaticCleanupParametersFormLayout.addRow("Profile the cleanup\n", self.profileCheckBox)
+
     #
     # Apply Button for the Automatic Cleanup widget
     #
@@ -286,6 +306,29 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
     self.automaticCleanupParamsButton.setStyleSheet("background-color: rgb(230,241,255)")
     automaticCleanupParametersFormLayout.addRow(self.automaticCleanupParamsButton)
 
+    #
+    # Progress of the Automatic Cleanup, which runs in the background
+    #
+    self.automaticCleanupProgressBar = qt.QProgressBar()
+    self.automaticCleanupProgressBar.minimum = 0
+    self.automaticCleanupProgressBar.maximum = 100
+    self.automaticCleanupProgressBar.value = 0
+    automaticCleanupParametersFormLayout.addRow(self.automaticCleanupProgressBar)
+
+    self.automaticCleanupStatusLabel = qt.QLabel("")
+    automaticCleanupParametersFormLayout.addRow(self.automaticCleanupStatusLabel)
+
+    self.automaticCleanupCancelButton = qt.QPushButton("Cancel")
+    self.automaticCleanupCancelButton.toolTip = "Stop the running cleanup. The output label map is left unchanged."
+    self.automaticCleanupCancelButton.enabled = False
+    automaticCleanupParametersFormLayout.addRow(self.automaticCleanupCancelButton)
+
+    self.automaticCleanupTimer = qt.QTimer()
+    self.automaticCleanupTimer.setInterval(250)
+    self.automaticCleanupObject = None
+    self.automaticCleanupThread = None
+    self.automaticCleanupReservation = None
+
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #% Label Suggestion Parameters Area %%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
@@ -363,6 +406,14 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
     self.labelParamsOutputSelectorLabel.setToolTip( "Pick the output label map to the algorithm." )
     labelParametersFormLayout.addRow("Output Label Map Volume: ", self.labelParamsOutputSelectorLabel)
 
+    #
+    # check box to evaluate every fiducial point at once for Label Suggestion Params
+    #
+    self.labelParamsAllFiducialsCheckBox = qt.QCheckBox()
+    self.labelParamsAllFiducialsCheckBox.checked = 0
+    self.labelParamsAllFiducialsCheckBox.setToolTip("Place several fiducial points and get a suggestion for the island under each of them")
+    labelParametersFormLayout.addRow("Evaluate every fiducial point\n(one island per point)\n", self.labelParamsAllFiducialsCheckBox)
+
     #
     # Add fiducial Button for Label Suggestion Params
     #
@@ -386,6 +437,7 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
     self.view.sortingEnabled = True
     self.view.setMaximumHeight(0)
     labelParametersFormLayout.addWidget(self.view)
+    self.isIslandSuggestionTable = False
 
     #
     # Apply Button for Label Suggestion Params
@@ -396,6 +448,18 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
     self.labelParamsRelabelButton.setStyleSheet("background-color: rgb(230,241,255)")
     labelParametersFormLayout.addRow("Step 3:", self.labelParamsRelabelButton)
 
+    #
+    # memory budget of the cache of images and statistics reused between Label Suggestion clicks
+    #
+    self.sessionCacheMegabytes = qt.QSpinBox()
+    self.sessionCacheMegabytes.minimum = 0
+    self.sessionCacheMegabytes.maximum = 65536
+    self.sessionCacheMegabytes.singleStep = 256
+    self.sessionCacheMegabytes.suffix = " MB"
+    self.sessionCacheMegabytes.value = self.logic.sessionCacheMegabytes
+    self.sessionCacheMegabytes.setToolTip("Memory for the images and label statistics that are kept between clicks, until the volumes are modified")
+    labelParametersFormLayout.addRow("Cache size: ", self.sessionCacheMegabytes)
+
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #% Merge Suspicious Label to Target Label Parameters Area %%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
@@ -570,11 +634,79 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
     self.applyButton.setStyleSheet("background-color: rgb(230,241,255)")
     parametersFormLayout.addRow(self.applyButton)
 
+    #%%%%%%%%%%%%%%%%%%%%%%%%
+    #% Edit History Area %%%%
+    #%%%%%%%%%%%%%%%%%%%%%%%%
+
+    editHistoryCollapsibleButton = ctk.ctkCollapsibleButton()
+    editHistoryCollapsibleButton.text = "Edit History"
+    editHistoryCollapsibleButton.setContentsMargins(10, 30, 10, 10)
+    self.layout.addWidget(editHistoryCollapsibleButton)
+
+    # Layout within the Edit History Area collapsible button
+    editHistoryFormLayout = qt.QFormLayout(editHistoryCollapsibleButton)
+
+    #
+    # Undo and Redo Buttons
+    #
+    self.undoButton = qt.QPushButton("Undo")
+    self.undoButton.toolTip = "Undo the last merge, relabel, cast or cleanup of a label map."
+    self.undoButton.enabled = False
+    self.redoButton = qt.QPushButton("Redo")
+    self.redoButton.toolTip = "Redo the last undone edit."
+    self.redoButton.enabled = False
+    undoRedoLayout = qt.QHBoxLayout()
+    undoRedoLayout.addWidget(self.undoButton)
+    undoRedoLayout.addWidget(self.redoButton)
+    editHistoryFormLayout.addRow(undoRedoLayout)
+
+    self.editHistoryStatusLabel = qt.QLabel("No edits")
+    editHistoryFormLayout.addRow("Status: ", self.editHistoryStatusLabel)
+
+    #%%%%%%%%%%%%%%%%%%%%%%%%
+    #% Resources Area %%%%%%%
+    #%%%%%%%%%%%%%%%%%%%%%%%%
+
+    resourcesCollapsibleButton = ctk.ctkCollapsibleButton()
+    resourcesCollapsibleButton.text = "Resources"
+    resourcesCollapsibleButton.collapsed = True
+    resourcesCollapsibleButton.setContentsMargins(10, 30, 10, 10)
+    self.layout.addWidget(resourcesCollapsibleButton)
+
+    # Layout within the Resources Area collapsible button
+    resourcesFormLayout = qt.QFormLayout(resourcesCollapsibleButton)
+
+    #
+    # thread and memory budget of the SimpleITK filters and of the automatic cleanup, kept in the
+    # application settings
+    #
+    settings = qt.QSettings()
+    self.numberOfThreads = qt.QSpinBox()
+    self.numberOfThreads.minimum = 0
+    self.numberOfThreads.maximum = 256
+    self.numberOfThreads.specialValueText = "Automatic"
+    self.numberOfThreads.value = int(settings.value('LabelAtlasEditor/numberOfThreads', 0))
+    self.numberOfThreads.setToolTip("Threads of every SimpleITK filter, automatic uses the CPUs allowed to Slicer")
+    resourcesFormLayout.addRow("Threads: ", self.numberOfThreads)
+
+    self.memoryMegabytes = qt.QSpinBox()
+    self.memoryMegabytes.minimum = 0
+    self.memoryMegabytes.maximum = 1048576
+    self.memoryMegabytes.singleStep = 1024
+    self.memoryMegabytes.suffix = " MB"
+    self.memoryMegabytes.specialValueText = "Automatic"
+    self.memoryMegabytes.value = int(settings.value('LabelAtlasEditor/memoryMegabytes', 0))
+    self.memoryMegabytes.setToolTip("Memory for the volumes kept in the background, automatic uses the memory limit of Slicer's cgroup")
+    resourcesFormLayout.addRow("Memory: ", self.memoryMegabytes)
+    self.onResourceBudgetChanged()
+
     # connections
     self.castApplyButton.connect('clicked(bool)', self.onCastApplyButton)
     self.inputCastLabelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onCastSelect)
     self.outputCastLabelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onCastSelect)
     self.automaticCleanupParamsButton.connect('clicked(bool)', self.onAutomaticCleanupParamsButton)
+    self.automaticCleanupCancelButton.connect('clicked(bool)', self.onAutomaticCleanupCancelButton)
+    self.automaticCleanupTimer.connect('timeout()', self.onAutomaticCleanupTimer)
     self.labelParamsApplyButton.connect('clicked(bool)', self.onLabelParamsApplyButton)
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
     self.inputSelectorLabel.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
@@ -583,12 +715,21 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
     self.enablePosteriorCheckBox.connect('clicked(bool)', self.onEnablePosteriorSelect)
     self.labelParamsAddFiducialButton.connect('clicked(bool)', self.onlabelParamsAddFiducialButton)
     self.labelParamsRelabelButton.connect('clicked(bool)', self.onRelabelApplyButton)
+    self.undoButton.connect('clicked(bool)', self.onUndoButton)
+    self.redoButton.connect('clicked(bool)', self.onRedoButton)
+    self.sessionCacheMegabytes.connect('valueChanged(int)', self.onSessionCacheMegabytesChanged)
+    self.numberOfThreads.connect('valueChanged(int)', self.onResourceBudgetChanged)
+    self.memoryMegabytes.connect('valueChanged(int)', self.onResourceBudgetChanged)
 
     # Add vertical spacer
     self.layout.addStretch(1)
 
   def cleanup(self):
-    pass
+    if self.automaticCleanupObject is not None:
+      self.automaticCleanupObject.cancelRequested = True
+    if self.automaticCleanupReservation is not None:
+      self.automaticCleanupReservation.release()
+    self.automaticCleanupTimer.stop()
 
   def onCastSelect(self):
     self.castApplyButton.enabled = self.inputCastLabelSelector.currentNode() \
@@ -606,11 +747,11 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
   def onCastApplyButton(self):
     self.logic.runCast(self.inputCastLabelSelector.currentNode(),
                   self.outputCastLabelSelector.currentNode())
+    self.updateEditHistory()
 
   def onAutomaticCleanupParamsButton(self):
-    self.automaticCleanupParamsButton.text = "Working..."
-    self.automaticCleanupParamsButton.repaint()
-    slicer.app.processEvents()
+    if self.automaticCleanupThread is not None:
+      return
     arguments = {'--inputAtlasPath': self.automaticCleanupParamsInputSelectorLabel.currentNode().GetName(),
                  '--inputT1Path': self.automaticCleanupParamsInputT1VolumeSelector.currentNode().GetName(),
                  '--outputAtlasPath': self.automaticCleanupParamsOutputSelectorLabel.currentNode().GetName(),
@@ -619,30 +760,151 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
                  '--maximumIslandVoxelCount': int(self.maximumIslandVoxelCount.value),
                  '--noDilation': self.noDilationCheckBox.checked,
                  '--useFullyConnectedInConnectedComponentFilter': self.useFullyConnectedInConnectedComponentFilterCheckBox.checked,
-                 '--forceSuspiciousLabelChange': self.forceSuspiciousLabelChangeCheckBox.checked
+                 '--forceSuspiciousLabelChange': self.forceSuspiciousLabelChangeCheckBox.checked,
+                 '--profile': self.profileCheckBox.checked
                  }
+    arguments.update(self.getResourceBudgetArguments())
     if self.automaticCleanupParamsInputT2VolumeSelector.currentNode():
         arguments['--inputT2Path'] = self.automaticCleanupParamsInputT2VolumeSelector.currentNode().GetName()
     else:
         arguments['--inputT2Path'] = None
     print arguments
     localDustCleanupObject = LocalDustCleanup(arguments=arguments)
-    localDustCleanupObject.main()
+    # MRML nodes are only looked up and written on the main thread. The thread reads copies of
+    # the voxels, so the input nodes can be edited, reloaded or removed while it runs.
+    labelVolume, inputT1Volume, inputT2Volume = localDustCleanupObject.getInputVolumes(copy=True)
+    self.automaticCleanupReservation = localDustCleanupObject.resourceBudget.reserve(
+      sum(volume.array.nbytes for volume in (labelVolume, inputT1Volume, inputT2Volume) if volume is not None),
+      wait=False)
+    self.automaticCleanupObject = localDustCleanupObject
+    self.automaticCleanupThread = threading.Thread(target=localDustCleanupObject.cleanupInBackground,
+                                                   args=(labelVolume, inputT1Volume, inputT2Volume))
+    self.automaticCleanupThread.daemon = True
+    self.automaticCleanupStartTime = time.time()
+    self.automaticCleanupParamsButton.text = "Working..."
+    self.automaticCleanupParamsButton.enabled = False
+    self.automaticCleanupCancelButton.enabled = True
+    self.automaticCleanupProgressBar.value = 0
+    self.automaticCleanupStatusLabel.text = "Reading the label map"
+    self.automaticCleanupThread.start()
+    self.automaticCleanupTimer.start()
+
+  def onAutomaticCleanupCancelButton(self):
+    if self.automaticCleanupObject is not None:
+      self.automaticCleanupObject.cancelRequested = True
+      self.automaticCleanupCancelButton.enabled = False
+      self.automaticCleanupStatusLabel.text = "Cancelling..."
+
+  def onAutomaticCleanupTimer(self):
+    localDustCleanupObject = self.automaticCleanupObject
+    if self.automaticCleanupThread.is_alive():
+      if not localDustCleanupObject.cancelRequested:
+        self.automaticCleanupStatusLabel.text = self.getAutomaticCleanupProgressText(localDustCleanupObject)
+      return
+
+    self.automaticCleanupTimer.stop()
+    if localDustCleanupObject.isCleanupFinished:
+      localDustCleanupObject.printIslandStatistics()
+      localDustCleanupObject.writeOutputVolume(self.logic)
+      localDustCleanupObject.profiler.report(localDustCleanupObject.profilePath)
+      self.updateEditHistory()
+      self.automaticCleanupProgressBar.value = 100
+      self.automaticCleanupStatusLabel.text = "Done: %d islands cleaned in %.1f s" % (
+        localDustCleanupObject.islandStatistics['Total']['numberOfIslandsCleaned'],
+        time.time() - self.automaticCleanupStartTime)
+    elif isinstance(localDustCleanupObject.cleanupError, CleanupCancelled):
+      self.automaticCleanupStatusLabel.text = "Cancelled, the output label map was not changed"
+    else:
+      self.automaticCleanupStatusLabel.text = "Failed: %s" % localDustCleanupObject.cleanupError
+    self.automaticCleanupReservation.release()
+    self.automaticCleanupReservation = None
+    self.automaticCleanupObject = None
+    self.automaticCleanupThread = None
     self.automaticCleanupParamsButton.text = "Apply"
+    self.automaticCleanupParamsButton.enabled = True
+    self.automaticCleanupCancelButton.enabled = False
+
+  def getAutomaticCleanupProgressText(self, localDustCleanupObject):
+    numberOfLabels = localDustCleanupObject.numberOfLabels
+    numberOfLabelsProcessed = localDustCleanupObject.numberOfLabelsProcessed
+    if numberOfLabels == 0:
+      return "Reading the label map"
+    self.automaticCleanupProgressBar.value = int(100 * numberOfLabelsProcessed / numberOfLabels)
+    progressText = "Label %d of %d, %d islands cleaned" % (
+      min(numberOfLabelsProcessed + 1, numberOfLabels), numberOfLabels,
+      localDustCleanupObject.islandStatistics['Total']['numberOfIslandsCleaned'])
+    if numberOfLabelsProcessed > 0:
+      elapsedTime = time.time() - self.automaticCleanupStartTime
+      remainingTime = elapsedTime * (numberOfLabels - numberOfLabelsProcessed) / numberOfLabelsProcessed
+      progressText += ", about %d s left" % math.ceil(remainingTime)
+    return progressText
 
   def onLabelParamsApplyButton(self):
+    if self.labelParamsAllFiducialsCheckBox.checked:
+      self.logic.runGetRegionInfoForAllFiducials(self.labelParamsInputSelectorLabel.currentNode().GetName(),
+                                                 self.labelParamsInputT1VolumeSelector.currentNode(),
+                                                 self.labelParamsInputT2VolumeSelector.currentNode())
+      self.populateIslandSuggestions()
+      return
     self.logic.runGetRegionInfo(self.labelParamsInputSelectorLabel.currentNode().GetName(),
                            self.labelParamsInputT1VolumeSelector.currentNode(),
                            self.labelParamsInputT2VolumeSelector.currentNode())
     self.populateStats()
 
+  def onSessionCacheMegabytesChanged(self, megabytes):
+    self.logic.setSessionCacheMegabytes(megabytes)
+
+  def onResourceBudgetChanged(self, value=None):
+    settings = qt.QSettings()
+    settings.setValue('LabelAtlasEditor/numberOfThreads', self.numberOfThreads.value)
+    settings.setValue('LabelAtlasEditor/memoryMegabytes', self.memoryMegabytes.value)
+    self.logic.setResourceBudget(self.numberOfThreads.value, self.memoryMegabytes.value)
+
+  def getResourceBudgetArguments(self):
+    """
+    Returns the --threads and --memoryMegabytes arguments of the cleanup, None when automatic.
+    """
+    return {'--threads': str(self.numberOfThreads.value) if self.numberOfThreads.value else None,
+            '--memoryMegabytes': str(self.memoryMegabytes.value) if self.memoryMegabytes.value else None}
+
+  def onUndoButton(self):
+    labelEdit = self.logic.undoLabelMapEdit()
+    self.updateEditHistory()
+    if labelEdit is not None:
+      self.editHistoryStatusLabel.text = "Undone: %s (%d voxels)" % (labelEdit.description, labelEdit.numberOfVoxels)
+
+  def onRedoButton(self):
+    labelEdit = self.logic.redoLabelMapEdit()
+    self.updateEditHistory()
+    if labelEdit is not None:
+      self.editHistoryStatusLabel.text = "Redone: %s (%d voxels)" % (labelEdit.description, labelEdit.numberOfVoxels)
+
+  def updateEditHistory(self):
+    labelEditJournal = self.logic.labelEditJournal
+    self.undoButton.enabled = labelEditJournal.canUndo()
+    self.redoButton.enabled = labelEditJournal.canRedo()
+    self.editHistoryStatusLabel.text = "%d edits to undo, %d to redo, %.1f KB" % (
+      len(labelEditJournal.undoEdits), len(labelEditJournal.redoEdits), labelEditJournal.getNumberOfBytes() / 1024.0)
+
   def onlabelParamsAddFiducialButton(self):
-    self.logic.runAddFiducial()
+    self.logic.runAddFiducial(self.labelParamsAllFiducialsCheckBox.checked)
+    labelNode = self.labelParamsInputSelectorLabel.currentNode()
+    inputT1VolumeNode = self.labelParamsInputT1VolumeSelector.currentNode()
+    inputT2VolumeNode = self.labelParamsInputT2VolumeSelector.currentNode()
+    if labelNode and inputT1VolumeNode and inputT2VolumeNode:
+      # build the label statistics while the fiducial is placed, so Step 2 only looks at the island
+      self.logic.getCachedLabelStatisticsTable(labelNode, [inputT1VolumeNode, inputT2VolumeNode])
 
   def onRelabelApplyButton(self):
-    self.logic.runRelabelOutputLabelMap(self.labelParamsInputSelectorLabel.currentNode(),
-                                        self.labelParamsOutputSelectorLabel.currentNode().GetName(),
-                                        self.items)
+    if self.isIslandSuggestionTable:
+      self.logic.runRelabelIslandSuggestions(self.labelParamsInputSelectorLabel.currentNode(),
+                                             self.labelParamsOutputSelectorLabel.currentNode().GetName(),
+                                             self.getCheckedIslandSuggestionLabels())
+    else:
+      self.logic.runRelabelOutputLabelMap(self.labelParamsInputSelectorLabel.currentNode(),
+                                          self.labelParamsOutputSelectorLabel.currentNode().GetName(),
+                                          self.items)
+    self.updateEditHistory()
 
   def onApplyButton(self):
     self.applyButton.text = "Working..."
@@ -664,6 +926,7 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
               enablePosterior=True,
               inputPosteriorName=self.inputSelectorPosterior.currentNode().GetName(),
               posteriorThreshold=self.posteriorThreshold.value)
+    self.updateEditHistory()
     self.applyButton.text = "Apply"
 
   def onEnablePosteriorSelect(self):
@@ -677,6 +940,7 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
 
   def populateStats(self):
     self.tableColumnNames = ['Label Number', 'Label Name', 'Square Diff of Means']
+    self.isIslandSuggestionTable = False
 
     if not self.logic:
       return
@@ -733,6 +997,70 @@ class LabelAtlasEditorWidget(ScriptedLoadableModuleWidget):
       self.model.setHeaderData(col,1,k)
       col += 1
 
+  def populateIslandSuggestions(self):
+    """
+    Fills the table with one row per island of the fiducial points: the island, its label, its
+    voxel count and the closest bordering label, which can be edited before it is applied.
+    """
+    self.tableColumnNames = ['Island', 'Label Number', 'Voxels', 'New Label', 'New Label Name', 'Square Diff of Means']
+    self.isIslandSuggestionTable = True
+
+    displayNode = self.labelParamsInputSelectorLabel.currentNode().GetDisplayNode()
+    colorNode = displayNode.GetColorNode()
+    lut = colorNode.GetLookupTable()
+    self.islandSuggestionItems = []
+    self.model = qt.QStandardItemModel()
+    self.view.setModel(self.model)
+    self.view.verticalHeader().visible = False
+    for row, islandSuggestion in enumerate(self.logic.islandSuggestions):
+      labelDict = islandSuggestion['squareRootDiffLabelDict']
+      if labelDict:
+        newLabel = min(labelDict, key=labelDict.get)
+      else:
+        newLabel = islandSuggestion['label']
+
+      color = qt.QColor()
+      rgb = lut.GetTableValue(newLabel)
+      color.setRgb(rgb[0]*255, rgb[1]*255, rgb[2]*255)
+      item = qt.QStandardItem()
+      item.setData(color,qt.Qt.DecorationRole)
+      self.model.setItem(row, 0, item)
+
+      # write Island column, checked islands are relabeled
+      islandItem = qt.QStandardItem()
+      islandItem.setData(row + 1, qt.Qt.DisplayRole)
+      islandItem.setCheckable(True)
+      islandItem.setCheckState(qt.Qt.Checked if labelDict else qt.Qt.Unchecked)
+      islandItem.setEditable(False)
+      self.model.setItem(row, 1, islandItem)
+
+      values = [islandSuggestion['label'], len(islandSuggestion['voxelIndices']), newLabel,
+                colorNode.GetColorName(newLabel), float(labelDict.get(newLabel, 0.0))]
+      for column, value in enumerate(values):
+        item = qt.QStandardItem()
+        item.setData(value, qt.Qt.DisplayRole)
+        item.setToolTip(colorNode.GetColorName(islandSuggestion['label']))
+        item.setEditable(column == 2) # the new label can be changed before it is applied
+        self.model.setItem(row, column + 2, item)
+      self.islandSuggestionItems.append((islandItem, self.model.item(row, 4)))
+
+    self.view.setMinimumHeight(self.view.rowHeight(0) * 5 + 10)
+    self.view.setMaximumHeight(self.view.rowHeight(0) * 5 + 10)
+    self.view.setColumnWidth(0,30)
+    self.model.setHeaderData(0,1," ")
+    col = 1
+    for k in self.tableColumnNames:
+      self.view.setColumnWidth(col,10*len(k))
+      self.model.setHeaderData(col,1,k)
+      col += 1
+
+  def getCheckedIslandSuggestionLabels(self):
+    islandLabels = list()
+    for row, (islandItem, newLabelItem) in enumerate(self.islandSuggestionItems):
+      if islandItem.checkState() == qt.Qt.Checked:
+        islandLabels.append((self.logic.islandSuggestions[row]['voxelIndices'], int(newLabelItem.text())))
+    return islandLabels
+
 #
 # LabelAtlasEditorLogic
 #
@@ -747,6 +1075,40 @@ class LabelAtlasEditorLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  sessionCacheMegabytes = 1024
+  labelEditJournalMegabytes = 256
+
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.sessionCache = SessionCache(self.sessionCacheMegabytes << 20)
+    self.labelEditJournal = LabelEditJournal(self.labelEditJournalMegabytes << 20)
+
+  def setSessionCacheMegabytes(self, megabytes):
+    self.sessionCacheMegabytes = megabytes
+    self.sessionCache.setMaximumBytes(megabytes << 20)
+
+  def setResourceBudget(self, numberOfThreads=None, memoryMegabytes=None):
+    """
+    Applies the thread budget to the SimpleITK filters of the module (see resourceBudget); zero
+    or None takes the budget from the environment or the machine.
+    """
+    self.resourceBudget = getResourceBudget(numberOfThreads or None, memoryMegabytes or None)
+
+  def getCachedProduct(self, productName, volumeNodes, computeProduct):
+    """
+    Returns the product of computeProduct() for volumeNodes from the session cache. It is only
+    computed again when one of the volume nodes has been modified since it was cached.
+    """
+    slot = (productName,) + tuple(volumeNode.GetID() for volumeNode in volumeNodes)
+    version = tuple(getVolumeNodeVersion(volumeNode) for volumeNode in volumeNodes)
+    return self.sessionCache.get(slot, version, computeProduct)
+
+  def getCachedLabelStatisticsTable(self, labelNode, volumeNodes):
+    return self.getCachedProduct('labelStatisticsTable', [labelNode] + volumeNodes,
+                                 lambda: LabelStatisticsTable(getVolumeNodeArray(labelNode),
+                                                              [getVolumeNodeArray(volumeNode) for volumeNode in volumeNodes],
+                                                              trackExtrema=True))
+
   def hasImageData(self,volumeNode):
     """This is a dummy logic method that
     returns true if the passed in volume
@@ -768,43 +1130,38 @@ class LabelAtlasEditorLogic(ScriptedLoadableModuleLogic):
 
     self.delayDisplay('Running')
 
-    newLabel = self.mergeLabels(inputLabelName, targetLabel, suspiciousLabel, mergeAllIslandsChecked,
-                                enablePosterior, inputPosteriorName, posteriorThreshold)
-
-    inputNode = slicer.util.getNode(pattern=inputLabelName)
+    inputNode = getVolumeNodeByName(inputLabelName)
     inputLabelNodeLUTNodeID = inputNode.GetDisplayNode().GetColorNodeID()
+    posteriorArray = self.getPosteriorArray(enablePosterior, inputPosteriorName, posteriorThreshold)
 
-    su.PushLabel(newLabel, outputLabelName, overwrite=True)
+    self.editOutputLabelMap(inputNode, outputLabelName,
+                            lambda labelArray: mergeLabelArray(labelArray, int(targetLabel), int(suspiciousLabel),
+                                                               mergeAllIslandsChecked, posteriorArray,
+                                                               posteriorThreshold),
+                            'Merge label %d into label %d' % (suspiciousLabel, targetLabel))
     self.setLabelLUT(outputLabelName, inputLabelNodeLUTNodeID)
 
     return True
 
   def mergeLabels(self, labelImageName, targetLabel, suspiciousLabel, mergeAllIslandsChecked,
                   enablePosterior, inputPosteriorName, posteriorThreshold):
-    labelImage = su.PullFromSlicer(labelImageName)
-    targetLabelMask = sitk.BinaryThreshold(labelImage, targetLabel, targetLabel)
-    suspiciousLabelMask = sitk.BinaryThreshold(labelImage, suspiciousLabel, suspiciousLabel)
-    targetAndSuspiciousMergedLabel = sitk.Add(targetLabelMask, suspiciousLabelMask)
-    connectedRegion = sitk.ConnectedComponent(targetAndSuspiciousMergedLabel, True)
-    relabeledConnectedRegion = sitk.RelabelComponent(connectedRegion)
+    """
+    Returns the label map labelImageName with suspiciousLabel merged into targetLabel as a
+    SimpleITK image, leaving the node unchanged.
+    """
+    labelNode = getVolumeNodeByName(labelImageName)
+    labelArray = getVolumeNodeArray(labelNode).astype(np.int16)
+    posteriorArray = self.getPosteriorArray(enablePosterior, inputPosteriorName, posteriorThreshold)
+    mergeLabelArray(labelArray, int(targetLabel), int(suspiciousLabel), mergeAllIslandsChecked,
+                    posteriorArray, posteriorThreshold)
+    return getVolumeNodeVolume(labelNode).getImageFromArray(labelArray)
+
+  def getPosteriorArray(self, enablePosterior, inputPosteriorName, posteriorThreshold):
     if not enablePosterior:
-      if mergeAllIslandsChecked == False:
-        newRegion = sitk.BinaryThreshold(relabeledConnectedRegion, 1, 1)
-        print('no thresh used')
-      else:
-        newRegion = sitk.BinaryThreshold(relabeledConnectedRegion, 1)
-        print('no thresh used')
-    else:
-      print('threshold used: ', posteriorThreshold)
-      posterior = su.PullFromSlicer(inputPosteriorName)
-      thresholdedPosterior = sitk.BinaryThreshold(posterior, posteriorThreshold)
-      if mergeAllIslandsChecked == False:
-        relabeledMask = sitk.BinaryThreshold(relabeledConnectedRegion, 1, 1)
-      else:
-        relabeledMask = sitk.BinaryThreshold(relabeledConnectedRegion, 1)
-      newRegion = sitk.Multiply(relabeledMask, thresholdedPosterior)
-    newLabel = self.relabelImage(labelImage, newRegion, targetLabel)
-    return newLabel
+      print('no thresh used')
+      return None
+    print('threshold used: ', posteriorThreshold)
+    return getVolumeNodeArray(getVolumeNodeByName(inputPosteriorName))
 
   def setLabelLUT(self, nodeName, colorNodeID):
     outputNode = slicer.util.getNode(pattern=nodeName)
@@ -812,169 +1169,260 @@ class LabelAtlasEditorLogic(ScriptedLoadableModuleLogic):
     outputLabelDisplayNode.SetAndObserveColorNodeID(colorNodeID)
 
   def runCast(self, inputNode, outputNode):
-    inputName = inputNode.GetName()
-    inputImage = su.PullFromSlicer(inputName)
-    outputImage = sitk.Cast(inputImage, sitk.sitkInt16)
+    outputArray = getVolumeNodeArray(inputNode).astype(np.int16)
     inputLabelNodeLUTNodeID = inputNode.GetDisplayNode().GetColorNodeID()
-    outputName = outputNode.GetName()
-    su.PushLabel(outputImage, outputName, overwrite=True)
-    self.setLabelLUT(outputName, inputLabelNodeLUTNodeID)
+    self.writeLabelMap(outputNode, outputArray, inputNode, 'Cast %s' % inputNode.GetName())
+    self.setLabelLUT(outputNode.GetName(), inputLabelNodeLUTNodeID)
 
     return True
 
-  def runAddFiducial(self):
+  def runAddFiducial(self, keepFiducials=False):
+    """
+    Starts placing the fiducial point of the suspicious island. With keepFiducials the points
+    already placed are kept and points are placed until place mode is left, one per island.
+    """
     fiducialName = 'DustCleanupModuleFiducialNode'
 
-    fiducialNode = slicer.util.getNode(fiducialName)
-    if fiducialNode != None:
-      slicer.mrmlScene.RemoveNode(fiducialNode)
-
     markupsLogic = slicer.modules.markups.logic()
-    markupsLogic.AddNewFiducialNode(fiducialName)
+    fiducialNode = slicer.util.getNode(fiducialName)
+    if fiducialNode != None and keepFiducials:
+      markupsLogic.SetActiveListID(fiducialNode)
+    else:
+      if fiducialNode != None:
+        slicer.mrmlScene.RemoveNode(fiducialNode)
+      markupsLogic.AddNewFiducialNode(fiducialName)
 
-    placeModePersistence = 0
+    placeModePersistence = 1 if keepFiducials else 0
     markupsLogic.StartPlaceMode(placeModePersistence)
 
   def runGetRegionInfo(self, inputLabelName, inputT1VolumeNode,
                        inputT2VolumeNode):
+    """
+    Ranks the labels bordering the island under the fiducial. The island is flood filled in a
+    region around the fiducial and the label means come from the cached label statistics table
+    of the whole atlas, from which the voxels of the island are subtracted.
+    """
 
     fiducialName = 'DustCleanupModuleFiducialNode'
     fiducialNode = slicer.util.getNode(fiducialName)
 
     seedList = self.createSeedList(fiducialNode, inputT1VolumeNode)
-    inputLabelImage = self.getSitkInt16ImageFromSlicer(inputLabelName)
-    suspiciousLabel = self.getLabel(inputLabelImage, seedList)
-    self.connectedThresholdOutput = self.runConnectedThresholdImageFilter(suspiciousLabel, seedList, inputLabelImage)
-
-    inputT1VolumeImage = self.getSitkInt16ImageFromSlicer(inputT1VolumeNode.GetName())
-    inputT2VolumeImage = self.getSitkInt16ImageFromSlicer(inputT2VolumeNode.GetName())
-
-    dialatedBinaryLabelMap = self.dialateLabelMap(self.connectedThresholdOutput)
-    reducedLabelMapImage = sitk.Multiply(dialatedBinaryLabelMap, inputLabelImage)
-
-    reducedLabelMapT1LabelStats = self.getLabelStatsObject(inputT1VolumeImage, reducedLabelMapImage)
-    reducedLabelMapT2LabelStats = self.getLabelStatsObject(inputT2VolumeImage, reducedLabelMapImage)
-    targetLabels = reducedLabelMapT1LabelStats.GetLabels()
-
-    labelImageWithoutSuspiciousIslandPixels = self.relabelImage(inputLabelImage, self.connectedThresholdOutput, 0)
-
-    T1LabelStats = self.getLabelStatsObject(inputT1VolumeImage, labelImageWithoutSuspiciousIslandPixels)
-    T2LabelStats = self.getLabelStatsObject(inputT2VolumeImage, labelImageWithoutSuspiciousIslandPixels)
-
-    self.printLabelStatistics(reducedLabelMapT1LabelStats)
+    inputLabelNode = getVolumeNodeByName(inputLabelName)
+    labelArray = getVolumeNodeArray(inputLabelNode)
+    volumeArrays = [getVolumeNodeArray(inputT1VolumeNode), getVolumeNodeArray(inputT2VolumeNode)]
+    suspiciousLabel = self.getLabel(labelArray, seedList)
+    self.suspiciousIslandVoxelIndices = getSeedIslandVoxelIndices(labelArray, seedList[0], fullyConnected=True)
+    targetLabels = getTargetLabelsForIsland(labelArray, self.suspiciousIslandVoxelIndices)
+
+    x, y, z = self.suspiciousIslandVoxelIndices.T
+    islandValues = [volumeArray[z, y, x].astype(np.float64) for volumeArray in volumeArrays]
+    labelStatisticsTable = copy.deepcopy(self.getCachedLabelStatisticsTable(inputLabelNode,
+                                                                            [inputT1VolumeNode, inputT2VolumeNode]))
+    # the labels are compared with the island as if its voxels were already relabeled
+    labelStatisticsTable.relabelVoxels(suspiciousLabel, 0, len(x), [values.sum() for values in islandValues],
+                                       [np.dot(values, values) for values in islandValues])
+
+    self.printLabelStatistics(labelStatisticsTable, targetLabels)
     self.squareRootDiffLabelDict = self.calculateLabelIntensityDifferenceValue(
-                              reducedLabelMapT1LabelStats.GetMean(int(suspiciousLabel)),
-                              reducedLabelMapT2LabelStats.GetMean(int(suspiciousLabel)),
-                              targetLabels, T1LabelStats, T2LabelStats)
+                              islandValues[0].mean(), islandValues[1].mean(),
+                              targetLabels, labelStatisticsTable)
 
     print self.squareRootDiffLabelDict
 
     return True
 
-  def getLabel(self, inputLabelImage, seedList):
-
-    return int(inputLabelImage.GetPixel(seedList[0][0], seedList[0][1], seedList[0][2]))
-
-  def getLabelStatsObject(self, volumeImage, labelImage):
-    labelStatsObject = sitk.LabelStatisticsImageFilter()
-    labelStatsObject.Execute(volumeImage, labelImage)
-
-    return labelStatsObject
-
-  def getSitkInt16ImageFromSlicer(self, volumeName):
-    volume = su.PullFromSlicer(volumeName)
-    castedVolume = sitk.Cast(volume, sitk.sitkInt16)
-
-    return castedVolume
-
-  def runConnectedThresholdImageFilter(self, label, seedList, inputLabelImage):
-    myFilter = sitk.ConnectedThresholdImageFilter()
-    myFilter.SetConnectivity(1)
-    myFilter.SetDebug(False)
-    myFilter.SetLower(label)
-    myFilter.SetNumberOfThreads(8)
-    myFilter.SetReplaceValue(1)
-    myFilter.SetUpper(label)
-    myFilter.SetSeedList(seedList)
-    output = myFilter.Execute(inputLabelImage)
-    castedOutput = sitk.Cast(output, sitk.sitkInt16)
+  def runGetRegionInfoForAllFiducials(self, inputLabelName, inputT1VolumeNode, inputT2VolumeNode):
+    fiducialName = 'DustCleanupModuleFiducialNode'
+    fiducialNode = slicer.util.getNode(fiducialName)
 
-    return castedOutput
+    seedList = self.createSeedList(fiducialNode, inputT1VolumeNode, allFiducials=True)
+    self.islandSuggestions = self.getIslandSuggestions(getVolumeNodeByName(inputLabelName), inputT1VolumeNode,
+                                                       inputT2VolumeNode, seedList)
+    for islandSuggestion in self.islandSuggestions:
+      print islandSuggestion['seed'], islandSuggestion['label'], islandSuggestion['squareRootDiffLabelDict']
 
-  def dialateLabelMap(self, inputLabelImage):
-    myFilter = sitk.BinaryDilateImageFilter()
-    myFilter.SetBackgroundValue(0.0)
-    myFilter.SetBoundaryToForeground(False)
-    myFilter.SetDebug(False)
-    myFilter.SetForegroundValue(1.0)
-    myFilter.SetKernelRadius((1, 1, 1))
-    myFilter.SetKernelType(2)  # Kernel Type=Box
-    myFilter.SetNumberOfThreads(8)
-    output = myFilter.Execute(inputLabelImage)
-    castedOutput = sitk.Cast(output, sitk.sitkInt16)
+    return True
 
-    return castedOutput
+  def getIslandSuggestions(self, labelNode, inputT1VolumeNode, inputT2VolumeNode, seedList):
+    """
+    Returns a dict for every island that holds one of the (x, y, z) seeds of seedList, with the
+    seed, the label and the voxel indices of the island and the squareRootDiffLabelDict of its
+    bordering labels. The islands share one copy of the cached label statistics table, from
+    which all of them are subtracted, as if they had all been relabeled. Seeds outside of the
+    volume or in an island found for an earlier seed are skipped.
+    """
+    labelArray = getVolumeNodeArray(labelNode)
+    volumeArrays = [getVolumeNodeArray(inputT1VolumeNode), getVolumeNodeArray(inputT2VolumeNode)]
+    labelStatisticsTable = copy.deepcopy(self.getCachedLabelStatisticsTable(labelNode,
+                                                                            [inputT1VolumeNode, inputT2VolumeNode]))
+    islandSuggestions = list()
+    for seed in seedList:
+      if not all(0 <= seed[axis] < labelArray.shape[2 - axis] for axis in range(3)):
+        print 'Skipping the fiducial point outside of the label map at', seed
+        continue
+      if any((islandSuggestion['voxelIndices'] == seed).all(axis=1).any() for islandSuggestion in islandSuggestions):
+        continue
+      label = self.getLabel(labelArray, [seed])
+      voxelIndices = getSeedIslandVoxelIndices(labelArray, seed, fullyConnected=True)
+      x, y, z = voxelIndices.T
+      islandValues = [volumeArray[z, y, x].astype(np.float64) for volumeArray in volumeArrays]
+      labelStatisticsTable.relabelVoxels(label, 0, len(x), [values.sum() for values in islandValues],
+                                         [np.dot(values, values) for values in islandValues])
+      islandSuggestions.append({'seed': seed, 'label': label, 'voxelIndices': voxelIndices,
+                                'means': [values.mean() for values in islandValues]})
+
+    # all islands are scored against their bordering labels at once
+    candidateLabelLists = [self.getCandidateLabels(getTargetLabelsForIsland(labelArray, islandSuggestion['voxelIndices']),
+                                                   labelStatisticsTable)
+                           for islandSuggestion in islandSuggestions]
+    squareRootDiffLabelDicts = scoreIslands([islandSuggestion['means'] for islandSuggestion in islandSuggestions],
+                                            candidateLabelLists, labelStatisticsTable)
+    for islandSuggestion, squareRootDiffLabelDict in zip(islandSuggestions, squareRootDiffLabelDicts):
+      islandSuggestion['squareRootDiffLabelDict'] = squareRootDiffLabelDict
+    return islandSuggestions
+
+  def getLabel(self, labelArray, seedList):
+
+    return int(labelArray[seedList[0][2], seedList[0][1], seedList[0][0]])
 
   def calculateLabelIntensityDifferenceValue(self, averageT1IntensitySuspiciousLabel,
                                              averageT2IntensitySuspiciousLabel,
-                                             targetLabels, T1LabelStats, T2LabelStats):
+                                             targetLabels, labelStatisticsTable):
     """
-    Calculates a measurement for each label that is on the border of the suspicious label.
-    This value is the square root of the sum of the squared difference in the average T1
-    intensity values and the squared difference in the average T2 intensity values of the
-    two islands in the comparison. The calculated value for each border label will later be
-    sorted in ascending order - meaning that the smallest value has the "closest" average
-    intensity to the suspicious label.
+    Calculates a measurement for each label that is on the border of the suspicious label: the
+    square root of the sum of the squared differences of the average T1 and T2 intensities of
+    the island and of the label (see islandScoring). The smallest value is the "closest" label.
+    The average intensities of the border labels are looked up in labelStatisticsTable.
     """
+    return scoreIslands([[averageT1IntensitySuspiciousLabel, averageT2IntensitySuspiciousLabel]],
+                        [self.getCandidateLabels(targetLabels, labelStatisticsTable)], labelStatisticsTable)[0]
 
-    squareRootDiffLabelDict = dict()
+  def getCandidateLabels(self, targetLabels, labelStatisticsTable):
+    return [targetLabel for targetLabel in targetLabels
+            if targetLabel != 0 and labelStatisticsTable.getCount(targetLabel) > 0]
 
-    for targetLabel in targetLabels:
-      if targetLabel == 0:
-        continue
-      averageT1IntensityTargetLabel = T1LabelStats.GetMean(targetLabel)
-      averageT2IntensityTargetLabel = T2LabelStats.GetMean(targetLabel)
+  def runRelabelOutputLabelMap(self, inputLabelNode, outputLabelNodeName, items):
+    inputLabelNodeLUTNodeID = inputLabelNode.GetDisplayNode().GetColorNodeID()
+    newLabels = [int(item.text()) for item in items if item.checkState() == 2]
+    if not newLabels:
+      return
+    for newLabel in newLabels:
+      print('Changing the suspicious label to', newLabel)
+    # every checked label is applied to the input label map, so the last one is the one that is kept
+    self.relabelIslands(inputLabelNode, outputLabelNodeName, [(self.suspiciousIslandVoxelIndices, newLabels[-1])],
+                        'Relabel an island to label %d' % newLabels[-1])
+    self.setLabelLUT(outputLabelNodeName, inputLabelNodeLUTNodeID)
+
+  def runRelabelIslandSuggestions(self, inputLabelNode, outputLabelNodeName, islandLabels):
+    inputLabelNodeLUTNodeID = inputLabelNode.GetDisplayNode().GetColorNodeID()
+    if not islandLabels:
+      return
+    print('Relabeling %d islands' % len(islandLabels))
+    self.relabelIslands(inputLabelNode, outputLabelNodeName, islandLabels,
+                        'Relabel %d islands' % len(islandLabels))
+    self.setLabelLUT(outputLabelNodeName, inputLabelNodeLUTNodeID)
 
-      squareDiffAverageT1 = math.pow(averageT1IntensitySuspiciousLabel -
-                                     averageT1IntensityTargetLabel, 2)
-      squareDiffAverageT2 = math.pow(averageT2IntensitySuspiciousLabel -
-                                     averageT2IntensityTargetLabel, 2)
-      squareRootDiff = math.sqrt(squareDiffAverageT1 + squareDiffAverageT2)
+  def relabelIslands(self, inputLabelNode, outputLabelNodeName, islandLabels, description):
+    """
+    Writes the input label map with every (voxelIndices, newLabel) island of islandLabels
+    relabeled to the output label map, in one update of the output node.
+    """
+    def relabelIslandsInArray(labelArray):
+      changedVoxelIndices = list()
+      oldLabels = list()
+      for voxelIndices, newLabel in islandLabels:
+        x, y, z = np.asarray(voxelIndices).T
+        changedVoxelIndices.append(np.asarray(voxelIndices))
+        oldLabels.append(labelArray[z, y, x])
+        relabelArrayInPlace(labelArray, newLabel, voxelIndices=voxelIndices)
+      return np.concatenate(changedVoxelIndices), np.concatenate(oldLabels)
+    self.editOutputLabelMap(inputLabelNode, outputLabelNodeName, relabelIslandsInArray, description)
+
+  def editOutputLabelMap(self, inputLabelNode, outputLabelNodeName, editLabelArray, description):
+    """
+    Calls editLabelArray, which returns the (x, y, z) indices of the voxels it changed and their
+    old labels, on the array of the input label map and records the change in the edit journal.
+    The input is edited in place when it is the output label map, and otherwise an int16 copy of
+    it is edited and written to the output label map.
+    """
+    outputLabelNode = getOrAddLabelVolumeNode(outputLabelNodeName)
+    if outputLabelNode is not inputLabelNode:
+      labelArray = getVolumeNodeArray(inputLabelNode).astype(np.int16)
+      editLabelArray(labelArray)
+      self.writeLabelMap(outputLabelNode, labelArray, inputLabelNode, description)
+      return
+    labelArray = getVolumeNodeArray(outputLabelNode)
+    voxelIndices, oldLabels = editLabelArray(labelArray)
+    flatIndices = np.ravel_multi_index(tuple(voxelIndices[:, ::-1].T), labelArray.shape)
+    self.labelEditJournal.record(LabelEdit(description, outputLabelNode.GetID(), labelArray.shape,
+                                           flatIndices, oldLabels, labelArray.take(flatIndices)))
+    volumeNodeArrayModified(outputLabelNode)
+
+  def writeLabelMap(self, labelNode, labelArray, referenceNode, description):
+    """
+    Writes labelArray to labelNode and records the voxels that changed in the edit journal. A
+    label map that gets a new size or scalar type cannot be undone, so its edits are forgotten.
+    """
+    nodeArray = None
+    if labelNode.GetImageData() is not None:
+      nodeArray = getVolumeNodeArray(labelNode)
+    if (nodeArray is not None and nodeArray.shape == labelArray.shape and nodeArray.dtype == labelArray.dtype and
+        not np.may_share_memory(nodeArray, labelArray)):
+      self.labelEditJournal.record(LabelEdit(description, labelNode.GetID(), labelArray.shape,
+                                             *getArrayDiff(nodeArray, labelArray)))
+    else:
+      self.labelEditJournal.forgetNode(labelNode.GetID())
+    updateVolumeNodeFromArray(labelNode, labelArray, referenceNode)
 
-      squareRootDiffLabelDict[int(targetLabel)] = squareRootDiff
+  def undoLabelMapEdit(self):
+    """
+    Undoes the last recorded edit on its label map and returns it, or None if there is none.
+    """
+    if not self.labelEditJournal.canUndo():
+      return None
+    return self.applyLabelMapEdit(self.labelEditJournal.undo(), undo=True)
 
-    return squareRootDiffLabelDict
+  def redoLabelMapEdit(self):
+    """
+    Redoes the last undone edit on its label map and returns it, or None if there is none.
+    """
+    if not self.labelEditJournal.canRedo():
+      return None
+    return self.applyLabelMapEdit(self.labelEditJournal.redo(), undo=False)
+
+  def applyLabelMapEdit(self, labelEdit, undo):
+    labelNode = slicer.mrmlScene.GetNodeByID(labelEdit.nodeID)
+    if labelNode is None or labelNode.GetImageData() is None:
+      # the label map was removed from the scene
+      self.labelEditJournal.forgetNode(labelEdit.nodeID)
+      return None
+    if undo:
+      labelEdit.undo(getVolumeNodeArray(labelNode))
+    else:
+      labelEdit.redo(getVolumeNodeArray(labelNode))
+    volumeNodeArrayModified(labelNode)
+    return labelEdit
 
-  def runRelabelOutputLabelMap(self, inputLabelNode, outputLabelNodeName, items):
-    inputLabelNodeLUTNodeID = inputLabelNode.GetDisplayNode().GetColorNodeID()
-    for item in items:
-      if item.checkState() == 2:
-        print('Changing the suspicious label to', int(item.text()))
-        labelImage = self.getSitkInt16ImageFromSlicer(inputLabelNode.GetName())
-        relabeledImage = self.relabelImage(labelImage, self.connectedThresholdOutput, int(item.text()))
-        su.PushLabel(relabeledImage, outputLabelNodeName, overwrite=True)
-        self.setLabelLUT(outputLabelNodeName, inputLabelNodeLUTNodeID)
-
-  def relabelImage(self, labelImage, newRegion, newLabel):
-    castedLabelImage = sitk.Cast(labelImage, sitk.sitkInt16)
-    castedNewRegion = sitk.Cast(newRegion, sitk.sitkInt16)
-    negatedMask = sitk.BinaryNot(castedNewRegion)
-    negatedImage = sitk.Mask(castedLabelImage, negatedMask)
-    maskTimesNewLabel = sitk.Multiply(castedNewRegion, newLabel)
-    relabeledImage = sitk.Add(negatedImage, maskTimesNewLabel)
-
-    return relabeledImage
-
-  def printLabelStatistics(self, labelStatsObject):
-    for val in labelStatsObject.GetLabels():
+  def replayLabelMapEdits(self, editedLabelNode, labelNode):
+    """
+    Makes the recorded edits of editedLabelNode again on labelNode, for example a freshly
+    loaded copy of the atlas that editedLabelNode was made from.
+    """
+    self.labelEditJournal.replay(getVolumeNodeArray(labelNode), editedLabelNode.GetID())
+    volumeNodeArrayModified(labelNode)
+
+  def printLabelStatistics(self, labelStatisticsTable, labels):
+    for val in labels:
+      if labelStatisticsTable.getCount(val) == 0:
+        continue
       print 'Label:', int(val)
-      print('Count:', labelStatsObject.GetCount(val))
-      print('Mean:', labelStatsObject.GetMean(val))
-      print('Standard Deviation:', labelStatsObject.GetSigma(val))
-      print('Minimum:', labelStatsObject.GetMinimum(val))
-      print('Maximum:', labelStatsObject.GetMaximum(val))
+      print('Count:', labelStatisticsTable.getCount(val))
+      print('Mean:', labelStatisticsTable.getMean(val, 0))
+      print('Standard Deviation:', math.sqrt(labelStatisticsTable.getVariance(val, 0)))
+      print('Minimum:', labelStatisticsTable.getMinimum(val, 0))
+      print('Maximum:', labelStatisticsTable.getMaximum(val, 0))
 
-  def createSeedList(self, inputFiducialNode, inputVolumeNode):
+  def createSeedList(self, inputFiducialNode, inputVolumeNode, allFiducials=False):
     seedList = list()
     ras2ijk = self.getRas2ijkMatrix(inputVolumeNode)
     for val in range(0, inputFiducialNode.GetNumberOfFiducials()):
@@ -983,6 +1431,8 @@ class LabelAtlasEditorLogic(ScriptedLoadableModuleLogic):
       ijkPoint = self.getIJKFromRAS(rasPoint, ras2ijk)
       seedList.append(ijkPoint)
 
+    if allFiducials:
+      return seedList
     return seedList[0:1]
 
   def getRas2ijkMatrix(self, volumeNode):
@@ -1051,21 +1501,58 @@ class LabelAtlasEditorTest(ScriptedLoadableModuleTest):
     self.delayDisplay('Test passed!')
 
 class LocalDustCleanup(DustCleanup):
+  def __init__(self, arguments):
+    DustCleanup.__init__(self, arguments)
+    # the output is a node, so the profile is only written when a path is given
+    self.profilePath = arguments.get('--profilePath')
+    self.isCleanupFinished = False
+    self.cleanupError = None
+
   def main(self):
-    labelImage = su.PullFromSlicer(self.inputAtlasPath)
-    inputT1VolumeImage = su.PullFromSlicer(self.inputT1Path)
+    labelVolume, inputT1Volume, inputT2Volume = self.getInputVolumes()
+    self.cleanupLabelArray(labelVolume, inputT1Volume, inputT2Volume)
+    self.printIslandStatistics()
+    self.writeOutputVolume()
+    self.profiler.report(self.profilePath)
+
+  def getInputVolumes(self, copy=False):
+    """
+    Returns the input nodes as MemoryMappedVolumes whose arrays share the voxels of the nodes, or
+    with copy hold read-only copies of them for a worker thread (see getVolumeNodeVolume).
+    """
+    labelVolume = getVolumeNodeVolume(getVolumeNodeByName(self.inputAtlasPath), copy)
+    inputT1Volume = getVolumeNodeVolume(getVolumeNodeByName(self.inputT1Path), copy)
     if self.inputT2Path:
-      inputT2VolumeImage = su.PullFromSlicer(self.inputT2Path)
+      inputT2Volume = getVolumeNodeVolume(getVolumeNodeByName(self.inputT2Path), copy)
     else:
-      inputT2VolumeImage = None
-    labelsList = self.getLabelsList(inputT1VolumeImage, labelImage)
-    for label in labelsList:
-      labelImage = self.relabelCurrentLabel(labelImage, inputT1VolumeImage, inputT2VolumeImage, label)
-    self.printIslandStatistics()
+      inputT2Volume = None
+    return labelVolume, inputT1Volume, inputT2Volume
 
-    su.PushLabel(labelImage, self.outputAtlasPath, overwrite=True)
+  def writeOutputVolume(self, logic=None):
+    """
+    Writes the cleaned label map to the output node, through logic when given so that the cleanup
+    is recorded in its edit journal.
+    """
+    outputNode = getOrAddLabelVolumeNode(self.outputAtlasPath)
+    inputNode = getVolumeNodeByName(self.inputAtlasPath)
+    with self.profiler.stage('writeOutputVolume'):
+      if logic is not None:
+        logic.writeLabelMap(outputNode, self.labelArray, inputNode, 'Automatic dust cleanup')
+      else:
+        updateVolumeNodeFromArray(outputNode, self.labelArray, inputNode)
     self.setLabelLUT()
 
+  def cleanupInBackground(self, labelVolume, inputT1Volume, inputT2Volume):
+    """
+    Runs cleanupLabelArray in a worker thread. The exception that stopped the cleanup, if any,
+    is kept for the widget, which writes the result to the scene on the main thread.
+    """
+    try:
+      self.cleanupLabelArray(labelVolume, inputT1Volume, inputT2Volume)
+      self.isCleanupFinished = True
+    except Exception as error:
+      self.cleanupError = error
+
   def setLabelLUT(self):
     inputNode = slicer.util.getNode(pattern=self.inputAtlasPath)
     inputLabelNodeLUTNodeID = inputNode.GetDisplayNode().GetColorNodeID()
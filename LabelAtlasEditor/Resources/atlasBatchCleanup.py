@@ -0,0 +1,215 @@
+"""
+usage: atlasBatchCleanup.py --manifestPath=<argument> --summaryPath=<argument> --maximumIslandVoxelCount=<argument> [--includeLabelsList=<argument> | --excludeLabelsList=<argument>] [--useFullyConnectedInConnectedComponentFilter] [--forceSuspiciousLabelChange] [--noDilation] [--jobs=<argument>] [--subjectJobs=<argument>] [--modalityWeightsList=<argument>] [--useMahalanobisDistance] [--outputCompression=<argument>] [--threads=<argument>] [--memoryMegabytes=<argument>] [--runLengthEncoding] [--outOfCore]
+atlasBatchCleanup.py -h | --help
+
+Runs the atlasSmallIslandCleanup.py cleanup for every subject of a manifest in one process.
+The manifest is either a CSV file with a header row or a JSON list of objects, with the
+columns inputAtlasPath, inputT1Path and outputAtlasPath, and optionally inputT2Path,
+inputVolumePathsList (comma separated paths of more intensity volumes), subject and
+changeLogPath (where the change log of the subject is written, see cleanupChangeLog).
+With --subjectJobs=N the subjects are cleaned by a pool of N worker processes, otherwise they
+are cleaned one at a time while the images of the next subject are read and the output of the
+previous subject is written in the background. --outputCompression is default, none or fast
+(see backgroundVolumeIO). The summary (CSV or JSON, by file extension) has one row per subject.
+
+The --threads and --memoryMegabytes options set the resource budget of the batch (see
+resourceBudget): the subject pool is limited to the thread budget and every worker gets its share
+of both budgets.
+Without a pool, the images of the next subject are only read ahead, and the outputs written in
+the background, while they fit in the memory budget. --runLengthEncoding cleans every atlas as
+a RunLengthLabelMap and --outOfCore cleans every subject out of core (see
+atlasSmallIslandCleanup).
+"""
+
+import csv
+import json
+import multiprocessing
+import threading
+import time
+import traceback
+from Queue import Queue
+
+from atlasSmallIslandCleanup import DustCleanup
+from memoryMappedVolume import getVolumeBytes
+from resourceBudget import getResourceBudget
+
+summaryColumns = ['subject', 'status', 'numberOfIslands', 'numberOfIslandsCleaned', 'seconds', 'outputAtlasPath']
+
+def getInputImagesBytes(cleanup):
+  """
+  Returns the bytes of the input images of a subject that cleanup.readInputImages keeps in
+  memory, from the headers of the files. Memory-mapped volumes take none.
+  """
+  if cleanup.outOfCore:
+    return 0
+  paths = [cleanup.inputAtlasPath, cleanup.inputT1Path, cleanup.inputT2Path] + cleanup.inputVolumePathsList
+  return sum(getVolumeBytes(path) for path in paths if path)
+
+def cleanupSubject(subjectArguments, images=None):
+  """
+  Cleans one subject and returns its summary row. images are the input images of the subject
+  as returned by DustCleanup.readInputImages, or an exception raised while reading them, and
+  are read here if not given.
+  """
+  return finishSubjectCleanup(*startSubjectCleanup(subjectArguments, images))
+
+def startSubjectCleanup(subjectArguments, images=None, inputReservation=None):
+  """
+  Cleans one subject and starts writing its output atlas in the background. Returns the
+  summary row, the BackgroundTask of the write (None if the cleanup failed) and the start time,
+  for finishSubjectCleanup. inputReservation, the memory reserved for images, is released once
+  the subject is cleaned.
+  """
+  summary = {'subject': subjectArguments['subject'], 'outputAtlasPath': subjectArguments['--outputAtlasPath']}
+  startTime = time.time()
+  writeTask = None
+  try:
+    cleanup = DustCleanup(subjectArguments)
+    if images is None:
+      images = cleanup.readInputImages()
+    if isinstance(images, Exception):
+      raise images
+    labelImage = cleanup.cleanupLabelImage(*images)
+    if inputReservation is not None:
+      inputReservation.release()
+    writeTask = cleanup.writeOutputImageInBackground(labelImage)
+    cleanup.writeChangeLog()
+    summary['numberOfIslands'] = cleanup.islandStatistics['Total']['numberOfIslands']
+    summary['numberOfIslandsCleaned'] = cleanup.islandStatistics['Total']['numberOfIslandsCleaned']
+  except Exception as error:
+    traceback.print_exc()
+    summary['status'] = 'failed: %s' % error
+    if inputReservation is not None:
+      inputReservation.release()
+  summary['seconds'] = round(time.time() - startTime, 3)
+  return summary, writeTask, startTime
+
+def finishSubjectCleanup(summary, writeTask, startTime):
+  """
+  Waits until the output atlas of a subject is written and completes its summary row. The
+  seconds of a subject run from its start until its output was written.
+  """
+  if writeTask is not None:
+    try:
+      writeTask.getResult()
+      summary['status'] = 'done'
+    except Exception as error:
+      traceback.print_exc()
+      summary['status'] = 'failed: %s' % error
+    summary['seconds'] = round(writeTask.finishTime - startTime, 3)
+  return summary
+
+class BatchCleanup():
+
+  def __init__(self, arguments):
+    self.arguments = arguments
+    self.manifestPath = arguments['--manifestPath']
+    self.summaryPath = arguments['--summaryPath']
+    self.resourceBudget = getResourceBudget(arguments.get('--threads'), arguments.get('--memoryMegabytes'))
+    self.numberOfSubjectJobs = self.resourceBudget.getNumberOfWorkers(int(arguments.get('--subjectJobs') or 1))
+    self.subjects = self.readManifest(self.manifestPath)
+
+  def readManifest(self, manifestPath):
+    with open(manifestPath) as manifestFile:
+      if manifestPath.lower().endswith('.json'):
+        subjects = json.load(manifestFile)
+      else:
+        subjects = list(csv.DictReader(manifestFile))
+    for subjectIndex, subject in enumerate(subjects):
+      if not subject.get('subject'):
+        subject['subject'] = str(subjectIndex)
+      if not subject.get('inputT2Path'):
+        subject['inputT2Path'] = None
+      if not subject.get('changeLogPath'):
+        subject['changeLogPath'] = None
+      if not subject.get('inputVolumePathsList'):
+        subject['inputVolumePathsList'] = None
+    return subjects
+
+  def getSubjectArguments(self, subject):
+    subjectArguments = dict(self.arguments)
+    subjectArguments['subject'] = subject['subject']
+    subjectArguments['--inputAtlasPath'] = subject['inputAtlasPath']
+    subjectArguments['--inputT1Path'] = subject['inputT1Path']
+    subjectArguments['--inputT2Path'] = subject['inputT2Path']
+    subjectArguments['--outputAtlasPath'] = subject['outputAtlasPath']
+    subjectArguments['--changeLogPath'] = subject['changeLogPath']
+    subjectArguments['--inputVolumePathsList'] = subject['inputVolumePathsList']
+    if self.numberOfSubjectJobs > 1:
+      # pool workers cannot start their own label pools
+      subjectArguments['--jobs'] = None
+      subjectArguments = self.resourceBudget.getWorkerArguments(subjectArguments, self.numberOfSubjectJobs)
+    return subjectArguments
+
+  def main(self):
+    subjectArgumentsList = [self.getSubjectArguments(subject) for subject in self.subjects]
+    if self.numberOfSubjectJobs > 1:
+      pool = multiprocessing.Pool(self.numberOfSubjectJobs)
+      summaries = pool.imap(cleanupSubject, subjectArgumentsList)
+    else:
+      summaries = self.cleanupSubjectsWithPrefetch(subjectArgumentsList)
+
+    summaryRows = list()
+    for summary in summaries:
+      print len(summaryRows) + 1, '/', len(subjectArgumentsList), summary['subject'], summary['status'], summary['seconds']
+      summaryRows.append(summary)
+    if self.numberOfSubjectJobs > 1:
+      pool.close()
+      pool.join()
+    self.writeSummary(summaryRows)
+
+  def cleanupSubjectsWithPrefetch(self, subjectArgumentsList):
+    """
+    Cleans the subjects one at a time in this process. A reader thread reads the images of the
+    next subject while the current subject is cleaned. It starts reading a subject only once the
+    previous one has been taken for cleaning, so it stays at most one subject ahead, and only
+    once the memory budget has room for the bytes of its images, as given by the headers of the
+    files. The output of a subject is written while the next subject is cleaned, so the summary
+    of a subject is yielded once the next one has been cleaned.
+    """
+    prefetchQueue = Queue(maxsize=1)
+    readSlot = threading.Semaphore(1)
+
+    def readSubjects():
+      for subjectArguments in subjectArgumentsList:
+        readSlot.acquire()
+        inputReservation = None
+        try:
+          cleanup = DustCleanup(subjectArguments)
+          inputReservation = self.resourceBudget.reserve(getInputImagesBytes(cleanup))
+          images = cleanup.readInputImages()
+        except Exception as error:
+          images = error
+        prefetchQueue.put((images, inputReservation))
+
+    readerThread = threading.Thread(target=readSubjects)
+    readerThread.daemon = True
+    readerThread.start()
+    pendingSubjectCleanup = None
+    for subjectArguments in subjectArgumentsList:
+      images, inputReservation = prefetchQueue.get()
+      readSlot.release()
+      subjectCleanup = startSubjectCleanup(subjectArguments, images, inputReservation)
+      if pendingSubjectCleanup is not None:
+        yield finishSubjectCleanup(*pendingSubjectCleanup)
+      pendingSubjectCleanup = subjectCleanup
+    if pendingSubjectCleanup is not None:
+      yield finishSubjectCleanup(*pendingSubjectCleanup)
+
+  def writeSummary(self, summaryRows):
+    if self.summaryPath.lower().endswith('.json'):
+      with open(self.summaryPath, 'w') as summaryFile:
+        json.dump(summaryRows, summaryFile, indent=2)
+    else:
+      with open(self.summaryPath, 'wb') as summaryFile:
+        writer = csv.DictWriter(summaryFile, summaryColumns)
+        writer.writeheader()
+        writer.writerows(summaryRows)
+
+if __name__ == '__main__':
+  from docopt import docopt
+  arguments = docopt(__doc__)
+  print arguments
+  print "-"*50
+  Object = BatchCleanup(arguments)
+  Object.main()
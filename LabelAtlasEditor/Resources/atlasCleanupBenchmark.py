@@ -0,0 +1,252 @@
+"""
+usage: atlasCleanupBenchmark.py [--outputPath=<argument>] [--size=<argument>] [--numberOfLabels=<argument>] [--dustDensity=<argument>] [--maximumIslandVoxelCount=<argument>] [--seed=<argument>] [--repeats=<argument>] [--jobs=<argument>]
+atlasCleanupBenchmark.py -h | --help
+
+Times the cleanup engines on a synthetic atlas and writes the results as JSON to
+--outputPath (or prints them). The atlas is a Voronoi partition of a --size voxel cube
+(default 96) into --numberOfLabels labels (default 20) around a background shell, with a
+--dustDensity fraction of voxels (default 0.01) set to random labels, and comes with T1 and
+T2 volumes whose mean intensity depends on the label. Every engine runs --repeats times
+(default 3), each time in a new process, and is reported with its wall times, peak resident
+memory and cleaned islands per second; an engine that raises or whose process dies is reported
+with the error instead, and the remaining engines are still timed. The merge and region info operations of
+LabelAtlasEditorLogic are only timed when the script is run inside 3D Slicer.
+"""
+
+import json
+import multiprocessing
+import os
+import Queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+import SimpleITK as sitk
+
+def makeSyntheticAtlas(size, numberOfLabels, dustDensity, seed):
+  """
+  Returns the label, T1 and T2 arrays, indexed (z, y, x), of a synthetic atlas.
+  """
+  randomState = np.random.RandomState(seed)
+  shape = (size, size, size)
+  centers = randomState.uniform(0, size, (numberOfLabels, 3))
+  labelArray = np.zeros(shape, dtype=np.int16)
+  coordinates = np.arange(size, dtype=np.float32)
+  for z in range(size):
+    # one slice at a time so the distances to all centers never have to be held at once
+    squaredDistances = ((z - centers[:, 0, None, None]) ** 2 +
+                        (coordinates[None, :, None] - centers[:, 1, None, None]) ** 2 +
+                        (coordinates[None, None, :] - centers[:, 2, None, None]) ** 2)
+    labelArray[z] = np.argmin(squaredDistances, axis=0) + 1
+  z, y, x = np.ogrid[:size, :size, :size]
+  radius = (size - 1) / 2.0
+  labelArray[(z - radius) ** 2 + (y - radius) ** 2 + (x - radius) ** 2 > radius ** 2] = 0
+
+  dustMask = randomState.uniform(size=shape) < dustDensity
+  labelArray[dustMask] = randomState.randint(0, numberOfLabels + 1, int(dustMask.sum()))
+
+  t1Means = randomState.uniform(100, 1000, numberOfLabels + 1)
+  t2Means = randomState.uniform(100, 1000, numberOfLabels + 1)
+  t1Array = (t1Means[labelArray] + randomState.normal(0, 20, shape)).astype(np.float32)
+  t2Array = (t2Means[labelArray] + randomState.normal(0, 20, shape)).astype(np.float32)
+  return labelArray, t1Array, t2Array
+
+def writeSyntheticAtlas(directory, arrays):
+  paths = list()
+  for name, array in zip(('atlas', 't1', 't2'), arrays):
+    path = os.path.join(directory, name + '.nrrd')
+    sitk.WriteImage(sitk.GetImageFromArray(array), path)
+    paths.append(path)
+  return paths
+
+def getPeakRssMegabytes():
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return peakRss / 1024.0 / 1024.0
+  return peakRss / 1024.0
+
+def runSmallIslandCleanup(paths, outputPath, maximumIslandVoxelCount, noDilation, jobs):
+  from atlasSmallIslandCleanup import DustCleanup
+  cleanup = DustCleanup({'--inputAtlasPath': paths[0], '--outputAtlasPath': outputPath,
+                         '--inputT1Path': paths[1], '--inputT2Path': paths[2],
+                         '--includeLabelsList': None, '--excludeLabelsList': None,
+                         '--maximumIslandVoxelCount': str(maximumIslandVoxelCount),
+                         '--useFullyConnectedInConnectedComponentFilter': False,
+                         '--forceSuspiciousLabelChange': False, '--noDilation': noDilation,
+                         '--jobs': str(jobs)})
+  cleanup.main()
+  return cleanup.islandStatistics['Total']['numberOfIslands'], cleanup.islandStatistics['Total']['numberOfIslandsCleaned']
+
+def runDustCleanup(paths, outputPath, maximumIslandVoxelCount, label):
+  from atlasDustCleanup import DustCleanup
+  cleanup = DustCleanup({'--inputAtlasPath': paths[0], '--outputAtlasPath': outputPath,
+                         '--inputT1Path': paths[1], '--inputT2Path': paths[2], '--label': str(label),
+                         '--maximumIslandVoxelCount': str(maximumIslandVoxelCount),
+                         '--useFullyConnectedInConnectedComponentFilter': False,
+                         '--forceSuspiciousLabelChange': False})
+  cleanup.main()
+  return cleanup.numberOfIslands, cleanup.numberOfIslandsCleaned
+
+def runCase(case, resultQueue):
+  """
+  Runs one benchmark case in a worker process, with the output of the engine silenced, and
+  puts its timing, or the traceback of the error it raised, on resultQueue.
+  """
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    function, arguments = case
+    startTime = time.time()
+    numberOfIslands, numberOfIslandsCleaned = function(*arguments)
+    seconds = time.time() - startTime
+    resultQueue.put({'seconds': seconds, 'peakRssMegabytes': getPeakRssMegabytes(),
+                     'numberOfIslands': numberOfIslands, 'numberOfIslandsCleaned': numberOfIslandsCleaned})
+  except Exception:
+    resultQueue.put({'error': traceback.format_exc()})
+
+def timeCaseInProcess(case, pollSeconds=1.0):
+  """
+  Runs case in a new process and returns its result, or an error if the process exited without
+  putting a result on the queue (killed, out of memory, ...).
+  """
+  resultQueue = multiprocessing.Queue()
+  process = multiprocessing.Process(target=runCase, args=(case, resultQueue))
+  process.start()
+  result = None
+  while result is None:
+    hasExited = process.exitcode is not None
+    try:
+      result = resultQueue.get(timeout=pollSeconds)
+    except Queue.Empty:
+      # a result put just before the exit is read by the get after the exit was seen
+      if hasExited:
+        result = {'error': 'The case process exited with code %d without a result' % process.exitcode}
+  process.join()
+  return result
+
+def summarizeRuns(name, runs):
+  errors = [run['error'] for run in runs if 'error' in run]
+  if errors:
+    return {'name': name, 'numberOfFailedRuns': len(errors), 'error': errors[0]}
+  bestSeconds = min(run['seconds'] for run in runs)
+  numberOfIslandsCleaned = runs[0]['numberOfIslandsCleaned']
+  summary = {'name': name,
+             'seconds': [round(run['seconds'], 4) for run in runs],
+             'bestSeconds': round(bestSeconds, 4),
+             'peakRssMegabytes': round(max(run['peakRssMegabytes'] for run in runs), 1),
+             'numberOfIslands': runs[0]['numberOfIslands'],
+             'numberOfIslandsCleaned': numberOfIslandsCleaned,
+             'islandsPerSecond': None}
+  if numberOfIslandsCleaned is not None and bestSeconds > 0:
+    summary['islandsPerSecond'] = round(numberOfIslandsCleaned / bestSeconds, 1)
+  return summary
+
+class CleanupBenchmark():
+
+  def __init__(self, arguments):
+    self.outputPath = arguments['--outputPath']
+    self.size = int(arguments['--size'] or 96)
+    self.numberOfLabels = int(arguments['--numberOfLabels'] or 20)
+    self.dustDensity = float(arguments['--dustDensity'] or 0.01)
+    self.maximumIslandVoxelCount = int(arguments['--maximumIslandVoxelCount'] or 10)
+    self.seed = int(arguments['--seed'] or 0)
+    self.repeats = int(arguments['--repeats'] or 3)
+    self.numberOfJobs = int(arguments['--jobs'] or 1)
+
+  def getParameters(self):
+    return {'size': self.size, 'numberOfLabels': self.numberOfLabels, 'dustDensity': self.dustDensity,
+            'maximumIslandVoxelCount': self.maximumIslandVoxelCount, 'seed': self.seed,
+            'repeats': self.repeats, 'jobs': self.numberOfJobs}
+
+  def getCases(self, paths, outputPath):
+    cases = [('atlasSmallIslandCleanup', (runSmallIslandCleanup, (paths, outputPath, self.maximumIslandVoxelCount, False, 1))),
+             ('atlasSmallIslandCleanup --noDilation', (runSmallIslandCleanup, (paths, outputPath, self.maximumIslandVoxelCount, True, 1))),
+             ('atlasDustCleanup --label=1', (runDustCleanup, (paths, outputPath, self.maximumIslandVoxelCount, 1)))]
+    if self.numberOfJobs > 1:
+      cases.append(('atlasSmallIslandCleanup --jobs=%d' % self.numberOfJobs,
+                    (runSmallIslandCleanup, (paths, outputPath, self.maximumIslandVoxelCount, False, self.numberOfJobs))))
+    return cases
+
+  def main(self):
+    temporaryDirectory = tempfile.mkdtemp(prefix='atlasCleanupBenchmark')
+    try:
+      startTime = time.time()
+      paths = writeSyntheticAtlas(temporaryDirectory, makeSyntheticAtlas(self.size, self.numberOfLabels,
+                                                                         self.dustDensity, self.seed))
+      print 'Synthetic atlas written in %.2f s' % (time.time() - startTime)
+      results = list()
+      for name, case in self.getCases(paths, os.path.join(temporaryDirectory, 'output.nrrd')):
+        runs = [timeCaseInProcess(case) for repeat in range(self.repeats)]
+        results.append(summarizeRuns(name, runs))
+        if 'error' in results[-1]:
+          print name, 'failed:', results[-1]['error']
+        else:
+          print name, results[-1]['bestSeconds'], 's'
+      results.extend(self.getLogicResults(paths))
+    finally:
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+
+    report = {'parameters': self.getParameters(), 'simpleITKVersion': sitk.Version().VersionString(),
+              'numpyVersion': np.__version__, 'results': results}
+    if self.outputPath:
+      with open(self.outputPath, 'w') as reportFile:
+        json.dump(report, reportFile, indent=2)
+    else:
+      print json.dumps(report, indent=2)
+
+  def getLogicResults(self, paths):
+    """
+    Times the LabelAtlasEditorLogic operations in this process, on the synthetic atlas loaded
+    into the Slicer scene. Returns an empty list outside of Slicer.
+    """
+    try:
+      import slicer
+      import vtk
+      import sitkUtils as su
+      from LabelAtlasEditor import LabelAtlasEditorLogic
+    except ImportError:
+      print 'Not running in 3D Slicer, the LabelAtlasEditorLogic operations are not timed'
+      return list()
+
+    labelImage = sitk.ReadImage(paths[0])
+    su.PushLabel(labelImage, 'benchmarkAtlas', overwrite=True)
+    su.PushVolumeToSlicer(sitk.ReadImage(paths[1]), name='benchmarkT1')
+    su.PushVolumeToSlicer(sitk.ReadImage(paths[2]), name='benchmarkT2')
+    t1Node = slicer.util.getNode('benchmarkT1')
+    t2Node = slicer.util.getNode('benchmarkT2')
+
+    fiducialNode = slicer.util.getNode('DustCleanupModuleFiducialNode')
+    if fiducialNode is None:
+      fiducialNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'DustCleanupModuleFiducialNode')
+    fiducialNode.RemoveAllMarkups()
+    z, y, x = [int(value) for value in np.argwhere(sitk.GetArrayFromImage(labelImage) == 1)[0]]
+    ijkToRAS = vtk.vtkMatrix4x4()
+    t1Node.GetIJKToRASMatrix(ijkToRAS)
+    rasPoint = ijkToRAS.MultiplyPoint([x, y, z, 1])
+    fiducialNode.AddFiducial(*rasPoint[:3])
+
+    logic = LabelAtlasEditorLogic()
+    operations = [('LabelAtlasEditorLogic.mergeLabels', lambda: logic.mergeLabels('benchmarkAtlas', 1, 2, True, False, None, None)),
+                  ('LabelAtlasEditorLogic.runGetRegionInfo', lambda: logic.runGetRegionInfo('benchmarkAtlas', t1Node, t2Node))]
+    results = list()
+    for name, operation in operations:
+      runs = list()
+      for repeat in range(self.repeats):
+        startTime = time.time()
+        operation()
+        runs.append({'seconds': time.time() - startTime, 'peakRssMegabytes': getPeakRssMegabytes(),
+                     'numberOfIslands': None, 'numberOfIslandsCleaned': None})
+      results.append(summarizeRuns(name, runs))
+    return results
+
+if __name__ == '__main__':
+  from docopt import docopt
+  arguments = docopt(__doc__)
+  print arguments
+  print "-"*50
+  Object = CleanupBenchmark(arguments)
+  Object.main()
@@ -0,0 +1,48 @@
+"""
+usage: atlasCleanupReplay.py --inputAtlasPath=<argument> --changeLogPath=<argument> --outputAtlasPath=<argument> [--excludeIslandIdsList=<argument>] [--outputCompression=<argument>]
+atlasCleanupReplay.py -h | --help
+
+Applies the island decisions of a change log written with --changeLogPath by
+atlasSmallIslandCleanup.py or atlasDustCleanup.py to --inputAtlasPath, in one pass and without
+computing them again. The islands in --excludeIslandIdsList (comma separated island ids) keep
+their labels. --outputCompression is default, none or fast (see backgroundVolumeIO).
+"""
+
+import numpy as np
+from cleanupChangeLog import readCleanupChangeLog, applyCleanupChangeLog
+from memoryMappedVolume import readVolume, getVolumeArray, getImageFromVolumeArray
+from backgroundVolumeIO import writeVolume
+
+class CleanupReplay():
+
+  def __init__(self, arguments):
+    self.inputAtlasPath = arguments['--inputAtlasPath']
+    self.changeLogPath = arguments['--changeLogPath']
+    self.outputAtlasPath = arguments['--outputAtlasPath']
+    self.excludeIslandIdsList = self.evalInputListArg(arguments['--excludeIslandIdsList'])
+    self.outputCompression = arguments.get('--outputCompression') or 'default'
+
+  def evalInputListArg(self, inputArg):
+    if inputArg:
+      return map(int, inputArg.split(','))
+    else:
+      return None
+
+  def main(self):
+    labelVolume = readVolume(self.inputAtlasPath)
+    labelArray = getVolumeArray(labelVolume).astype(np.int16)
+    changeLog = readCleanupChangeLog(self.changeLogPath)
+    numberOfIslandsApplied, numberOfMismatchedVoxels = applyCleanupChangeLog(labelArray, changeLog,
+                                                                             self.excludeIslandIdsList)
+    print "Islands applied:", numberOfIslandsApplied, "of", len(changeLog['islandIds'])
+    if numberOfMismatchedVoxels:
+      print "WARNING:", numberOfMismatchedVoxels, "voxels did not have the source label of their island in", self.inputAtlasPath
+    writeVolume(getImageFromVolumeArray(labelArray, labelVolume), self.outputAtlasPath, self.outputCompression)
+
+if __name__ == '__main__':
+  from docopt import docopt
+  arguments = docopt(__doc__)
+  print arguments
+  print "-"*50
+  Object = CleanupReplay(arguments)
+  Object.main()
@@ -1,10 +1,32 @@
 """
-usage: atlasDustCleanup.py --inputAtlasPath=<argument> --outputAtlasPath=<argument> --inputT1Path=<argument> --inputT2Path=<argument> --label=<argument> --maximumIslandVoxelCount=<argument> [--useFullyConnectedInConnectedComponentFilter] [--forceSuspiciousLabelChange]
+usage: atlasDustCleanup.py --inputAtlasPath=<argument> --outputAtlasPath=<argument> --inputT1Path=<argument> --inputT2Path=<argument> --label=<argument> --maximumIslandVoxelCount=<argument> [--useFullyConnectedInConnectedComponentFilter] [--forceSuspiciousLabelChange] [--changeLogPath=<argument>] [--outputCompression=<argument>] [--profile] [--profilePath=<argument>] [--threads=<argument>] [--memoryMegabytes=<argument>]
 atlasDustCleanup.py -h | --help
+
+With --changeLogPath the decision taken for every cleaned island is also written to an NPZ
+change log (see cleanupChangeLog), which atlasCleanupReplay.py applies to an atlas.
+
+The T1 and T2 volumes are read in background threads while the islands are found, and the
+output atlas is written in the background, with --outputCompression default, none or fast (see
+backgroundVolumeIO).
+
+With --profile the calls, wall time and memory of every stage are recorded per island size (see
+cleanupProfiler); a summary table is printed and the JSON profile is written to --profilePath, or
+next to the output atlas.
+
+--threads and --memoryMegabytes set the thread budget of the SimpleITK filters and the memory
+budget of the output image written in the background (see resourceBudget).
 """
 
 import SimpleITK as sitk
-import math
+from labelStatisticsTable import LabelStatisticsTable
+from atlasIslandTable import getIslandVoxelIndices
+from cleanupChangeLog import CleanupChangeLog
+from islandScoring import scoreIslands
+from backgroundVolumeIO import BackgroundTask, writeVolume
+from cleanupProfiler import CleanupProfiler
+from resourceBudget import getResourceBudget, getImageBytes
+from labelArrayTools import (relabelArrayInPlace, getArrayViewFromImage, getLabelArrayFromImage,
+                             getImageFromLabelArray, getTargetLabelsForIsland)
 
 class DustCleanup():
 
@@ -17,49 +39,94 @@ class DustCleanup():
     self.maximumIslandVoxelCount = int(arguments['--maximumIslandVoxelCount'])
     self.useFullyConnectedInConnectedComponentFilter = arguments['--useFullyConnectedInConnectedComponentFilter']
     self.forceSuspiciousLabelChange = arguments['--forceSuspiciousLabelChange']
+    self.changeLogPath = arguments.get('--changeLogPath')
+    self.outputCompression = arguments.get('--outputCompression') or 'default'
+    self.profiler = CleanupProfiler(bool(arguments.get('--profile')))
+    self.profilePath = arguments.get('--profilePath') or self.outputAtlasPath + '.profile.json'
+    self.resourceBudget = getResourceBudget(arguments.get('--threads'), arguments.get('--memoryMegabytes'))
 
   def main(self):
-    labelImage = sitk.Cast(sitk.ReadImage(self.inputAtlasPath), sitk.sitkInt16)
+    readT1Task = BackgroundTask(sitk.ReadImage, self.inputT1Path)
+    readT2Task = BackgroundTask(sitk.ReadImage, self.inputT2Path)
+    with self.profiler.stage('readInputAtlas'):
+      labelImage = sitk.Cast(sitk.ReadImage(self.inputAtlasPath), sitk.sitkInt16)
     relabeledConnectedRegion = sitk.Cast(self.thresholdAtlas(labelImage), sitk.sitkInt16)
-    inputT1VolumeImage = sitk.ReadImage(self.inputT1Path)
-    inputT2VolumeImage = sitk.ReadImage(self.inputT2Path)
+    with self.profiler.stage('readInputVolumes'):
+      inputT1VolumeImage = readT1Task.getResult()
+      inputT2VolumeImage = readT2Task.getResult()
+    labelArray = getLabelArrayFromImage(labelImage)
+    with self.profiler.stage('labelStatisticsTable'):
+      labelStatisticsTable = LabelStatisticsTable(labelArray, [getArrayViewFromImage(inputT1VolumeImage),
+                                                               getArrayViewFromImage(inputT2VolumeImage)])
     labelStatsT1WithRelabeledConnectedRegion = self.getLabelStatsObject(inputT1VolumeImage, relabeledConnectedRegion)
     labelStatsT2WithRelabeledConnectedRegion = self.getLabelStatsObject(inputT2VolumeImage, relabeledConnectedRegion)
     labelList = self.getLabelListFromLabelStatsObject(labelStatsT1WithRelabeledConnectedRegion)
     labelList.reverse()
+    with self.profiler.stage('getLabelShapeStatsObject'):
+      islandShapeStats = sitk.LabelShapeStatisticsImageFilter()
+      islandShapeStats.Execute(relabeledConnectedRegion)
     print "Number of islands:", len(labelList)
+    self.numberOfIslands = len(labelList)
+    self.numberOfIslandsCleaned = 0
+    cleanupChangeLog = CleanupChangeLog() if self.changeLogPath else None
 
     for currentLabel in labelList:
       islandVoxelCount = labelStatsT1WithRelabeledConnectedRegion.GetCount(currentLabel)
       if islandVoxelCount <= self.maximumIslandVoxelCount:
+        self.profiler.setContext(self.label, islandVoxelCount)
         meanT1Intesity = labelStatsT1WithRelabeledConnectedRegion.GetMean(currentLabel)
         meanT2Intesity = labelStatsT2WithRelabeledConnectedRegion.GetMean(currentLabel)
-        targetLabels = self.getTargetLabels(labelImage, relabeledConnectedRegion, inputT1VolumeImage, currentLabel)
-        diffDict = self.calculateLabelIntensityDifferenceValue(meanT1Intesity, meanT2Intesity,
-                                                               targetLabels, inputT1VolumeImage,
-                                                               inputT2VolumeImage, labelImage)
+        with self.profiler.stage('getIslandVoxelIndices'):
+          voxelIndices = getIslandVoxelIndices(relabeledConnectedRegion, currentLabel,
+                                               islandShapeStats.GetBoundingBox(currentLabel))
+        with self.profiler.stage('getTargetLabelsForIsland'):
+          targetLabels = getTargetLabelsForIsland(labelArray, voxelIndices)
+        with self.profiler.stage('calculateLabelIntensityDifferenceValue'):
+          diffDict = self.calculateLabelIntensityDifferenceValue(meanT1Intesity, meanT2Intesity,
+                                                                 targetLabels, labelStatisticsTable)
         if self.forceSuspiciousLabelChange:
           diffDict.pop(self.label)
         print currentLabel, islandVoxelCount, diffDict
         sortedLabelList = self.getDictKeysListSortedByValue(diffDict)
-        currentLabelBinaryThresholdImage = sitk.BinaryThreshold(relabeledConnectedRegion, currentLabel, currentLabel)
-        labelImage = self.relabelImage(labelImage, currentLabelBinaryThresholdImage, sortedLabelList[0])
+        with self.profiler.stage('relabelIsland'):
+          relabelArrayInPlace(labelArray, sortedLabelList[0], voxelIndices=voxelIndices)
+          if cleanupChangeLog is not None:
+            cleanupChangeLog.addIsland(self.label, voxelIndices, sortedLabelList[0], diffDict, currentLabel)
+          labelStatisticsTable.relabelIsland(self.label, sortedLabelList[0],
+                                             [labelStatsT1WithRelabeledConnectedRegion,
+                                              labelStatsT2WithRelabeledConnectedRegion],
+                                             currentLabel)
+        self.numberOfIslandsCleaned += 1
       else:
         break
-    sitk.WriteImage(labelImage, self.outputAtlasPath)
+    self.profiler.setContext()
+    outputImage = getImageFromLabelArray(labelArray, labelImage)
+    writeTask = BackgroundTask(self.writeOutputImage, outputImage, self.resourceBudget.reserve(getImageBytes(outputImage), wait=False))
+    if cleanupChangeLog is not None:
+      with self.profiler.stage('writeChangeLog'):
+        cleanupChangeLog.write(self.changeLogPath, labelArray.shape)
+    writeTask.getResult()
+    self.profiler.report(self.profilePath)
+
+  def writeOutputImage(self, labelImage, reservation):
+    with reservation:
+      with self.profiler.stage('writeOutputImage'):
+        writeVolume(labelImage, self.outputAtlasPath, self.outputCompression)
 
   def thresholdAtlas(self, labelImage):
-    binaryThresholdImage = sitk.BinaryThreshold(labelImage, self.label, self.label)
-    if not self.useFullyConnectedInConnectedComponentFilter:
-      connectedRegion = sitk.ConnectedComponent(binaryThresholdImage, fullyConnected=False)
-    else:
-      connectedRegion = sitk.ConnectedComponent(binaryThresholdImage, fullyConnected=True)
-    relabeledConnectedRegion = sitk.RelabelComponent(connectedRegion)
+    with self.profiler.stage('thresholdAtlas'):
+      binaryThresholdImage = sitk.BinaryThreshold(labelImage, self.label, self.label)
+      if not self.useFullyConnectedInConnectedComponentFilter:
+        connectedRegion = sitk.ConnectedComponent(binaryThresholdImage, fullyConnected=False)
+      else:
+        connectedRegion = sitk.ConnectedComponent(binaryThresholdImage, fullyConnected=True)
+      relabeledConnectedRegion = sitk.RelabelComponent(connectedRegion)
     return relabeledConnectedRegion
 
   def getLabelStatsObject(self, volumeImage, labelImage):
-    labelStatsObject = sitk.LabelStatisticsImageFilter()
-    labelStatsObject.Execute(volumeImage, labelImage)
+    with self.profiler.stage('getLabelStatsObject'):
+      labelStatsObject = sitk.LabelStatisticsImageFilter()
+      labelStatsObject.Execute(volumeImage, labelImage)
 
     return labelStatsObject
 
@@ -70,83 +137,23 @@ class DustCleanup():
       compontentLabels = labelStatsObject.GetValidLabels()
     return list(compontentLabels)
 
-  def getTargetLabels(self, labelImage, relabeledConnectedRegion, inputVolumeImage, currentLabel):
-    currentLabelBinaryThresholdImage = sitk.BinaryThreshold(relabeledConnectedRegion, currentLabel, currentLabel)
-    castedCurrentLabelBinaryThresholdImage = sitk.Cast(currentLabelBinaryThresholdImage, sitk.sitkInt16)
-
-    dialatedBinaryLabelMap = self.dialateLabelMap(castedCurrentLabelBinaryThresholdImage)
-    outsideValue = -1
-    reducedLabelMapImage = sitk.Mask(labelImage, dialatedBinaryLabelMap, outsideValue=outsideValue)
-
-    reducedLabelMapT1LabelStats = self.getLabelStatsObject(inputVolumeImage, reducedLabelMapImage)
-    targetLabels = self.getLabelListFromLabelStatsObject(reducedLabelMapT1LabelStats)
-    targetLabels = self.removeOutsideValueFromTargetLabels(targetLabels, outsideValue)
-    return targetLabels
-
-  def removeOutsideValueFromTargetLabels(self, targetLabels, outsideValue):
-    if outsideValue in targetLabels:
-      targetLabels.remove(outsideValue)
-    return targetLabels
-
-  def dialateLabelMap(self, inputLabelImage):
-    myFilter = sitk.BinaryDilateImageFilter()
-    myFilter.SetBackgroundValue(0.0)
-    myFilter.SetBoundaryToForeground(False)
-    myFilter.SetDebug(False)
-    myFilter.SetForegroundValue(1.0)
-    myFilter.SetKernelRadius((1, 1, 1))
-    myFilter.SetKernelType(2)  # Kernel Type=Box
-    myFilter.SetNumberOfThreads(8)
-    output = myFilter.Execute(inputLabelImage)
-    castedOutput = sitk.Cast(output, sitk.sitkInt16)
-
-    return castedOutput
-
   def calculateLabelIntensityDifferenceValue(self, averageT1IntensitySuspiciousLabel,
                                              averageT2IntensitySuspiciousLabel,
-                                             targetLabels, inputT1VolumeImage,
-                                             inputT2VolumeImage, inputLabelImage):
+                                             targetLabels, labelStatisticsTable):
     """
-    Calculates a measurement for each label that is on the border of the suspicious label.
-    This value is the square root of the sum of the squared difference in the average T1
-    intensity values and the squared difference in the average T2 intensity values of the
-    two islands in the comparison. The calculated value for each border label will later be
-    sorted in ascending order - meaning that the smallest value has the "closest" average
-    intensity to the suspicious label.
+    Calculates a measurement for each label that is on the border of the suspicious label: the
+    square root of the sum of the squared differences of the average T1 and T2 intensities of
+    the island and of the label (see islandScoring). The smallest value is the "closest" label.
+    The average intensities of the border labels are looked up in the running
+    labelStatisticsTable of the current label image.
     """
-
-    squareRootDiffLabelDict = dict()
-    labelStatsT1WithInputLabelImage = self.getLabelStatsObject(inputT1VolumeImage, inputLabelImage)
-    labelStatsT2WithInputLabelImage = self.getLabelStatsObject(inputT2VolumeImage, inputLabelImage)
-
-    for targetLabel in targetLabels:
-      # if targetLabel == 0:
-      #   continue
-      averageT1IntensityTargetLabel = labelStatsT1WithInputLabelImage.GetMean(targetLabel)
-      averageT2IntensityTargetLabel = labelStatsT2WithInputLabelImage.GetMean(targetLabel)
-      # print('targetLabel', targetLabel)
-      # print('averageT1IntensityTargetLabel', averageT1IntensityTargetLabel)
-      # print('averageT1IntensitySuspiciousLabel', averageT1IntensitySuspiciousLabel)
-      # print('averageT2IntensityTargetLabel', averageT2IntensityTargetLabel)
-      # print('averageT2IntensitySuspiciousLabel', averageT2IntensitySuspiciousLabel)
-      squareDiffAverageT1 = math.pow(averageT1IntensitySuspiciousLabel -
-                                     averageT1IntensityTargetLabel, 2)
-      squareDiffAverageT2 = math.pow(averageT2IntensitySuspiciousLabel -
-                                     averageT2IntensityTargetLabel, 2)
-      squareRootDiff = math.sqrt(squareDiffAverageT1 + squareDiffAverageT2)
-
-      squareRootDiffLabelDict[int(targetLabel)] = squareRootDiff
-
-    return squareRootDiffLabelDict
+    return scoreIslands([[averageT1IntensitySuspiciousLabel, averageT2IntensitySuspiciousLabel]],
+                        [targetLabels], labelStatisticsTable)[0]
 
   def relabelImage(self, labelImage, newRegion, newLabel):
-    castedLabelImage = sitk.Cast(labelImage, sitk.sitkInt16)
-    castedNewRegion = sitk.Cast(newRegion, sitk.sitkInt16)
-    negatedMask = sitk.BinaryNot(castedNewRegion)
-    negatedImage = sitk.Mask(castedLabelImage, negatedMask)
-    maskTimesNewLabel = sitk.Multiply(castedNewRegion, newLabel)
-    relabeledImage = sitk.Add(negatedImage, maskTimesNewLabel)
-    return relabeledImage
+    labelArray = getLabelArrayFromImage(labelImage)
+    relabelArrayInPlace(labelArray, newLabel, mask=getArrayViewFromImage(newRegion))
+    return getImageFromLabelArray(labelArray, labelImage)
 
   def getDictKeysListSortedByValue(self, val):
     return sorted(val, key=val.get)
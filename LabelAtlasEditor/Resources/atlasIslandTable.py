@@ -0,0 +1,102 @@
+import SimpleITK as sitk
+import numpy as np
+from runLengthLabelMap import RunLengthLabelMap
+
+def getIslandVoxelIndices(componentImage, componentLabel, boundingBox):
+  """
+  Returns the (N, 3) array of (x, y, z) indices of the voxels with value componentLabel, looking
+  only inside boundingBox (in the SimpleITK (x, y, z, sizeX, sizeY, sizeZ) layout).
+  """
+  index = list(boundingBox[:3])
+  size = list(boundingBox[3:])
+  componentArrayInBoundingBox = sitk.GetArrayFromImage(sitk.RegionOfInterest(componentImage, size, index))
+  # numpy arrays are indexed (z, y, x) so reverse the columns to get SimpleITK indices
+  zyxIndices = np.argwhere(componentArrayInBoundingBox == componentLabel)
+  return zyxIndices[:, ::-1] + np.array(index)
+
+class Island():
+  """
+  One connected region of voxels that share the same atlas label.
+  componentLabel is the value of the island in AtlasIslandTable.componentImage, boundingBox is
+  in the SimpleITK (x, y, z, sizeX, sizeY, sizeZ) layout and voxelIndices is an (N, 3) array of
+  (x, y, z) indices, or None if the island is larger than the indexed island size of the table.
+  """
+
+  def __init__(self, componentLabel, label, voxelCount, boundingBox, voxelIndices):
+    self.componentLabel = componentLabel
+    self.label = label
+    self.voxelCount = voxelCount
+    self.boundingBox = boundingBox
+    self.voxelIndices = voxelIndices
+
+class AtlasIslandTable():
+  """
+  Finds the islands of every label of an atlas with a single connected component scan.
+
+  The scan runs a ScalarConnectedComponentImageFilter with a distance threshold of zero, so
+  neighbouring voxels are joined only if they have the same label, and then one shape statistics
+  pass to get the voxel count and bounding box of every island. If label is given only the
+  islands of that label are scanned. The islands of each label are kept in the order used by
+  RelabelComponentImageFilter (largest first, ties in scan order).
+
+  labelImage can also be a RunLengthLabelMap, whose islands are found by joining its runs
+  instead (see RunLengthLabelMap.getIslands); componentImage is then None and the
+  componentLabel of an island is its first run.
+  """
+
+  def __init__(self, labelImage, fullyConnected=False, maximumIndexedIslandVoxelCount=None, label=None):
+    self.islandsByLabel = dict()
+    if isinstance(labelImage, RunLengthLabelMap):
+      self.componentImage = None
+      for firstRun, islandLabel, voxelCount, boundingBox, runIndices in labelImage.getIslands(fullyConnected, label):
+        if maximumIndexedIslandVoxelCount and voxelCount <= maximumIndexedIslandVoxelCount:
+          voxelIndices = np.column_stack(labelImage.getRunVoxels(runIndices)[::-1])
+        else:
+          voxelIndices = None
+        island = Island(firstRun, islandLabel, voxelCount, boundingBox, voxelIndices)
+        self.islandsByLabel.setdefault(islandLabel, list()).append(island)
+      self.sortIslands()
+      return
+
+    if label is None:
+      # shift the labels by one so that label 0 is not treated as background by the scan
+      shiftedLabelImage = sitk.Cast(labelImage, sitk.sitkInt32) + 1
+      self.componentImage = sitk.ScalarConnectedComponent(shiftedLabelImage, 0.0, fullyConnected)
+      labelStatsObject = sitk.LabelStatisticsImageFilter()
+      labelStatsObject.Execute(shiftedLabelImage, self.componentImage)
+    else:
+      maskForLabel = sitk.BinaryThreshold(labelImage, label, label)
+      self.componentImage = sitk.ConnectedComponent(maskForLabel, fullyConnected)
+      labelStatsObject = None
+
+    shapeStatsObject = sitk.LabelShapeStatisticsImageFilter()
+    shapeStatsObject.Execute(self.componentImage)
+
+    for componentLabel in shapeStatsObject.GetLabels():
+      componentLabel = int(componentLabel)
+      if labelStatsObject:
+        islandLabel = int(labelStatsObject.GetMinimum(componentLabel)) - 1
+      else:
+        islandLabel = int(label)
+      voxelCount = int(shapeStatsObject.GetNumberOfPixels(componentLabel))
+      boundingBox = shapeStatsObject.GetBoundingBox(componentLabel)
+      if maximumIndexedIslandVoxelCount and voxelCount <= maximumIndexedIslandVoxelCount:
+        voxelIndices = getIslandVoxelIndices(self.componentImage, componentLabel, boundingBox)
+      else:
+        voxelIndices = None
+      island = Island(componentLabel, islandLabel, voxelCount, boundingBox, voxelIndices)
+      self.islandsByLabel.setdefault(islandLabel, list()).append(island)
+    self.sortIslands()
+
+  def sortIslands(self):
+    for islands in self.islandsByLabel.values():
+      islands.sort(key=lambda island: (-island.voxelCount, island.componentLabel))
+
+  def getLabels(self):
+    return sorted(self.islandsByLabel)
+
+  def getIslandsForLabel(self, label):
+    return self.islandsByLabel.get(label, list())
+
+  def getNumberOfIslands(self):
+    return sum(len(islands) for islands in self.islandsByLabel.values())
@@ -1,10 +1,58 @@
 """
-usage: atlasSmallIslandCleanup.py --inputAtlasPath=<argument> --outputAtlasPath=<argument> --inputT1Path=<argument> [--inputT2Path=<argument>] [--includeLabelsList=<argument> | --excludeLabelsList=<argument>] --maximumIslandVoxelCount=<argument> [--useFullyConnectedInConnectedComponentFilter] [--forceSuspiciousLabelChange] [--noDilation]
+usage: atlasSmallIslandCleanup.py --inputAtlasPath=<argument> --outputAtlasPath=<argument> --inputT1Path=<argument> [--inputT2Path=<argument>] [--inputVolumePathsList=<argument>] [--modalityWeightsList=<argument>] [--useMahalanobisDistance] [--includeLabelsList=<argument> | --excludeLabelsList=<argument>] --maximumIslandVoxelCount=<argument> [--useFullyConnectedInConnectedComponentFilter] [--forceSuspiciousLabelChange] [--noDilation] [--jobs=<argument>] [--changeLogPath=<argument>] [--outputCompression=<argument>] [--profile] [--profilePath=<argument>] [--threads=<argument>] [--memoryMegabytes=<argument>] [--runLengthEncoding] [--outOfCore]
 atlasSmallIslandCleanup.py -h | --help
+
+Islands are scored against their bordering labels in every intensity volume: T1, T2 and the
+comma separated --inputVolumePathsList (FLAIR, PD, posteriors, ...), in that order. The comma
+separated --modalityWeightsList gives one weight per volume, and --useMahalanobisDistance divides
+the differences by the variances of the labels (see islandScoring).
+
+With --changeLogPath the decision taken for every cleaned island is also written to an NPZ
+change log (see cleanupChangeLog), which atlasCleanupReplay.py applies to an atlas.
+
+The input volumes are read in background threads and the output atlas is written in the
+background, with --outputCompression default, none or fast (see backgroundVolumeIO).
+
+With --profile the calls, wall time and memory of every stage are recorded per label and island
+size (see cleanupProfiler); a summary table is printed and the JSON profile is written to
+the --profilePath, or next to the output atlas.
+
+The --threads and --memoryMegabytes options set the thread budget of the SimpleITK filters and of
+the --jobs pool and the memory budget of the volumes kept in the background; by default they come
+from the environment or the cgroup limits of the machine (see resourceBudget).
+
+With --runLengthEncoding the atlas is cleaned as a RunLengthLabelMap, which keeps the runs of
+every row of voxels instead of an Int16 copy of the atlas and finds islands and label contacts
+on the runs (see runLengthLabelMap). It is decoded only to write the output atlas.
+
+With --outOfCore atlases that do not fit in memory next to their intensity volumes are cleaned.
+The atlas is cleaned as a RunLengthLabelMap, the intensity volumes are memory-mapped (compressed
+files are decompressed one at a time to temporary files), the islands of a label are found in
+blocks sized from the memory budget (see chunkedIslandSchedule) and a NRRD output atlas is
+written a slab at a time.
 """
 
 import SimpleITK as sitk
+import numpy as np
 import math
+from labelStatisticsTable import LabelStatisticsTable
+from atlasIslandTable import AtlasIslandTable
+from islandSizeSchedule import IslandSizeSchedule
+from chunkedIslandSchedule import ChunkedIslandSchedule
+from labelArrayTools import relabelArrayInPlace, getArrayViewFromImage, getLabelArrayFromImage, getImageFromLabelArray
+from labelAdjacencyGraph import LabelAdjacencyGraph
+from cleanupChangeLog import CleanupChangeLog
+from islandScoring import scoreIslands
+from memoryMappedVolume import getVolumeArray, getImageFromVolumeArray, getVolumeGeometry, readMemoryMappedVolume
+from backgroundVolumeIO import BackgroundTask, readVolumesInBackground, getVolumes, writeVolume, writeVolumeSlabs
+from cleanupProfiler import CleanupProfiler
+from resourceBudget import getResourceBudget, getImageBytes
+from runLengthLabelMap import RunLengthLabelMap, getRunLengthLabelMap
+
+class CleanupCancelled(Exception):
+  """
+  Raised by DustCleanup.cleanupLabelImage when cancelRequested has been set.
+  """
 
 class DustCleanup():
 
@@ -19,7 +67,23 @@ class DustCleanup():
     self.useFullyConnectedInConnectedComponentFilter = arguments['--useFullyConnectedInConnectedComponentFilter']
     self.forceSuspiciousLabelChange = arguments['--forceSuspiciousLabelChange']
     self.noDilation = arguments['--noDilation']
+    self.numberOfJobs = int(arguments.get('--jobs') or 1)
+    self.changeLogPath = arguments.get('--changeLogPath')
+    self.inputVolumePathsList = self.evalInputPathListArg(arguments.get('--inputVolumePathsList'))
+    self.modalityWeightsList = self.evalInputWeightListArg(arguments.get('--modalityWeightsList'))
+    self.useMahalanobisDistance = bool(arguments.get('--useMahalanobisDistance'))
+    self.outputCompression = arguments.get('--outputCompression') or 'default'
+    self.profiler = CleanupProfiler(bool(arguments.get('--profile')))
+    self.profilePath = arguments.get('--profilePath') or self.outputAtlasPath + '.profile.json'
+    self.resourceBudget = getResourceBudget(arguments.get('--threads'), arguments.get('--memoryMegabytes'))
+    self.outOfCore = bool(arguments.get('--outOfCore'))
+    self.useRunLengthEncoding = bool(arguments.get('--runLengthEncoding')) or self.outOfCore
+    self.arguments = arguments
     self.islandStatistics = {'Total': {'numberOfIslandsCleaned': 0, 'numberOfIslands': 0}}
+    # progress and cancellation for callers that run the cleanup in another thread
+    self.numberOfLabels = 0
+    self.numberOfLabelsProcessed = 0
+    self.cancelRequested = False
 
   def evalInputListArg(self, inputArg):
     if inputArg:
@@ -27,22 +91,185 @@ class DustCleanup():
     else:
       return None
 
-  def main(self):
-    labelImage = sitk.Cast(sitk.ReadImage(self.inputAtlasPath), sitk.sitkInt16)
-    inputT1VolumeImage = sitk.ReadImage(self.inputT1Path)
-    if self.inputT2Path:
-      inputT2VolumeImage = sitk.ReadImage(self.inputT2Path)
+  def evalInputPathListArg(self, inputArg):
+    if inputArg:
+      return inputArg.split(',')
     else:
-      inputT2VolumeImage = None
-    labelsList = self.getLabelsList(inputT1VolumeImage, labelImage)
-    for label in labelsList:
-      labelImage = self.relabelCurrentLabel(labelImage, inputT1VolumeImage, inputT2VolumeImage, label)
+      return list()
+
+  def evalInputWeightListArg(self, inputArg):
+    if inputArg:
+      return map(float, inputArg.split(','))
+    else:
+      return None
+
+  def main(self):
+    with self.profiler.stage('readInputImages'):
+      images = self.readInputImages()
+    labelImage = self.cleanupLabelImage(*images)
+    writeTask = self.writeOutputImageInBackground(labelImage)
     self.printIslandStatistics()
-    sitk.WriteImage(labelImage, self.outputAtlasPath)
+    self.writeChangeLog()
+    writeTask.getResult()
+    self.profiler.report(self.profilePath)
+
+  def readInputImages(self):
+    """
+    Opens the atlas and the intensity volumes as MemoryMappedVolumes, so that only the voxels
+    used by the cleanup are read from uncompressed NRRD and NIfTI files. Compressed files are
+    read and decompressed at the same time, each in its own thread, or with --outOfCore one
+    after the other into memory-mapped temporary files.
+    """
+    paths = [self.inputAtlasPath, self.inputT1Path, self.inputT2Path] + self.inputVolumePathsList
+    if self.outOfCore:
+      volumes = [readMemoryMappedVolume(path) if path else None for path in paths]
+    else:
+      volumes = getVolumes(readVolumesInBackground(paths))
+    return volumes[0], volumes[1], volumes[2], volumes[3:]
 
-  def getLabelsList(self, volumeImage, labelImage):
-    labelStatsObject = self.getLabelStatsObject(volumeImage, labelImage)
-    labelsList = self.getLabelListFromLabelStatsObject(labelStatsObject)
+  def writeOutputImageInBackground(self, labelImage):
+    """
+    Starts writing labelImage to the output atlas path and returns the BackgroundTask. The image
+    is kept in the memory budget until it is written. A RunLengthLabelMap is written a slab at a
+    time and is not counted again.
+    """
+    if isinstance(labelImage, RunLengthLabelMap):
+      return BackgroundTask(self.writeOutputImage, labelImage)
+    reservation = self.resourceBudget.reserve(getImageBytes(labelImage), wait=False)
+    return BackgroundTask(self.writeOutputImage, labelImage, reservation)
+
+  def writeOutputImage(self, labelImage, reservation=None):
+    try:
+      with self.profiler.stage('writeOutputImage'):
+        if isinstance(labelImage, RunLengthLabelMap):
+          writeVolumeSlabs(labelImage, self.labelGeometry, self.outputAtlasPath, self.outputCompression)
+        else:
+          writeVolume(labelImage, self.outputAtlasPath, self.outputCompression)
+    finally:
+      if reservation is not None:
+        reservation.release()
+
+  def cleanupLabelImage(self, labelImage, inputT1VolumeImage, inputT2VolumeImage, inputVolumeImages=None):
+    """
+    Cleans labelImage and returns the cleaned label image. The inputs are SimpleITK images or
+    MemoryMappedVolumes, with inputVolumeImages the intensity volumes after T1 and T2. The
+    islands are relabeled in place in self.labelArray, an Int16 copy of the atlas or its
+    RunLengthLabelMap, which is turned back into an image once at the end. With --outOfCore the
+    RunLengthLabelMap itself is returned, for writeOutputImageInBackground.
+    """
+    self.cleanupLabelArray(labelImage, inputT1VolumeImage, inputT2VolumeImage, inputVolumeImages)
+    if self.outOfCore:
+      return self.labelArray
+    with self.profiler.stage('getImageFromVolumeArray'):
+      return getImageFromVolumeArray(self.getLabelArray(), labelImage)
+
+  def cleanupLabelArray(self, labelImage, inputT1VolumeImage, inputT2VolumeImage, inputVolumeImages=None):
+    """
+    Cleans labelImage into self.labelArray without turning the result into an image.
+    """
+    self.labelGeometry = getVolumeGeometry(labelImage)
+    with self.profiler.stage('castLabelArray'):
+      if self.useRunLengthEncoding:
+        self.labelArray = getRunLengthLabelMap(getVolumeArray(labelImage))
+      else:
+        self.labelArray = getVolumeArray(labelImage).astype(np.int16)
+    self.volumeArrays = [getVolumeArray(inputT1VolumeImage)]
+    if inputT2VolumeImage:
+      self.volumeArrays.append(getVolumeArray(inputT2VolumeImage))
+    self.volumeArrays.extend(getVolumeArray(inputVolumeImage) for inputVolumeImage in inputVolumeImages or list())
+    for volumeArray in self.volumeArrays:
+      if volumeArray.shape != self.labelArray.shape:
+        raise ValueError("The intensity volumes do not have the size of the atlas: %s" % self.inputAtlasPath)
+    if self.modalityWeightsList and len(self.modalityWeightsList) != len(self.volumeArrays):
+      raise ValueError("%d modality weights were given for %d intensity volumes" %
+                       (len(self.modalityWeightsList), len(self.volumeArrays)))
+    with self.profiler.stage('labelStatisticsTable'):
+      self.labelStatisticsTable = LabelStatisticsTable(self.labelArray, self.volumeArrays)
+    with self.profiler.stage('labelAdjacencyGraph'):
+      self.labelAdjacencyGraph = LabelAdjacencyGraph(self.labelArray, self.useFullyConnectedInConnectedComponentFilter)
+    self.labelsChangedByCleanup = set()
+    self.cleanupChangeLog = CleanupChangeLog() if self.changeLogPath else None
+    if self.noDilation:
+      with self.profiler.stage('atlasIslandTable'):
+        self.atlasIslandTable = AtlasIslandTable(self.getLabelMap(),
+                                                 self.useFullyConnectedInConnectedComponentFilter,
+                                                 self.maximumIslandVoxelCount)
+    labelsList = self.getLabelsList(self.getLabelMap())
+    self.numberOfLabels = len(labelsList)
+    numberOfJobs = self.getNumberOfLabelPassJobs()
+    if numberOfJobs > 1 and not self.noDilation:
+      self.cleanupLabelImageInParallel(labelsList, numberOfJobs)
+    else:
+      for label in labelsList:
+        self.relabelCurrentLabel(label)
+        self.numberOfLabelsProcessed += 1
+    self.profiler.setContext()
+
+  def getLabelMap(self):
+    """
+    Returns the atlas being cleaned for AtlasIslandTable and getLabelsList: the
+    RunLengthLabelMap, or an image of the label array.
+    """
+    if isinstance(self.labelArray, RunLengthLabelMap):
+      return self.labelArray
+    return sitk.GetImageFromArray(self.labelArray)
+
+  def getLabelArray(self):
+    """
+    Returns the atlas being cleaned as an Int16 array, decoding the RunLengthLabelMap.
+    """
+    if isinstance(self.labelArray, RunLengthLabelMap):
+      return self.labelArray.toArray()
+    return self.labelArray
+
+  def getNumberOfLabelPassJobs(self):
+    """
+    Returns --jobs limited by the resource budget. A label pass keeps a mask, a distance map and
+    connected component images of the region of its label, about 16 bytes per voxel, or with
+    --outOfCore its copy of the RunLengthLabelMap, its blocks coming out of its share of the
+    memory budget.
+    """
+    if self.numberOfJobs == 1:
+      return 1
+    if self.outOfCore:
+      return self.resourceBudget.getNumberOfWorkers(self.numberOfJobs, self.labelArray.getNumberOfBytes())
+    return self.resourceBudget.getNumberOfWorkers(self.numberOfJobs, 16 * self.labelArray.size)
+
+  def getIslandSizeSchedule(self, labelArray, label):
+    if self.outOfCore:
+      return ChunkedIslandSchedule(self, labelArray, label)
+    return IslandSizeSchedule(self, labelArray, label)
+
+  def cleanupLabelImageInParallel(self, labelsList, numberOfJobs):
+    """
+    Runs the island size sweep of every label ahead of time in a process pool on the input atlas
+    (see parallelIslandCleanup) and replays the labels here in order. A precomputed label pass is
+    only used while it matches the serial run: it is dropped if the label has received voxels
+    from an earlier label, and from the first island size on which an island was (or was not)
+    moved to another label differently than in the precomputed pass.
+    """
+    from parallelIslandCleanup import LabelPassPool
+    labelPassPool = LabelPassPool(self.resourceBudget.getWorkerArguments(self.arguments, numberOfJobs),
+                                  self.labelArray, self.volumeArrays, self.labelStatisticsTable, numberOfJobs)
+    try:
+      labelPasses = labelPassPool.getLabelPasses(labelsList)
+      for label in labelsList:
+        self.profiler.setContext(label)
+        with self.profiler.stage('waitForLabelPass'):
+          speculativeLabelPass = next(labelPasses)
+        if label in self.labelsChangedByCleanup:
+          speculativeLabelPass = None
+        self.relabelCurrentLabel(label, speculativeLabelPass)
+        self.numberOfLabelsProcessed += 1
+    finally:
+      labelPassPool.close()
+
+  def getLabelsList(self, labelImage):
+    if isinstance(labelImage, RunLengthLabelMap):
+      labelsList = labelImage.getLabels()
+    else:
+      labelStatsObject = self.getLabelStatsObject(labelImage, labelImage)
+      labelsList = self.getLabelListFromLabelStatsObject(labelStatsObject)
     if self.excludeLabelsList:
       return self.removeLabelsFromLabelsList(labelsList, self.excludeLabelsList)
     if self.includeLabelsList:
@@ -77,59 +304,151 @@ class DustCleanup():
           labelStats.extend([str(i), str(self.islandStatistics[val][i])])
       print ','.join(labelStats)
 
-  def relabelCurrentLabel(self, labelImage, inputT1VolumeImage, inputT2VolumeImage, label):
+  def writeChangeLog(self):
+    if self.cleanupChangeLog is not None:
+      with self.profiler.stage('writeChangeLog'):
+        self.cleanupChangeLog.write(self.changeLogPath, self.labelArray.shape)
+
+  def checkCancelRequested(self):
+    if self.cancelRequested:
+      raise CleanupCancelled()
+
+  def relabelCurrentLabel(self, label, speculativeLabelPass=None):
+    self.checkCancelRequested()
+    if self.noDilation:
+      return self.relabelCurrentLabelIslands(label)
 
     self.islandStatistics[label] = {'numberOfIslandsCleaned': 0}
+    islandSizeSchedule = None
 
     for currentIslandSize in range(1, self.maximumIslandVoxelCount + 1):
-      maskForCurrentLabel = sitk.BinaryThreshold(labelImage, label, label)
-      relabeledConnectedRegion = self.getRelabeldConnectedRegion(maskForCurrentLabel, currentIslandSize)
-      labelStatsT1WithRelabeledConnectedRegion = self.getLabelStatsObject(inputT1VolumeImage, relabeledConnectedRegion)
-      if inputT2VolumeImage:
-        labelStatsT2WithRelabeledConnectedRegion = self.getLabelStatsObject(inputT2VolumeImage, relabeledConnectedRegion)
-      labelList = self.getLabelListFromLabelStatsObject(labelStatsT1WithRelabeledConnectedRegion)
-      labelList.remove(0)  #remove background label from labelList
-      labelList.reverse()
+      self.profiler.setContext(label, currentIslandSize)
+      if speculativeLabelPass:
+        numberOfIslands, islands, speculativeIslandsMoved = speculativeLabelPass[currentIslandSize - 1]
+      else:
+        with self.profiler.stage('getIslands'):
+          if islandSizeSchedule is None:
+            islandSizeSchedule = self.getIslandSizeSchedule(self.labelArray, label)
+          numberOfIslands, islands = islandSizeSchedule.getIslands(currentIslandSize)
 
       if currentIslandSize == 1: #use island size 1 to get # of islands since this label map is not dilated
-        self.islandStatistics[label]['numberOfIslands'] = len(labelList)
-        self.islandStatistics['Total']['numberOfIslands'] += len(labelList)
-
-      numberOfIslandsCleaned = 0
-
-      for currentLabel in labelList:
-        islandVoxelCount = labelStatsT1WithRelabeledConnectedRegion.GetCount(currentLabel)
-        if islandVoxelCount < currentIslandSize:
-          continue
-        elif islandVoxelCount == currentIslandSize and currentLabel != 1: #stop if you reach largest island
-          meanT1Intensity = labelStatsT1WithRelabeledConnectedRegion.GetMean(currentLabel)
-          if inputT2VolumeImage:
-            meanT2Intensity = labelStatsT2WithRelabeledConnectedRegion.GetMean(currentLabel)
-          else:
-            meanT2Intensity = None
-          targetLabels = self.getTargetLabels(labelImage, relabeledConnectedRegion, inputT1VolumeImage, currentLabel)
-          diffDict = self.calculateLabelIntensityDifferenceValue(meanT1Intensity, meanT2Intensity,
-                                                                 targetLabels, inputT1VolumeImage,
-                                                                 inputT2VolumeImage, labelImage)
-          if self.forceSuspiciousLabelChange:
-            diffDict.pop(label)
-          sortedLabelList = self.getDictKeysListSortedByValue(diffDict)
-          currentLabelBinaryThresholdImage = sitk.BinaryThreshold(relabeledConnectedRegion, currentLabel, currentLabel)
-          labelImage = self.relabelImage(labelImage, currentLabelBinaryThresholdImage, sortedLabelList[0])
-          numberOfIslandsCleaned += 1
-        else:
-          break
+        self.islandStatistics[label]['numberOfIslands'] = numberOfIslands
+        self.islandStatistics['Total']['numberOfIslands'] += numberOfIslands
+
+      for islandIndex, voxelIndices in enumerate(islands):
+        newLabel = self.cleanIsland(voxelIndices, label)
+        if islandSizeSchedule and newLabel != label:
+          islandSizeSchedule.removeIsland(voxelIndices)
+        if speculativeLabelPass and (newLabel != label) != speculativeIslandsMoved[islandIndex]:
+          speculativeLabelPass = None #the islands of the next island sizes have to be recomputed
 
+      numberOfIslandsCleaned = len(islands)
       self.islandStatistics[label][currentIslandSize] = numberOfIslandsCleaned
       self.islandStatistics[label]['numberOfIslandsCleaned'] += numberOfIslandsCleaned
       self.islandStatistics['Total']['numberOfIslandsCleaned'] += numberOfIslandsCleaned
 
-    return labelImage
+  def relabelCurrentLabelIslands(self, label):
+    """
+    Cleans the islands of one label from the atlas island table instead of running connected
+    components for every island size. Without dilation the islands of a label do not depend on
+    the island size, so cleaning all islands except the largest one, smallest first, gives the
+    same result as the island size sweep. A label that has received voxels from an earlier label
+    is scanned again before its islands are cleaned.
+    """
+    self.profiler.setContext(label)
+    if label in self.labelsChangedByCleanup:
+      with self.profiler.stage('atlasIslandTable'):
+        islandTable = AtlasIslandTable(self.getLabelMap(),
+                                       self.useFullyConnectedInConnectedComponentFilter,
+                                       self.maximumIslandVoxelCount, label)
+    else:
+      islandTable = self.atlasIslandTable
+    islands = islandTable.getIslandsForLabel(label)
+
+    self.islandStatistics[label] = {'numberOfIslandsCleaned': 0, 'numberOfIslands': len(islands)}
+    self.islandStatistics['Total']['numberOfIslands'] += len(islands)
+    for currentIslandSize in range(1, self.maximumIslandVoxelCount + 1):
+      self.islandStatistics[label][currentIslandSize] = 0
+
+    for island in reversed(islands[1:]): #the largest island is never cleaned
+      if island.voxelCount > self.maximumIslandVoxelCount:
+        break
+      self.profiler.setContext(label, island.voxelCount)
+      self.cleanIsland(island.voxelIndices, label)
+      self.islandStatistics[label][island.voxelCount] += 1
+      self.islandStatistics[label]['numberOfIslandsCleaned'] += 1
+      self.islandStatistics['Total']['numberOfIslandsCleaned'] += 1
+
+  def cleanIsland(self, voxelIndices, label):
+    """
+    Relabels the island of label given by voxelIndices, an (N, 3) array of (x, y, z) indices, to
+    the bordering label with the closest mean intensities and returns that label.
+    """
+    self.checkCancelRequested()
+    with self.profiler.stage('getVoxelStatistics'):
+      voxelStatistics = self.getVoxelStatistics(voxelIndices)
+    with self.profiler.stage('getIslandBorderingLabels'):
+      islandContacts = self.labelAdjacencyGraph.getIslandBorderingLabels(voxelIndices)
+    newLabel, labelScores = self.selectNewLabel(voxelStatistics, islandContacts, label, self.labelStatisticsTable)
+    if self.cleanupChangeLog is not None:
+      self.cleanupChangeLog.addIsland(label, voxelIndices, newLabel, labelScores)
+    with self.profiler.stage('relabelIsland'):
+      self.labelAdjacencyGraph.relabelIsland(voxelIndices, newLabel, islandContacts)
+      self.labelStatisticsTable.relabelVoxels(label, newLabel, *voxelStatistics)
+    if newLabel != label:
+      self.labelsChangedByCleanup.add(newLabel)
+    return newLabel
+
+  def selectNewLabel(self, voxelStatistics, islandContacts, label, labelStatisticsTable):
+    """
+    Returns the label with the smallest score among the candidate labels of an island of label
+    (see getTargetLabels and getLabelScores), and the scores of all candidates. The --jobs
+    workers score islands with this method too, against their own labelStatisticsTable.
+    """
+    targetLabels = self.getTargetLabels(islandContacts, label)
+    with self.profiler.stage('getLabelScores'):
+      labelScores = self.getLabelScores(voxelStatistics, targetLabels, label, labelStatisticsTable)
+    return self.getDictKeysListSortedByValue(labelScores)[0], labelScores
 
-  def getRelabeldConnectedRegion(self, maskForCurrentLabel, currentIslandSize):
+  def getLabelScores(self, voxelStatistics, targetLabels, label, labelStatisticsTable):
+    """
+    Returns the intensity difference of the island to every candidate label, smallest is best.
+    The mean intensities of the candidate labels are looked up in the running
+    labelStatisticsTable of the current label image.
+    """
+    count, sums, sumsOfSquares = voxelStatistics
+    islandMeans = [total / count for total in sums]
+    diffDict = scoreIslands([islandMeans], [targetLabels], labelStatisticsTable,
+                            self.modalityWeightsList, self.useMahalanobisDistance)[0]
+    if self.forceSuspiciousLabelChange:
+      diffDict.pop(label)
+    return diffDict
+
+  def getVoxelStatistics(self, voxelIndices):
+    """
+    Returns the voxel count and, for each intensity volume, the sum and the sum of squares of
+    the intensity values at voxelIndices.
+    """
+    zyxIndices = (voxelIndices[:, 2], voxelIndices[:, 1], voxelIndices[:, 0])
+    sums = list()
+    sumsOfSquares = list()
+    for volumeArray in self.volumeArrays:
+      values = volumeArray[zyxIndices].astype(np.float64)
+      sums.append(values.sum())
+      sumsOfSquares.append(np.dot(values, values))
+    return len(voxelIndices), sums, sumsOfSquares
+
+  def getRelabeldConnectedRegion(self, maskForCurrentLabel, currentIslandSize, distanceMap):
+    """
+    Returns the islands of the label mask for currentIslandSize: the connected components of the
+    mask dilated with a box kernel whose radius grows with the island size. The dilated mask is
+    distanceMap, the chessboard distance map of the mask, thresholded at that radius.
+    """
     if (currentIslandSize > 1) and (not self.noDilation):
       dilationKernelRadius = self.calcDilationKernelRadius(currentIslandSize)
-      dilatedMaskForCurrentLabel = self.dilateLabelMap(maskForCurrentLabel, dilationKernelRadius)
+      dilatedMaskForCurrentLabel = sitk.GetImageFromArray(
+        np.less_equal(distanceMap, dilationKernelRadius).view(np.uint8))
+      dilatedMaskForCurrentLabel.CopyInformation(maskForCurrentLabel)
       relabeledConnectedLabelMap = self.runConnectedComponentsAndRelabel(dilatedMaskForCurrentLabel)
       return sitk.Mask(relabeledConnectedLabelMap, maskForCurrentLabel, outsideValue=0)
     else:
@@ -140,19 +459,28 @@ class DustCleanup():
     return int(math.ceil(math.pow(currentIslandSize/((4./3.)*math.pi), (1./3.))))
 
   def runConnectedComponentsAndRelabel(self, binaryImage):
-    if not self.useFullyConnectedInConnectedComponentFilter:
-      connectedRegion = sitk.ConnectedComponent(binaryImage, fullyConnected=False)
-    else:
-      connectedRegion = sitk.ConnectedComponent(binaryImage, fullyConnected=True)
-    relabeledConnectedRegion = sitk.RelabelComponent(connectedRegion)
+    with self.profiler.stage('runConnectedComponentsAndRelabel'):
+      if not self.useFullyConnectedInConnectedComponentFilter:
+        connectedRegion = sitk.ConnectedComponent(binaryImage, fullyConnected=False)
+      else:
+        connectedRegion = sitk.ConnectedComponent(binaryImage, fullyConnected=True)
+      relabeledConnectedRegion = sitk.RelabelComponent(connectedRegion)
     return relabeledConnectedRegion
 
   def getLabelStatsObject(self, volumeImage, labelImage):
-    labelStatsObject = sitk.LabelStatisticsImageFilter()
-    labelStatsObject.Execute(volumeImage, labelImage)
+    with self.profiler.stage('getLabelStatsObject'):
+      labelStatsObject = sitk.LabelStatisticsImageFilter()
+      labelStatsObject.Execute(volumeImage, labelImage)
 
     return labelStatsObject
 
+  def getLabelShapeStatsObject(self, labelImage):
+    with self.profiler.stage('getLabelShapeStatsObject'):
+      labelShapeStatsObject = sitk.LabelShapeStatisticsImageFilter()
+      labelShapeStatsObject.Execute(labelImage)
+
+    return labelShapeStatsObject
+
   def getLabelListFromLabelStatsObject(self, labelStatsObject):
     if sitk.Version().MajorVersion() > 0 or sitk.Version().MinorVersion() >= 9:
       compontentLabels = labelStatsObject.GetLabels()
@@ -160,80 +488,17 @@ class DustCleanup():
       compontentLabels = labelStatsObject.GetValidLabels()
     return list(compontentLabels)
 
-  def getTargetLabels(self, labelImage, relabeledConnectedRegion, inputVolumeImage, currentLabel):
-    currentLabelBinaryThresholdImage = sitk.BinaryThreshold(relabeledConnectedRegion, currentLabel, currentLabel)
-    castedCurrentLabelBinaryThresholdImage = sitk.Cast(currentLabelBinaryThresholdImage, sitk.sitkInt16)
-
-    dilatedBinaryLabelMap = self.dilateLabelMap(castedCurrentLabelBinaryThresholdImage, 1)
-    outsideValue = -1
-    reducedLabelMapImage = sitk.Mask(labelImage, dilatedBinaryLabelMap, outsideValue=outsideValue)
-
-    reducedLabelMapT1LabelStats = self.getLabelStatsObject(inputVolumeImage, reducedLabelMapImage)
-    targetLabels = self.getLabelListFromLabelStatsObject(reducedLabelMapT1LabelStats)
-    targetLabels = self.removeOutsideValueFromTargetLabels(targetLabels, outsideValue)
-    return targetLabels
-
-  def removeOutsideValueFromTargetLabels(self, targetLabels, outsideValue):
-    if outsideValue in targetLabels:
-      targetLabels.remove(outsideValue)
-    return targetLabels
-
-  def dilateLabelMap(self, inputLabelImage, kernelRadius):
-    myFilter = sitk.BinaryDilateImageFilter()
-    myFilter.SetBackgroundValue(0.0)
-    myFilter.SetBoundaryToForeground(False)
-    myFilter.SetDebug(False)
-    myFilter.SetForegroundValue(1.0)
-    myFilter.SetKernelRadius((kernelRadius, kernelRadius, kernelRadius))
-    myFilter.SetKernelType(2)  # Kernel Type=Box
-    myFilter.SetNumberOfThreads(8)
-    output = myFilter.Execute(inputLabelImage)
-    castedOutput = sitk.Cast(output, sitk.sitkInt16)
-
-    return castedOutput
-
-  def calculateLabelIntensityDifferenceValue(self, averageT1IntensitySuspiciousLabel,
-                                             averageT2IntensitySuspiciousLabel,
-                                             targetLabels, inputT1VolumeImage,
-                                             inputT2VolumeImage, inputLabelImage):
-    """
-    Calculates a measurement for each label that is on the border of the suspicious label.
-    This value is the square root of the sum of the squared difference in the average T1
-    intensity values and the squared difference in the average T2 intensity values of the
-    two islands in the comparison. The calculated value for each border label will later be
-    sorted in ascending order - meaning that the smallest value has the "closest" average
-    intensity to the suspicious label.
-    """
-
-    squareRootDiffLabelDict = dict()
-    labelStatsT1WithInputLabelImage = self.getLabelStatsObject(inputT1VolumeImage, inputLabelImage)
-    if inputT2VolumeImage:
-      labelStatsT2WithInputLabelImage = self.getLabelStatsObject(inputT2VolumeImage, inputLabelImage)
-
-    for targetLabel in targetLabels:
-      averageT1IntensityTargetLabel = labelStatsT1WithInputLabelImage.GetMean(targetLabel)
-      squareDiffAverageT1 = math.pow(averageT1IntensitySuspiciousLabel -
-                                     averageT1IntensityTargetLabel, 2)
-      if inputT2VolumeImage:
-        averageT2IntensityTargetLabel = labelStatsT2WithInputLabelImage.GetMean(targetLabel)
-        squareDiffAverageT2 = math.pow(averageT2IntensitySuspiciousLabel -
-                                       averageT2IntensityTargetLabel, 2)
-      else:
-        squareDiffAverageT2 = 0
-      squareRootDiff = math.sqrt(squareDiffAverageT1 + squareDiffAverageT2)
-
-      squareRootDiffLabelDict[int(targetLabel)] = squareRootDiff
-
-    return squareRootDiffLabelDict
+  def getTargetLabels(self, islandContacts, label):
+    """
+    Returns the sorted candidate labels of an island: its own label and the labels it touches
+    with the connectivity of the connected component filter.
+    """
+    return sorted(set(islandContacts) | set([label]))
 
   def relabelImage(self, labelImage, newRegion, newLabel):
-    castedLabelImage = sitk.Cast(labelImage, sitk.sitkInt16)
-    castedNewRegion = sitk.Cast(newRegion, sitk.sitkInt16)
-    negatedMask = sitk.BinaryNot(castedNewRegion)
-    negatedImage = sitk.Mask(castedLabelImage, negatedMask)
-    maskTimesNewLabel = sitk.Multiply(castedNewRegion, newLabel)
-    relabeledImage = sitk.Add(negatedImage, maskTimesNewLabel)
-    return relabeledImage
+    labelArray = getLabelArrayFromImage(labelImage)
+    relabelArrayInPlace(labelArray, newLabel, mask=getArrayViewFromImage(newRegion))
+    return getImageFromLabelArray(labelArray, labelImage)
 
   def getDictKeysListSortedByValue(self, val):
     return sorted(val, key=val.get)
@@ -0,0 +1,155 @@
+"""
+Reading and writing of volumes off the critical path of the command-line tools.
+
+BackgroundTask runs a function in a daemon thread, so the input volumes can be read and
+decompressed while the atlas is being prepared, and the output is compressed and written while
+the tool goes on with the next step or the next subject. writeVolume chooses the compression of
+the output file: 'default' writes the file as SimpleITK does without a compression flag, with
+uncompressed data (only a .nii.gz file is gzip compressed, by its extension), 'none' writes
+uncompressed data (a .nii.gz file is then gzip stored without compression) and 'fast' uses gzip
+level 1, writing the gzip encoded NRRD or the .nii.gz file here because SimpleITK does not have
+compression levels. writeVolumeSlabs writes a volume that is not held as an image, like a
+RunLengthLabelMap, to a NRRD file a slab of slices at a time.
+"""
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import SimpleITK as sitk
+import numpy as np
+from memoryMappedVolume import readVolume, MemoryMappedVolume
+
+outputCompressions = ('default', 'none', 'fast')
+
+nrrdTypeNames = {'i1': 'int8', 'u1': 'uint8', 'i2': 'short', 'u2': 'ushort', 'i4': 'int', 'u4': 'uint',
+                 'f4': 'float', 'f8': 'double'}
+
+class BackgroundTask():
+  """
+  Runs function(*arguments) in a daemon thread. getResult waits for it and returns its result or
+  raises the exception it raised, and finishTime is the time at which it returned.
+  """
+
+  def __init__(self, function, *arguments):
+    self.function = function
+    self.arguments = arguments
+    self.result = None
+    self.exceptionInfo = None
+    self.finishTime = None
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    try:
+      self.result = self.function(*self.arguments)
+    except Exception:
+      self.exceptionInfo = sys.exc_info()
+    self.finishTime = time.time()
+
+  def getResult(self):
+    self.thread.join()
+    if self.exceptionInfo is not None:
+      raise self.exceptionInfo[0], self.exceptionInfo[1], self.exceptionInfo[2]
+    return self.result
+
+def readVolumesInBackground(paths):
+  """
+  Starts reading every path of paths (None is skipped) with readVolume, each in its own thread,
+  and returns the list of BackgroundTasks (None for None).
+  """
+  return [BackgroundTask(readVolume, path) if path else None for path in paths]
+
+def getVolumes(readTasks):
+  return [readTask.getResult() if readTask else None for readTask in readTasks]
+
+def writeVolume(image, path, compression='default'):
+  if compression not in outputCompressions:
+    raise ValueError("Unknown output compression %s, use one of %s" % (compression, ', '.join(outputCompressions)))
+  lowerPath = path.lower()
+  if lowerPath.endswith('.nii.gz') and compression != 'default':
+    writeGzipCompressedNifti(image, path, 1 if compression == 'fast' else 0)
+  elif (lowerPath.endswith('.nrrd') and compression == 'fast' and image.GetDimension() == 3 and
+        image.GetNumberOfComponentsPerPixel() == 1):
+    writeGzipEncodedNrrd(image, path, 1)
+  elif compression == 'default':
+    sitk.WriteImage(image, path)
+  else:
+    sitk.WriteImage(image, path, compression == 'fast')
+
+def writeGzipCompressedNifti(image, path, compressionLevel):
+  """
+  Writes image as an uncompressed NIfTI file to a local temporary file and gzip compresses it
+  into path with compressionLevel.
+  """
+  temporaryDirectory = tempfile.mkdtemp(prefix='backgroundVolumeIO')
+  try:
+    niftiPath = os.path.join(temporaryDirectory, 'image.nii')
+    sitk.WriteImage(image, niftiPath, False)
+    with open(niftiPath, 'rb') as niftiFile:
+      gzipFile = gzip.open(path, 'wb', compressionLevel)
+      try:
+        shutil.copyfileobj(niftiFile, gzipFile, 1 << 22)
+      finally:
+        gzipFile.close()
+  finally:
+    shutil.rmtree(temporaryDirectory, ignore_errors=True)
+
+def writeGzipEncodedNrrd(image, path, compressionLevel):
+  """
+  Writes a scalar 3D image as a NRRD file with gzip encoded data, a slab of slices at a time.
+  """
+  writeNrrdSlabs(sitk.GetArrayFromImage(image), (image.GetSpacing(), image.GetOrigin(), image.GetDirection()),
+                 path, compressionLevel)
+
+def writeNrrdSlabs(array, geometry, path, compressionLevel=None):
+  """
+  Writes array, anything indexed (z, y, x) with a shape and a dtype whose slabs of slices are
+  arrays, as a NRRD file with the (spacing, origin, direction) geometry, with gzip encoded data
+  of compressionLevel or raw data if compressionLevel is None.
+  """
+  dataType = np.dtype(array.dtype).newbyteorder('<')
+  spacing, origin, direction = geometry
+  axes = [[direction[row * 3 + column] * spacing[column] for row in range(3)] for column in range(3)]
+  header = ['NRRD0004',
+            'type: %s' % nrrdTypeNames[dataType.str[1:]],
+            'dimension: 3',
+            'space: left-posterior-superior',
+            'sizes: %d %d %d' % tuple(array.shape[::-1]),
+            'space directions: %s' % ' '.join('(%r,%r,%r)' % tuple(axis) for axis in axes),
+            'kinds: domain domain domain',
+            'endian: little',
+            'encoding: %s' % ('raw' if compressionLevel is None else 'gzip'),
+            'space origin: (%r,%r,%r)' % tuple(origin)]
+  with open(path, 'wb') as nrrdFile:
+    nrrdFile.write('\n'.join(header) + '\n\n')
+    if compressionLevel is None:
+      dataFile = nrrdFile
+    else:
+      dataFile = gzip.GzipFile(fileobj=nrrdFile, mode='wb', compresslevel=compressionLevel)
+    try:
+      slabSliceCount = max(1, (1 << 22) // max(1, array.shape[1] * array.shape[2]))
+      for firstSlice in range(0, array.shape[0], slabSliceCount):
+        dataFile.write(np.ascontiguousarray(array[firstSlice:firstSlice + slabSliceCount], dtype=dataType).tostring())
+    finally:
+      if dataFile is not nrrdFile:
+        dataFile.close()
+
+def writeVolumeSlabs(array, geometry, path, compression='default'):
+  """
+  Writes array (see writeNrrdSlabs) to path with the (spacing, origin, direction) geometry. A
+  .nrrd file is written a slab at a time, gzip encoded only with fast compression; any other
+  file is written with writeVolume from the whole array.
+  """
+  if compression not in outputCompressions:
+    raise ValueError("Unknown output compression %s, use one of %s" % (compression, ', '.join(outputCompressions)))
+  if path.lower().endswith('.nrrd'):
+    writeNrrdSlabs(array, geometry, path, {'default': None, 'none': None, 'fast': 1}[compression])
+  else:
+    volume = MemoryMappedVolume(None, *geometry)
+    writeVolume(volume.getImageFromArray(np.asarray(array[:])), path, compression)
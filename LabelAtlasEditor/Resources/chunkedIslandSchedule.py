@@ -0,0 +1,254 @@
+"""
+Out-of-core island size sweep of atlasSmallIslandCleanup.
+
+ChunkedIslandSchedule hands out the same islands as IslandSizeSchedule without holding the mask,
+the distance map and the connected component images of the whole region of a label. The region
+is tiled into blocks. For every block the label mask is decoded from the atlas (a
+RunLengthLabelMap) over the block and a halo of the dilation radius plus one voxel, dilated, and
+labelled with connected components over the block and the one voxel ring around it. The ring
+voxels that belong to an earlier block are then looked up in the outer shell of that block, and
+a union-find pass joins the components of the blocks into the components of the whole region.
+
+A block only keeps the counts and the first voxel of its components, the keys of its ring and
+shell voxels and the voxels of its small islands, so the memory of a label pass is that of one
+block plus the surfaces of the blocks. The results of the blocks are cached for a dilation
+radius and only computed again for the blocks near an island that was moved out of the label.
+The block edge comes from the memory budget of the cleanup (see resourceBudget).
+"""
+
+import math
+
+import SimpleITK as sitk
+import numpy as np
+from islandSizeSchedule import IslandSizeSchedule
+from labelArrayTools import dilateArrayMask, getArrayViewFromImage, getPaddedRegion
+from runLengthLabelMap import getConnectedComponents
+
+# temporaries of a block, per voxel of the block and its halo: the decoded labels, the masks,
+# the dilation, the component image and its copy, and the sorts of the component labels
+bytesPerBlockVoxel = 32
+defaultBlockVoxelCount = 1 << 24
+minimumBlockEdgeLength = 16
+
+def getBlockEdgeLength(memoryBytes, maximumRadius):
+  """
+  Returns the block edge with which one block and its halo take at most a quarter of memoryBytes,
+  or defaultBlockVoxelCount voxels without a memory budget.
+  """
+  if memoryBytes:
+    blockVoxelCount = memoryBytes // 4 // bytesPerBlockVoxel
+  else:
+    blockVoxelCount = defaultBlockVoxelCount
+  return max(minimumBlockEdgeLength, int(blockVoxelCount ** (1. / 3)) - 2 * (maximumRadius + 1))
+
+def getBlockBoundaries(length, blockEdgeLength):
+  """
+  Returns the boundaries of the blocks along an axis of length voxels, with blocks of at most
+  blockEdgeLength voxels and of even sizes, so that no block is much thinner than the others.
+  """
+  numberOfBlocks = max(1, int(math.ceil(float(length) / blockEdgeLength)))
+  return np.linspace(0, length, numberOfBlocks + 1).round().astype(np.int64)
+
+class BlockIslands():
+  """
+  The connected components of the dilated label mask over one block and its one voxel ring.
+  Components are numbered from 0, and for every component the block holds the number of dilated
+  and label voxels it has in the block and the key (z * sizeY + y) * sizeX + x of its first voxel
+  in the block. smallKeys and smallComponents are the label voxels of the components with at most
+  maximumIslandVoxelCount label voxels in the block, shellKeys and shellComponents the dilated
+  voxels of the outer layer of the block, and ringKeys and ringComponents the dilated voxels of
+  the ring that belong to earlier blocks.
+  """
+
+  def __init__(self, numberOfComponents, dilatedVoxelCounts, labelVoxelCounts, firstKeys, smallKeys, smallComponents,
+               shellKeys, shellComponents, ringKeys, ringComponents):
+    self.numberOfComponents = numberOfComponents
+    self.dilatedVoxelCounts = dilatedVoxelCounts
+    self.labelVoxelCounts = labelVoxelCounts
+    self.firstKeys = firstKeys
+    self.smallKeys = smallKeys
+    self.smallComponents = smallComponents
+    self.shellKeys = shellKeys
+    self.shellComponents = shellComponents
+    self.ringKeys = ringKeys
+    self.ringComponents = ringComponents
+
+class ChunkedIslandSchedule(IslandSizeSchedule):
+
+  def __init__(self, cleanup, labelMap, label):
+    self.cleanup = cleanup
+    self.labelMap = labelMap
+    self.label = label
+    self.maximumIslandVoxelCount = cleanup.maximumIslandVoxelCount
+    self.maximumRadius = self.getDilationKernelRadius(self.maximumIslandVoxelCount)
+    boundingBox = labelMap.getLabelBoundingBox(label)
+    self.blockGridShape = None
+    if boundingBox is not None:
+      # the region and the blocks are kept in the (z, y, x) order of the arrays
+      size, index = getPaddedRegion(boundingBox, labelMap.shape[::-1], self.maximumRadius)
+      self.regionLower = np.array(index[::-1])
+      self.regionUpper = self.regionLower + size[::-1]
+      blockEdgeLength = getBlockEdgeLength(cleanup.resourceBudget.memoryBytes, self.maximumRadius)
+      self.blockBoundaries = [self.regionLower[axis] + getBlockBoundaries(size[2 - axis], blockEdgeLength)
+                              for axis in range(3)]
+      self.blockGridShape = tuple(len(boundaries) - 1 for boundaries in self.blockBoundaries)
+    self.removedVoxelIndices = list()
+    self.blockIslands = dict()
+    self.blockIslandsRadius = None
+    self.numberOfIslands = 0
+    self.islandBuckets = None
+    self.bucketIslandSizes = ()
+
+  def hasLabelVoxels(self):
+    return self.blockGridShape is not None
+
+  def getKeys(self, zIndices, yIndices, xIndices):
+    return (zIndices.astype(np.int64) * self.labelMap.shape[1] + yIndices) * self.labelMap.shape[2] + xIndices
+
+  def getBlockBox(self, blockIndex):
+    lower = np.array([self.blockBoundaries[axis][blockIndex[axis]] for axis in range(3)])
+    upper = np.array([self.blockBoundaries[axis][blockIndex[axis] + 1] for axis in range(3)])
+    return lower, upper
+
+  def getBlockMask(self, lower, upper):
+    """
+    Returns the mask of the label from lower to upper, without the voxels of the islands that
+    were moved out of the label.
+    """
+    maskArray = np.equal(self.labelMap[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]], self.label)
+    if self.removedVoxelIndices:
+      zyxIndices = np.concatenate(self.removedVoxelIndices)[:, ::-1]
+      inside = np.all((zyxIndices >= lower) & (zyxIndices < upper), axis=1)
+      removedIndices = zyxIndices[inside] - lower
+      maskArray[removedIndices[:, 0], removedIndices[:, 1], removedIndices[:, 2]] = False
+    return maskArray
+
+  def getBlockIslands(self, blockIndex, radius):
+    lower, upper = self.getBlockBox(blockIndex)
+    ringLower = np.maximum(lower - 1, self.regionLower)
+    ringUpper = np.minimum(upper + 1, self.regionUpper)
+    # the dilation of the ring reaches radius voxels further out
+    maskLower = np.maximum(ringLower - radius, self.regionLower)
+    maskUpper = np.minimum(ringUpper + radius, self.regionUpper)
+    maskArray = self.getBlockMask(maskLower, maskUpper)
+    dilatedMask = maskArray
+    for iteration in range(radius):
+      dilatedMask = dilateArrayMask(dilatedMask)
+    ringSlices = tuple(slice(ringLower[axis] - maskLower[axis], ringUpper[axis] - maskLower[axis]) for axis in range(3))
+    dilatedMask = dilatedMask[ringSlices]
+    maskArray = maskArray[ringSlices]
+    if not dilatedMask.any():
+      return None
+
+    componentImage = sitk.ConnectedComponent(sitk.GetImageFromArray(np.ascontiguousarray(dilatedMask).view(np.uint8)),
+                                             fullyConnected=bool(self.cleanup.useFullyConnectedInConnectedComponentFilter))
+    componentArray = getArrayViewFromImage(componentImage).astype(np.int64) - 1
+    numberOfComponents = int(componentArray.max()) + 1
+    blockSlices = tuple(slice(lower[axis] - ringLower[axis], upper[axis] - ringLower[axis]) for axis in range(3))
+    blockComponents = componentArray[blockSlices]
+    blockMask = maskArray[blockSlices]
+    isDilated = blockComponents >= 0
+
+    dilatedVoxelCounts = np.bincount(blockComponents[isDilated], minlength=numberOfComponents)
+    labelVoxelCounts = np.bincount(blockComponents[blockMask], minlength=numberOfComponents)
+    firstKeys = np.full(numberOfComponents, np.iinfo(np.int64).max, dtype=np.int64)
+    # the first voxel of a component in the block, in scan order, is its first in the volume
+    blockComponentsInScanOrder = blockComponents.ravel()
+    components, firstPositions = np.unique(blockComponentsInScanOrder, return_index=True)
+    firstIndices = np.unravel_index(firstPositions[components >= 0], blockComponents.shape)
+    firstKeys[components[components >= 0]] = self.getKeys(*[firstIndices[axis] + lower[axis] for axis in range(3)])
+
+    isSmall = (labelVoxelCounts > 0) & (labelVoxelCounts <= self.maximumIslandVoxelCount)
+    smallIndices = np.nonzero(blockMask & isSmall[np.maximum(blockComponents, 0)])
+    smallComponents = blockComponents[smallIndices]
+    smallKeys = self.getKeys(*[smallIndices[axis] + lower[axis] for axis in range(3)])
+
+    isShell = np.ones(blockComponents.shape, dtype=bool)
+    isShell[1:-1, 1:-1, 1:-1] = False
+    shellIndices = np.nonzero(isShell & isDilated)
+    shellComponents = blockComponents[shellIndices]
+    shellKeys = self.getKeys(*[shellIndices[axis] + lower[axis] for axis in range(3)])
+
+    isRing = componentArray >= 0
+    isRing[blockSlices] = False
+    ringIndices = [indices + ringLower[axis] for axis, indices in enumerate(np.nonzero(isRing))]
+    ringComponents = componentArray[isRing]
+    # the block of every ring voxel, which joins its component only if it came earlier
+    ringBlockIndices = [np.searchsorted(self.blockBoundaries[axis], ringIndices[axis], 'right') - 1 for axis in range(3)]
+    isEarlier = (np.ravel_multi_index(ringBlockIndices, self.blockGridShape) <
+                 np.ravel_multi_index(blockIndex, self.blockGridShape))
+    ringKeys = self.getKeys(*[indices[isEarlier] for indices in ringIndices])
+    return BlockIslands(numberOfComponents, dilatedVoxelCounts, labelVoxelCounts, firstKeys, smallKeys, smallComponents,
+                        shellKeys, shellComponents, ringKeys, ringComponents[isEarlier])
+
+  def fillIslandBuckets(self, islandSize):
+    """
+    Finds the islands of the region for islandSize block by block and fills the buckets of
+    islandSize and of all larger island sizes that use the same dilation radius. The components
+    are ordered like the output of RelabelComponentImageFilter: by number of dilated voxels, then
+    by first voxel in scan order.
+    """
+    radius = self.getDilationKernelRadius(islandSize)
+    if radius != self.blockIslandsRadius:
+      self.blockIslands = dict()
+      self.blockIslandsRadius = radius
+    for blockIndex in np.ndindex(*self.blockGridShape):
+      if blockIndex not in self.blockIslands:
+        with self.cleanup.profiler.stage('getBlockIslands'):
+          self.blockIslands[blockIndex] = self.getBlockIslands(blockIndex, radius)
+
+    with self.cleanup.profiler.stage('stitchBlockIslands'):
+      blocks = [blockIslands for blockIndex, blockIslands in sorted(self.blockIslands.items())
+                if blockIslands is not None]
+      componentOffsets = np.cumsum([0] + [blockIslands.numberOfComponents for blockIslands in blocks])
+      numberOfComponents = int(componentOffsets[-1])
+
+      def concatenate(name, isComponent=False):
+        arrays = [getattr(blockIslands, name) + (componentOffsets[blockNumber] if isComponent else 0)
+                  for blockNumber, blockIslands in enumerate(blocks)]
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
+
+      shellKeys = concatenate('shellKeys')
+      shellComponents = concatenate('shellComponents', True)
+      shellOrder = np.argsort(shellKeys)
+      ringKeys = concatenate('ringKeys')
+      ringComponents = concatenate('ringComponents', True)
+      shellPositions = np.minimum(np.searchsorted(shellKeys[shellOrder], ringKeys), max(len(shellKeys) - 1, 0))
+      inShell = shellKeys[shellOrder][shellPositions] == ringKeys if len(shellKeys) else np.zeros(0, dtype=bool)
+      roots = getConnectedComponents(numberOfComponents, ringComponents[inShell],
+                                     shellComponents[shellOrder][shellPositions[inShell]])
+
+      dilatedVoxelCounts = np.bincount(roots, weights=concatenate('dilatedVoxelCounts'), minlength=numberOfComponents)
+      labelVoxelCounts = np.bincount(roots, weights=concatenate('labelVoxelCounts'), minlength=numberOfComponents)
+      firstKeys = np.full(numberOfComponents, np.iinfo(np.int64).max, dtype=np.int64)
+      np.minimum.at(firstKeys, roots, concatenate('firstKeys'))
+      islandRoots = np.flatnonzero(dilatedVoxelCounts > 0)
+      islandRoots = islandRoots[np.lexsort((firstKeys[islandRoots], -dilatedVoxelCounts[islandRoots]))]
+
+      smallRoots = roots[concatenate('smallComponents', True)]
+      smallKeys = concatenate('smallKeys')
+      smallOrder = np.lexsort((smallKeys, smallRoots))
+      smallRoots = smallRoots[smallOrder]
+      smallKeys = smallKeys[smallOrder]
+
+    def getVoxelIndices(componentIndex):
+      root = islandRoots[componentIndex]
+      keys = smallKeys[np.searchsorted(smallRoots, root):np.searchsorted(smallRoots, root, 'right')]
+      zIndices, yIndices, xIndices = np.unravel_index(keys, self.labelMap.shape)
+      return np.column_stack((xIndices, yIndices, zIndices))
+    self.fillBuckets([int(labelVoxelCounts[root]) for root in islandRoots], getVoxelIndices)
+
+  def removeIsland(self, voxelIndices):
+    """
+    Removes an island that was moved to another label from the label mask, and drops the blocks
+    whose mask, dilated or not, reaches the island.
+    """
+    self.removedVoxelIndices.append(voxelIndices)
+    self.islandBuckets = None
+    islandLower = voxelIndices.min(axis=0)[::-1]
+    islandUpper = voxelIndices.max(axis=0)[::-1] + 1
+    reach = (self.blockIslandsRadius or 0) + 1
+    for blockIndex in list(self.blockIslands):
+      lower, upper = self.getBlockBox(blockIndex)
+      if np.all(islandLower < upper + reach) and np.all(islandUpper > lower - reach):
+        del self.blockIslands[blockIndex]
@@ -0,0 +1,119 @@
+"""
+Change log of the island decisions of a cleanup, saved as a compressed NPZ file.
+
+The log has one record per island: its source label, island id, voxel count, bounding box (in
+the SimpleITK (x, y, z, sizeX, sizeY, sizeZ) layout), the target label that was chosen, the
+score of every candidate label and the (x, y, z) indices of its voxels. Records of different
+lengths are stored back to back, with an offsets array per list, so the whole log is a handful
+of flat arrays. applyCleanupChangeLog writes the decisions of a log into an atlas in one
+vectorized pass, without computing them again.
+"""
+
+import numpy as np
+
+changeLogVersion = 1
+
+def getOffsets(counts):
+  return np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+
+class CleanupChangeLog():
+
+  def __init__(self):
+    self.sourceLabels = list()
+    self.islandIds = list()
+    self.targetLabels = list()
+    self.islandVoxelIndices = list()
+    self.numberOfCandidates = list()
+    self.candidateLabels = list()
+    self.candidateScores = list()
+
+  def addIsland(self, sourceLabel, voxelIndices, targetLabel, labelScores, islandId=None):
+    """
+    Records that the island of sourceLabel given by voxelIndices was given targetLabel, where
+    labelScores maps every candidate label to its score. Islands are numbered in the order they
+    are added unless islandId is given.
+    """
+    if islandId is None:
+      islandId = len(self.islandIds)
+    self.sourceLabels.append(sourceLabel)
+    self.islandIds.append(islandId)
+    self.targetLabels.append(targetLabel)
+    self.islandVoxelIndices.append(voxelIndices)
+    candidateLabels = sorted(labelScores)
+    self.numberOfCandidates.append(len(candidateLabels))
+    self.candidateLabels.extend(candidateLabels)
+    self.candidateScores.extend(labelScores[candidateLabel] for candidateLabel in candidateLabels)
+
+  def getNumberOfIslands(self):
+    return len(self.islandIds)
+
+  def getArrays(self, shape):
+    """
+    Returns the log as a dictionary of arrays, for an atlas array of the given (z, y, x) shape.
+    """
+    voxelCounts = np.array([len(voxelIndices) for voxelIndices in self.islandVoxelIndices], dtype=np.int32)
+    if self.islandVoxelIndices:
+      voxelIndices = np.concatenate(self.islandVoxelIndices).astype(np.int32)
+    else:
+      voxelIndices = np.zeros((0, 3), dtype=np.int32)
+    voxelOffsets = getOffsets(voxelCounts)
+    if len(voxelCounts):
+      lower = np.minimum.reduceat(voxelIndices, voxelOffsets[:-1], axis=0)
+      upper = np.maximum.reduceat(voxelIndices, voxelOffsets[:-1], axis=0) + 1
+      boundingBoxes = np.hstack((lower, upper - lower))
+    else:
+      boundingBoxes = np.zeros((0, 6), dtype=np.int32)
+    return {'version': np.array(changeLogVersion),
+            'shape': np.array(shape, dtype=np.int64),
+            'sourceLabels': np.array(self.sourceLabels, dtype=np.int16),
+            'islandIds': np.array(self.islandIds, dtype=np.int64),
+            'voxelCounts': voxelCounts,
+            'boundingBoxes': boundingBoxes,
+            'targetLabels': np.array(self.targetLabels, dtype=np.int16),
+            'candidateOffsets': getOffsets(self.numberOfCandidates),
+            'candidateLabels': np.array(self.candidateLabels, dtype=np.int16),
+            'candidateScores': np.array(self.candidateScores, dtype=np.float64),
+            'voxelOffsets': voxelOffsets,
+            'voxelIndices': voxelIndices}
+
+  def write(self, path, shape):
+    np.savez_compressed(path, **self.getArrays(shape))
+
+def readCleanupChangeLog(path):
+  """
+  Returns the arrays of a change log written by CleanupChangeLog.write as a dictionary.
+  """
+  changeLogFile = np.load(path)
+  try:
+    changeLog = dict((name, changeLogFile[name]) for name in changeLogFile.files)
+  finally:
+    changeLogFile.close()
+  if int(changeLog['version']) != changeLogVersion:
+    raise ValueError("Unsupported change log version %d: %s" % (int(changeLog['version']), path))
+  return changeLog
+
+def applyCleanupChangeLog(labelArray, changeLog, excludeIslandIds=None):
+  """
+  Writes the target label of every island of changeLog, except those in excludeIslandIds, into
+  labelArray, in place. A voxel that is in several islands gets the label of the last one, as
+  in the cleanup. Returns the number of islands applied and the number of voxels whose label
+  was not the source label recorded for them, which is zero when labelArray is the atlas the
+  log was made from.
+  """
+  if tuple(changeLog['shape']) != labelArray.shape:
+    raise ValueError("The change log was made for an atlas of size %s, not %s" %
+                     (tuple(changeLog['shape']), labelArray.shape))
+  voxelCounts = changeLog['voxelCounts']
+  isApplied = np.ones(len(voxelCounts), dtype=bool)
+  if excludeIslandIds:
+    isApplied &= ~np.in1d(changeLog['islandIds'], excludeIslandIds)
+  voxelIndices = changeLog['voxelIndices'][np.repeat(isApplied, voxelCounts)]
+  flatIndices = np.ravel_multi_index((voxelIndices[:, 2], voxelIndices[:, 1], voxelIndices[:, 0]), labelArray.shape)
+  sourceLabels = np.repeat(changeLog['sourceLabels'][isApplied], voxelCounts[isApplied])
+  targetLabels = np.repeat(changeLog['targetLabels'][isApplied], voxelCounts[isApplied])
+
+  # the label of a voxel before the replay is only known for the first island it is in
+  firstIndices = np.unique(flatIndices, return_index=True)[1]
+  numberOfMismatchedVoxels = np.count_nonzero(labelArray.take(flatIndices[firstIndices]) != sourceLabels[firstIndices])
+  labelArray.put(flatIndices, targetLabels)
+  return int(np.count_nonzero(isApplied)), numberOfMismatchedVoxels
@@ -0,0 +1,157 @@
+"""
+Per-stage profile of a cleanup run.
+
+The cleanup engines wrap their stages (connected components, dilation, label statistics
+passes, island scoring, relabeling, writing, ...) in CleanupProfiler.stage(name). For every
+stage, label and island size the profiler counts the calls and adds up the wall time and the
+change of the resident memory of the process, an estimate of the memory the stage allocated and
+kept. Stages nest, and the time of a stage includes the stages it calls. The engines set the
+label and the island size being cleaned with setContext.
+
+A hook added with addHook is called after every stage with an event dict with the keys stage,
+label, islandSize, seconds and residentBytes, in the thread that runs the stage. Adding a hook
+turns the profiler on. A disabled profiler costs a method call per stage.
+"""
+
+import collections
+import json
+import os
+import resource
+import sys
+import time
+
+pageSize = resource.getpagesize()
+
+def getResidentBytes():
+  """
+  Returns the resident memory of the process, or its peak where /proc is not available.
+  """
+  try:
+    with open('/proc/self/statm') as statmFile:
+      return int(statmFile.read().split()[1]) * pageSize
+  except (IOError, OSError):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peakRss if sys.platform == 'darwin' else peakRss * 1024
+
+class NullStage():
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, exceptionTraceback):
+    return False
+
+nullStage = NullStage()
+
+class ProfiledStage():
+
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.startResidentBytes = getResidentBytes()
+    self.startTime = time.time()
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, exceptionTraceback):
+    seconds = time.time() - self.startTime
+    self.profiler.record(self.name, seconds, getResidentBytes() - self.startResidentBytes)
+    return False
+
+class CleanupProfiler():
+
+  def __init__(self, isEnabled=False):
+    self.isEnabled = isEnabled
+    self.label = None
+    self.islandSize = None
+    self.records = collections.OrderedDict()
+    self.hooks = list()
+    self.startTime = time.time()
+
+  def addHook(self, hook):
+    self.hooks.append(hook)
+    self.isEnabled = True
+
+  def removeHook(self, hook):
+    self.hooks.remove(hook)
+
+  def setContext(self, label=None, islandSize=None):
+    self.label = label
+    self.islandSize = islandSize
+
+  def stage(self, name):
+    """
+    Returns the context manager that profiles one call of the stage name.
+    """
+    if not self.isEnabled:
+      return nullStage
+    return ProfiledStage(self, name)
+
+  def record(self, name, seconds, residentBytes):
+    label = None if self.label is None else int(self.label)
+    islandSize = None if self.islandSize is None else int(self.islandSize)
+    key = (name, label, islandSize)
+    if key not in self.records:
+      self.records[key] = [0, 0.0, 0]
+    entry = self.records[key]
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] += residentBytes
+    for hook in self.hooks:
+      hook({'stage': name, 'label': label, 'islandSize': islandSize, 'seconds': seconds,
+            'residentBytes': residentBytes})
+
+  def getTotals(self, keyIndex):
+    """
+    Returns the calls, seconds and resident bytes summed by stage (keyIndex 0), by label (1) or
+    by island size (2), in the order they were first recorded.
+    """
+    totals = collections.OrderedDict()
+    for key, (calls, seconds, residentBytes) in self.records.items():
+      if key[keyIndex] is None and keyIndex > 0:
+        continue
+      total = totals.setdefault(key[keyIndex], [0, 0.0, 0])
+      total[0] += calls
+      total[1] += seconds
+      total[2] += residentBytes
+    return totals
+
+  def getProfile(self):
+    """
+    Returns the profile as a dict that can be written as JSON.
+    """
+    return {'totalSeconds': time.time() - self.startTime,
+            'stages': [{'stage': name, 'calls': calls, 'seconds': seconds, 'residentBytes': residentBytes}
+                       for name, (calls, seconds, residentBytes) in self.getTotals(0).items()],
+            'records': [{'stage': name, 'label': label, 'islandSize': islandSize, 'calls': calls,
+                         'seconds': seconds, 'residentBytes': residentBytes}
+                        for (name, label, islandSize), (calls, seconds, residentBytes) in self.records.items()]}
+
+  def writeProfile(self, profilePath):
+    with open(profilePath, 'w') as profileFile:
+      json.dump(self.getProfile(), profileFile, indent=2)
+
+  def printSummary(self):
+    totalSeconds = time.time() - self.startTime
+    print "-"*50
+    print "Stage, Calls, Seconds, PercentOfTotal, ResidentMegabytes"
+    for name, (calls, seconds, residentBytes) in sorted(self.getTotals(0).items(), key=lambda item: -item[1][1]):
+      print '%s,%d,%.3f,%.1f,%.1f' % (name, calls, seconds, 100.0 * seconds / max(totalSeconds, 1e-9),
+                                      residentBytes / 1048576.0)
+    print "IslandSize, Calls, Seconds"
+    for islandSize, (calls, seconds, residentBytes) in sorted(self.getTotals(2).items()):
+      print '%d,%d,%.3f' % (islandSize, calls, seconds)
+    print 'Total seconds: %.3f' % totalSeconds
+
+  def report(self, profilePath):
+    """
+    Prints the summary table and writes the JSON profile to profilePath, if the profiler is on.
+    """
+    if not self.isEnabled:
+      return
+    self.printSummary()
+    if profilePath:
+      self.writeProfile(profilePath)
+      print 'Profile written to', os.path.abspath(profilePath)
@@ -0,0 +1,55 @@
+"""
+Scoring of islands against their candidate labels for any number of intensity volumes.
+
+An island is compared with a candidate label through the mean intensities of both in every
+modality volume (T1, T2, FLAIR, PD, posteriors, ...): the score is the square root of the sum
+over the modalities of the squared differences of the means, so the smallest score is the
+"closest" label. With weights the squared difference of each modality is multiplied by its
+weight, and with the Mahalanobis distance it is divided by the variance of the candidate label
+in that modality. The label means and variances are looked up in a LabelStatisticsTable, and
+all islands are scored against all of their candidates in one array operation on an
+(islands x candidates x modalities) array.
+"""
+
+import numpy as np
+
+def getIslandScores(islandMeans, labelMeans, labelVariances=None, weights=None, minimumVariance=1.0):
+  """
+  Returns the (I, C) scores of I islands against C candidates each, from the (I, M) means of the
+  islands and the (I, C, M) means of the candidates in M modalities. Variances below
+  minimumVariance, like those of labels with a single voxel, are raised to it.
+  """
+  differences = islandMeans[:, np.newaxis, :] - labelMeans
+  squaredDifferences = differences * differences
+  if labelVariances is not None:
+    squaredDifferences /= np.maximum(labelVariances, minimumVariance)
+  if weights is not None:
+    squaredDifferences *= weights
+  return np.sqrt(squaredDifferences.sum(axis=2))
+
+def scoreIslands(islandMeans, candidateLabelLists, labelStatisticsTable, weights=None, useMahalanobisDistance=False):
+  """
+  Scores every island, given by its list of mean intensities (one per volume of
+  labelStatisticsTable), against its list of candidate labels and returns a dict of the score
+  of each candidate label per island.
+  """
+  numberOfIslands = len(candidateLabelLists)
+  labels = sorted(set(label for candidateLabels in candidateLabelLists for label in candidateLabels))
+  if not labels:
+    return [dict() for candidateLabels in candidateLabelLists]
+  islandMeans = np.array(islandMeans, dtype=np.float64).reshape(numberOfIslands, -1)
+  if weights is not None:
+    weights = np.array(weights, dtype=np.float64)
+    if len(weights) != islandMeans.shape[1]:
+      raise ValueError("%d modality weights were given for %d volumes" % (len(weights), islandMeans.shape[1]))
+
+  # the candidates of every island are padded to the same length with the first label
+  labelMeans, labelVariances = labelStatisticsTable.getMoments(labels)
+  candidateIndices = np.zeros((numberOfIslands, max(len(candidateLabels) for candidateLabels in candidateLabelLists)),
+                              dtype=np.intp)
+  for islandIndex, candidateLabels in enumerate(candidateLabelLists):
+    candidateIndices[islandIndex, :len(candidateLabels)] = np.searchsorted(labels, candidateLabels)
+  scores = getIslandScores(islandMeans, labelMeans[candidateIndices],
+                           labelVariances[candidateIndices] if useMahalanobisDistance else None, weights)
+  return [dict((int(label), float(score)) for label, score in zip(candidateLabels, scores[islandIndex]))
+          for islandIndex, candidateLabels in enumerate(candidateLabelLists)]
@@ -0,0 +1,141 @@
+"""
+Size-bucketed scheduling of the island size sweep of atlasSmallIslandCleanup.
+
+The sweep looks for the islands of one label with exactly 1, 2, ... maximumIslandVoxelCount
+voxels, where the islands of a size are the connected components of the label mask after a
+dilation whose radius grows with the island size. The radius only changes a few times over the
+whole sweep, so IslandSizeSchedule runs the connected components once for all the island sizes
+that share a radius, sorts the islands into one bucket per size and hands the buckets out
+smallest size first. The buckets are only recomputed when islands have been moved out of the
+label, and only inside the bounding box of the label.
+
+The dilated masks are not computed with a dilation per radius: the chessboard distance map of
+the label mask, up to the largest radius, is computed once per label and thresholded at the
+radius, which gives the mask dilated with a box kernel of that radius. When an island is moved
+out of the label, the distance map is only computed again around the island.
+"""
+
+import SimpleITK as sitk
+import numpy as np
+from atlasIslandTable import getIslandVoxelIndices
+from labelArrayTools import (relabelArrayInPlace, getPaddedRegion, getArrayRegion, getMaskBoundingBox,
+                             getBoundingBox, getChessboardDistanceMap)
+from runLengthLabelMap import RunLengthLabelMap
+
+class IslandSizeSchedule():
+
+  def __init__(self, cleanup, labelArray, label):
+    self.cleanup = cleanup
+    self.maximumIslandVoxelCount = cleanup.maximumIslandVoxelCount
+    # the dilated label mask never reaches further than the largest dilation radius
+    self.maximumRadius = self.getDilationKernelRadius(self.maximumIslandVoxelCount)
+    if isinstance(labelArray, RunLengthLabelMap):
+      self.maskArray, self.regionIndex = labelArray.getLabelMaskRegion(label, self.maximumRadius)
+    else:
+      self.maskArray, self.regionIndex = self.getLabelMaskRegion(labelArray, label)
+    self.distanceMap = None
+    self.numberOfIslands = 0
+    self.islandBuckets = None
+    self.bucketIslandSizes = ()
+
+  def getLabelMaskRegion(self, labelArray, label):
+    """
+    Returns the uint8 mask of label inside its bounding box padded by the largest radius, and
+    the (x, y, z) index of that region, or None and [0, 0, 0] if the label has no voxel.
+    """
+    labelMask = np.equal(labelArray, label)
+    if not labelMask.any():
+      return None, [0, 0, 0]
+    size, regionIndex = getPaddedRegion(getMaskBoundingBox(labelMask), labelArray.shape[::-1], self.maximumRadius)
+    return getArrayRegion(labelMask, size, regionIndex).astype(np.uint8), regionIndex
+
+  def getDilationKernelRadius(self, islandSize):
+    if islandSize == 1:
+      return 0
+    return self.cleanup.calcDilationKernelRadius(islandSize)
+
+  def getIslands(self, islandSize):
+    """
+    Returns the number of islands of the label and the voxel indices of the islands that are
+    cleaned for islandSize, smallest component number last.
+    """
+    if not self.hasLabelVoxels():
+      return 0, list()
+    if self.islandBuckets is None or islandSize not in self.bucketIslandSizes:
+      self.bucketIslandSizes = self.getBucketIslandSizes(islandSize)
+      self.fillIslandBuckets(islandSize)
+    return self.numberOfIslands, self.islandBuckets.get(islandSize, list())
+
+  def hasLabelVoxels(self):
+    return self.maskArray is not None
+
+  def getBucketIslandSizes(self, islandSize):
+    radius = self.getDilationKernelRadius(islandSize)
+    return [size for size in range(islandSize, self.maximumIslandVoxelCount + 1)
+            if self.getDilationKernelRadius(size) == radius]
+
+  def fillIslandBuckets(self, islandSize):
+    """
+    Runs the connected components for islandSize and fills the buckets of islandSize and of all
+    larger island sizes that use the same dilation radius.
+    """
+    radius = self.getDilationKernelRadius(islandSize)
+    if self.distanceMap is None and radius > 0:
+      with self.cleanup.profiler.stage('getChessboardDistanceMap'):
+        self.distanceMap = getChessboardDistanceMap(self.maskArray, self.maximumRadius)
+    maskImage = sitk.GetImageFromArray(self.maskArray)
+    relabeledConnectedRegion = self.cleanup.getRelabeldConnectedRegion(maskImage, islandSize, self.distanceMap)
+    islandShapeStats = self.cleanup.getLabelShapeStatsObject(relabeledConnectedRegion)
+    componentLabels = sorted(islandShapeStats.GetLabels())
+
+    def getVoxelIndices(componentIndex):
+      componentLabel = componentLabels[componentIndex]
+      return getIslandVoxelIndices(relabeledConnectedRegion, componentLabel,
+                                   islandShapeStats.GetBoundingBox(componentLabel)) + np.array(self.regionIndex)
+    self.fillBuckets([islandShapeStats.GetNumberOfPixels(componentLabel) for componentLabel in componentLabels],
+                     getVoxelIndices)
+
+  def fillBuckets(self, islandVoxelCounts, getVoxelIndices):
+    """
+    Fills the buckets of bucketIslandSizes from the voxel counts of the islands in component
+    order (the largest dilated component first), where getVoxelIndices(componentIndex) returns
+    the voxel indices of an island. An island goes into the bucket of its size unless it is the
+    largest island or comes after a larger island when the components are visited from the last
+    one down, where the sweep has always stopped.
+    """
+    self.numberOfIslands = len(islandVoxelCounts)
+    self.islandBuckets = dict()
+    largestIslandVoxelCount = 0
+    for componentIndex in reversed(range(len(islandVoxelCounts))):
+      islandVoxelCount = islandVoxelCounts[componentIndex]
+      if islandVoxelCount > self.bucketIslandSizes[-1]:
+        break
+      if islandVoxelCount >= largestIslandVoxelCount and componentIndex != 0 and islandVoxelCount in self.bucketIslandSizes:
+        self.islandBuckets.setdefault(islandVoxelCount, list()).append(getVoxelIndices(componentIndex))
+      largestIslandVoxelCount = max(largestIslandVoxelCount, islandVoxelCount)
+
+  def removeIsland(self, voxelIndices):
+    """
+    Removes an island that was moved to another label from the label mask. The islands of the
+    following island sizes are then found again.
+    """
+    regionVoxelIndices = voxelIndices - np.array(self.regionIndex)
+    relabelArrayInPlace(self.maskArray, 0, voxelIndices=regionVoxelIndices)
+    self.islandBuckets = None
+    if self.distanceMap is not None:
+      self.updateDistanceMap(regionVoxelIndices)
+
+  def updateDistanceMap(self, regionVoxelIndices):
+    """
+    Computes the distance map again within the largest radius of a removed island, from the
+    label mask within twice that radius, which holds every voxel those distances depend on.
+    """
+    boundingBox = getBoundingBox(regionVoxelIndices)
+    maskSize = self.maskArray.shape[::-1]
+    size, index = getPaddedRegion(boundingBox, maskSize, self.maximumRadius)
+    outerSize, outerIndex = getPaddedRegion(boundingBox, maskSize, 2 * self.maximumRadius)
+    with self.cleanup.profiler.stage('updateChessboardDistanceMap'):
+      distanceMap = getChessboardDistanceMap(getArrayRegion(self.maskArray, outerSize, outerIndex),
+                                             self.maximumRadius)
+      innerIndex = [index[i] - outerIndex[i] for i in range(3)]
+      getArrayRegion(self.distanceMap, size, index)[...] = getArrayRegion(distanceMap, size, innerIndex)
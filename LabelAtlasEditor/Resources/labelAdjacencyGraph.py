@@ -0,0 +1,119 @@
+"""
+Label adjacency graph of an atlas.
+
+Two voxels are in contact if they are neighbours, either through a face (6-connectivity) or
+through a face, an edge or a corner (26-connectivity, fullyConnected). The graph counts the
+contacts between the voxels of every pair of different labels, is built once from the label
+array and is kept up to date as islands are moved from one label to another.
+"""
+
+import itertools
+
+import numpy as np
+from labelArrayTools import relabelArrayInPlace, getPaddedRegion, getArrayRegion, getBoundingBox
+from runLengthLabelMap import RunLengthLabelMap
+
+def getNeighbourOffsets(fullyConnected):
+  """
+  Returns the (x, y, z) offsets of the neighbours of a voxel.
+  """
+  offsets = [offset for offset in itertools.product((-1, 0, 1), repeat=3) if offset != (0, 0, 0)]
+  if not fullyConnected:
+    offsets = [offset for offset in offsets if sum(abs(value) for value in offset) == 1]
+  return offsets
+
+def getIslandContacts(labelArray, voxelIndices, fullyConnected):
+  """
+  Returns a dict with the number of contacts between the island given by voxelIndices, an
+  (N, 3) array of (x, y, z) indices, and each label bordering it. Only the region of interest
+  around the island is looked at.
+  """
+  size, index = getPaddedRegion(getBoundingBox(voxelIndices), labelArray.shape[::-1], 1)
+  labelArrayRegion = getArrayRegion(labelArray, size, index)
+  regionVoxelIndices = voxelIndices - np.array(index)
+  islandMask = np.zeros(labelArrayRegion.shape, dtype=bool)
+  islandMask[regionVoxelIndices[:, 2], regionVoxelIndices[:, 1], regionVoxelIndices[:, 0]] = True
+
+  neighbourLabels = list()
+  for offset in getNeighbourOffsets(fullyConnected):
+    neighbourIndices = regionVoxelIndices + np.array(offset)
+    insideRegion = np.all((neighbourIndices >= 0) & (neighbourIndices < np.array(size)), axis=1)
+    x, y, z = neighbourIndices[insideRegion].T
+    outsideIsland = ~islandMask[z, y, x]
+    neighbourLabels.append(labelArrayRegion[z[outsideIsland], y[outsideIsland], x[outsideIsland]])
+  labels, counts = np.unique(np.concatenate(neighbourLabels), return_counts=True)
+  return dict((int(label), int(count)) for label, count in zip(labels, counts))
+
+def getContactCounts(labelArray, fullyConnected):
+  """
+  Yields (firstLabel, secondLabel, count) with the number of contacts between two different
+  labels along every neighbour offset, every pair of neighbours counted once.
+  """
+  minimumLabel = int(labelArray.min())
+  numberOfBins = int(labelArray.max()) - minimumLabel + 1
+  for offset in getNeighbourOffsets(fullyConnected):
+    if offset <= (0, 0, 0):
+      continue #every pair of neighbours is counted once
+    lowerSlices = tuple(slice(max(-value, 0), labelArray.shape[axis] - max(value, 0))
+                        for axis, value in enumerate(offset[::-1]))
+    upperSlices = tuple(slice(max(value, 0), labelArray.shape[axis] - max(-value, 0))
+                        for axis, value in enumerate(offset[::-1]))
+    lowerLabels = labelArray[lowerSlices]
+    upperLabels = labelArray[upperSlices]
+    different = lowerLabels != upperLabels
+    pairBins = ((lowerLabels[different].astype(np.int64) - minimumLabel) * numberOfBins +
+                upperLabels[different].astype(np.int64) - minimumLabel)
+    pairBins, counts = np.unique(pairBins, return_counts=True)
+    for pairBin, count in zip(pairBins, counts):
+      yield int(pairBin) // numberOfBins + minimumLabel, int(pairBin) % numberOfBins + minimumLabel, int(count)
+
+class LabelAdjacencyGraph():
+  """
+  labelArray can also be a RunLengthLabelMap, whose contacts are counted on its runs (see
+  RunLengthLabelMap.getContactCounts).
+  """
+
+  def __init__(self, labelArray, fullyConnected=False):
+    self.labelArray = labelArray
+    self.fullyConnected = fullyConnected
+    self.contacts = dict()
+    if isinstance(labelArray, RunLengthLabelMap):
+      contactCounts = labelArray.getContactCounts(fullyConnected)
+    else:
+      contactCounts = getContactCounts(labelArray, fullyConnected)
+    for firstLabel, secondLabel, count in contactCounts:
+      self.addContacts(firstLabel, secondLabel, count)
+
+  def addContacts(self, firstLabel, secondLabel, count):
+    for label, otherLabel in ((firstLabel, secondLabel), (secondLabel, firstLabel)):
+      labelContacts = self.contacts.setdefault(label, dict())
+      labelContacts[otherLabel] = labelContacts.get(otherLabel, 0) + count
+      if labelContacts[otherLabel] == 0:
+        del labelContacts[otherLabel]
+
+  def getBorderingLabels(self, label):
+    """
+    Returns a dict with the number of contacts between label and each label bordering it.
+    """
+    return dict(self.contacts.get(label, dict()))
+
+  def getIslandBorderingLabels(self, voxelIndices):
+    return getIslandContacts(self.labelArray, voxelIndices, self.fullyConnected)
+
+  def relabelIsland(self, voxelIndices, newLabel, islandContacts=None):
+    """
+    Moves the island given by voxelIndices to newLabel in the label array and in the graph.
+    islandContacts are the bordering labels of the island if they are already known.
+    """
+    x, y, z = voxelIndices[0]
+    oldLabel = int(self.labelArray[z, y, x])
+    if oldLabel == newLabel:
+      return
+    if islandContacts is None:
+      islandContacts = self.getIslandBorderingLabels(voxelIndices)
+    for label, count in islandContacts.items():
+      if label != oldLabel:
+        self.addContacts(oldLabel, label, -count)
+      if label != newLabel:
+        self.addContacts(newLabel, label, count)
+    relabelArrayInPlace(self.labelArray, newLabel, voxelIndices=voxelIndices)
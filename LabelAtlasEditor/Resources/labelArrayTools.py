@@ -0,0 +1,144 @@
+"""
+NumPy helpers for working on a label map as a persistent array.
+
+Arrays are indexed (z, y, x) as returned by sitk.GetArrayFromImage, while voxel index lists are
+(N, 3) arrays of SimpleITK (x, y, z) indices.
+"""
+
+import SimpleITK as sitk
+import numpy as np
+
+def relabelArrayInPlace(labelArray, newLabel, mask=None, voxelIndices=None):
+  """
+  Writes newLabel into labelArray, in place, at the nonzero voxels of mask (an array with the
+  shape of labelArray) or at voxelIndices. No full-volume temporary is allocated.
+  """
+  if mask is not None:
+    np.putmask(labelArray, mask, newLabel)
+  else:
+    labelArray[voxelIndices[:, 2], voxelIndices[:, 1], voxelIndices[:, 0]] = newLabel
+
+def getArrayViewFromImage(image):
+  """
+  Returns a read-only array that shares the buffer of image, or a copy for SimpleITK versions
+  without GetArrayViewFromImage. The image must be kept alive while the array is used.
+  """
+  if hasattr(sitk, 'GetArrayViewFromImage'):
+    return sitk.GetArrayViewFromImage(image)
+  return sitk.GetArrayFromImage(image)
+
+def getLabelArrayFromImage(labelImage):
+  return sitk.GetArrayFromImage(sitk.Cast(labelImage, sitk.sitkInt16))
+
+def getImageFromLabelArray(labelArray, referenceImage):
+  labelImage = sitk.GetImageFromArray(labelArray)
+  labelImage.CopyInformation(referenceImage)
+  return labelImage
+
+def getPaddedRegion(boundingBox, imageSize, padding):
+  """
+  Returns the (size, index) of boundingBox, in the SimpleITK (x, y, z, sizeX, sizeY, sizeZ)
+  layout, padded by padding voxels on every side and clipped to imageSize.
+  """
+  dimension = len(imageSize)
+  lower = [max(boundingBox[i] - padding, 0) for i in range(dimension)]
+  upper = [min(boundingBox[i] + boundingBox[dimension + i] + padding, imageSize[i]) for i in range(dimension)]
+  size = [upper[i] - lower[i] for i in range(dimension)]
+  return size, lower
+
+def getArrayRegion(array, size, index):
+  return array[index[2]:index[2] + size[2], index[1]:index[1] + size[1], index[0]:index[0] + size[0]]
+
+def dilateArrayMask(mask):
+  """
+  Dilates a boolean array with a box kernel of radius 1, like a BinaryDilateImageFilter with a
+  box kernel of radius 1, by dilating along one axis at a time.
+  """
+  dilatedMask = mask
+  for axis in range(mask.ndim):
+    lower = [slice(None)] * mask.ndim
+    upper = [slice(None)] * mask.ndim
+    lower[axis] = slice(None, -1)
+    upper[axis] = slice(1, None)
+    axisDilatedMask = dilatedMask.copy()
+    axisDilatedMask[tuple(lower)] |= dilatedMask[tuple(upper)]
+    axisDilatedMask[tuple(upper)] |= dilatedMask[tuple(lower)]
+    dilatedMask = axisDilatedMask
+  return dilatedMask
+
+def getChessboardDistanceMap(mask, maximumDistance):
+  """
+  Returns the uint8 array of the chessboard distance of every voxel to the nonzero voxels of
+  mask, up to maximumDistance; voxels that are further get maximumDistance + 1. The voxels within
+  distance r are those of mask dilated with a box kernel of radius r.
+  """
+  distanceMap = np.full(mask.shape, maximumDistance + 1, dtype=np.uint8)
+  dilatedMask = mask.astype(bool)
+  distanceMap[dilatedMask] = 0
+  for distance in range(1, maximumDistance + 1):
+    nextDilatedMask = dilateArrayMask(dilatedMask)
+    distanceMap[nextDilatedMask & ~dilatedMask] = distance
+    dilatedMask = nextDilatedMask
+  return distanceMap
+
+def getTargetLabelsForIsland(labelArray, voxelIndices):
+  """
+  Returns the sorted labels of labelArray inside the island given by voxelIndices dilated by one
+  voxel (the island's own label included), looking only at a region of interest around it.
+  """
+  size, index = getPaddedRegion(getBoundingBox(voxelIndices), labelArray.shape[::-1], 1)
+  labelArrayRegion = getArrayRegion(labelArray, size, index)
+  islandMask = np.zeros(labelArrayRegion.shape, dtype=bool)
+  regionVoxelIndices = voxelIndices - np.array(index)
+  islandMask[regionVoxelIndices[:, 2], regionVoxelIndices[:, 1], regionVoxelIndices[:, 0]] = True
+  dilatedIslandMask = dilateArrayMask(islandMask)
+  return [int(targetLabel) for targetLabel in np.unique(labelArrayRegion[dilatedIslandMask])]
+
+def getMaskBoundingBox(mask):
+  """
+  Returns the bounding box of the nonzero voxels of mask, which must have some, in the SimpleITK
+  (x, y, z, sizeX, sizeY, sizeZ) layout.
+  """
+  lower = list()
+  size = list()
+  for otherAxes in ((0, 1), (0, 2), (1, 2)): #the array axes are (z, y, x)
+    voxels = np.flatnonzero(mask.any(axis=otherAxes))
+    lower.append(int(voxels[0]))
+    size.append(int(voxels[-1] - voxels[0] + 1))
+  return tuple(lower + size)
+
+def getBoundingBox(voxelIndices):
+  lower = voxelIndices.min(axis=0)
+  upper = voxelIndices.max(axis=0) + 1
+  return tuple(int(value) for value in lower) + tuple(int(value) for value in upper - lower)
+
+def getSeedIslandVoxelIndices(labelArray, seed, fullyConnected=True, radius=16):
+  """
+  Returns the (N, 3) array of (x, y, z) indices of the island of labelArray that holds seed, an
+  (x, y, z) index. The island is flood filled inside a box of radius voxels around the seed, and
+  the box is doubled until the island no longer reaches a side of the box inside the volume.
+  """
+  x, y, z = seed
+  label = labelArray[z, y, x]
+  imageSize = labelArray.shape[::-1]
+  connectedThreshold = sitk.ConnectedThresholdImageFilter()
+  connectedThreshold.SetConnectivity(1 if fullyConnected else 0)
+  connectedThreshold.SetLower(1)
+  connectedThreshold.SetUpper(1)
+  connectedThreshold.SetReplaceValue(1)
+  while True:
+    size, index = getPaddedRegion(tuple(seed) + (1, 1, 1), imageSize, radius)
+    labelMask = np.equal(getArrayRegion(labelArray, size, index), label).astype(np.uint8)
+    connectedThreshold.SetSeedList([[int(seed[axis] - index[axis]) for axis in range(3)]])
+    islandImage = connectedThreshold.Execute(sitk.GetImageFromArray(labelMask))
+    islandArray = getArrayViewFromImage(islandImage)
+    reachesBox = False
+    for axis in range(3):
+      arrayAxis = 2 - axis
+      if index[axis] > 0 and islandArray.take(0, axis=arrayAxis).any():
+        reachesBox = True
+      if index[axis] + size[axis] < imageSize[axis] and islandArray.take(-1, axis=arrayAxis).any():
+        reachesBox = True
+    if not reachesBox:
+      return np.argwhere(islandArray)[:, ::-1] + np.array(index)
+    radius *= 2
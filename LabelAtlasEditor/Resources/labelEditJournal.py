@@ -0,0 +1,132 @@
+"""
+Undo and redo of label map edits, stored as compressed sparse voxel diffs.
+
+A LabelEdit holds the flat indices of the voxels changed by one operation together with their
+old and new labels. The indices are sorted and stored as zlib compressed differences, and the
+labels as zlib compressed arrays, so an edit needs memory in proportion to the number of voxels
+it changed rather than to the size of the atlas. LabelEditJournal keeps the edits that can be
+undone and redone, dropping the oldest ones when they need more than maximumBytes, and can
+replay its edits onto another copy of the atlas.
+"""
+
+import zlib
+
+import numpy as np
+
+def compressArray(array):
+  return zlib.compress(np.ascontiguousarray(array).tostring(), 1)
+
+def decompressArray(data, dtype):
+  return np.frombuffer(zlib.decompress(data), dtype=dtype)
+
+def getArrayDiff(oldArray, newArray):
+  """
+  Returns the flat indices of the voxels whose labels differ between two arrays of the same
+  shape, with their labels in oldArray and in newArray.
+  """
+  flatIndices = np.flatnonzero(np.not_equal(oldArray, newArray))
+  return flatIndices, oldArray.take(flatIndices), newArray.take(flatIndices)
+
+class LabelEdit():
+
+  def __init__(self, description, nodeID, shape, flatIndices, oldLabels, newLabels):
+    self.description = description
+    self.nodeID = nodeID
+    self.shape = tuple(shape)
+    self.numberOfVoxels = len(flatIndices)
+    self.labelType = np.asarray(oldLabels).dtype
+    # a stable sort keeps the order of voxels that were changed more than once
+    order = np.argsort(flatIndices, kind='mergesort')
+    sortedIndices = np.asarray(flatIndices, dtype=np.int64)[order]
+    self.flatIndexDifferences = compressArray(np.diff(np.concatenate(([0], sortedIndices))))
+    self.oldLabels = compressArray(np.asarray(oldLabels)[order])
+    self.newLabels = compressArray(np.asarray(newLabels, dtype=self.labelType)[order])
+    self.numberOfBytes = len(self.flatIndexDifferences) + len(self.oldLabels) + len(self.newLabels)
+
+  def getFlatIndices(self):
+    return np.cumsum(decompressArray(self.flatIndexDifferences, np.int64))
+
+  def getOldLabels(self):
+    return decompressArray(self.oldLabels, self.labelType)
+
+  def getNewLabels(self):
+    return decompressArray(self.newLabels, self.labelType)
+
+  def checkShape(self, labelArray):
+    if labelArray.shape != self.shape:
+      raise ValueError("The edit '%s' was made on a label map of size %s, not %s" %
+                       (self.description, self.shape, labelArray.shape))
+
+  def redo(self, labelArray):
+    """
+    Writes the new labels into labelArray, in place.
+    """
+    self.checkShape(labelArray)
+    labelArray.put(self.getFlatIndices(), self.getNewLabels())
+
+  def undo(self, labelArray):
+    """
+    Writes the old labels back into labelArray, in place. A voxel changed more than once gets
+    the label it had before the first change.
+    """
+    self.checkShape(labelArray)
+    labelArray.put(self.getFlatIndices()[::-1], self.getOldLabels()[::-1])
+
+class LabelEditJournal():
+
+  def __init__(self, maximumBytes):
+    self.maximumBytes = maximumBytes
+    self.undoEdits = list()
+    self.redoEdits = list()
+
+  def getNumberOfBytes(self):
+    return sum(edit.numberOfBytes for edit in self.undoEdits + self.redoEdits)
+
+  def record(self, edit):
+    """
+    Adds an edit that was just made. The edits that were undone can no longer be redone.
+    """
+    if edit.numberOfVoxels == 0:
+      return
+    self.undoEdits.append(edit)
+    self.redoEdits = list()
+    while len(self.undoEdits) > 1 and self.getNumberOfBytes() > self.maximumBytes:
+      self.undoEdits.pop(0)
+
+  def canUndo(self):
+    return len(self.undoEdits) > 0
+
+  def canRedo(self):
+    return len(self.redoEdits) > 0
+
+  def undo(self):
+    """
+    Returns the last edit, which the caller undoes on the label map of edit.nodeID.
+    """
+    edit = self.undoEdits.pop()
+    self.redoEdits.append(edit)
+    return edit
+
+  def redo(self):
+    """
+    Returns the last undone edit, which the caller redoes on the label map of edit.nodeID.
+    """
+    edit = self.redoEdits.pop()
+    self.undoEdits.append(edit)
+    return edit
+
+  def forgetNode(self, nodeID):
+    """
+    Drops the edits of a label map whose voxels were replaced in a way the journal cannot undo.
+    """
+    self.undoEdits = [edit for edit in self.undoEdits if edit.nodeID != nodeID]
+    self.redoEdits = [edit for edit in self.redoEdits if edit.nodeID != nodeID]
+
+  def replay(self, labelArray, nodeID=None):
+    """
+    Makes the edits that can be undone (only those of nodeID, if given) again on labelArray, for
+    example on a freshly loaded copy of the atlas, in the order they were made.
+    """
+    for edit in self.undoEdits:
+      if nodeID is None or edit.nodeID == nodeID:
+        edit.redo(labelArray)
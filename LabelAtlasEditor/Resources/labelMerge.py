@@ -0,0 +1,55 @@
+"""
+Merging of a suspicious label into a target label, restricted to the region of both labels.
+
+The merge region is the largest fully connected island of the voxels of the target and the
+suspicious label (or all of their voxels), optionally only where a posterior volume is at least
+a threshold. All of this is computed inside the bounding box of the two labels, where only that
+slab of the posterior volume is read, and the region is then written to the label array in
+place.
+"""
+
+import SimpleITK as sitk
+import numpy as np
+from labelArrayTools import relabelArrayInPlace, getArrayViewFromImage, getArrayRegion, getMaskBoundingBox
+
+def getMergeRegion(labelArray, targetLabel, suspiciousLabel, mergeAllIslands=False,
+                   posteriorArray=None, posteriorThreshold=None):
+  """
+  Returns the (size, index) of the bounding box of targetLabel and suspiciousLabel and the
+  boolean mask, inside that box, of the voxels that are merged into targetLabel. The size is
+  None if neither label is in labelArray.
+  """
+  labelsMask = np.equal(labelArray, targetLabel)
+  labelsMask |= np.equal(labelArray, suspiciousLabel)
+  if not labelsMask.any():
+    return None, None, None
+  boundingBox = getMaskBoundingBox(labelsMask)
+  size, index = list(boundingBox[3:]), list(boundingBox[:3])
+  mergeMask = getArrayRegion(labelsMask, size, index)
+
+  if not mergeAllIslands:
+    connectedRegion = sitk.ConnectedComponent(sitk.GetImageFromArray(mergeMask.astype(np.uint8)), True)
+    relabeledConnectedRegion = sitk.RelabelComponent(connectedRegion)
+    mergeMask = np.equal(getArrayViewFromImage(relabeledConnectedRegion), 1)
+  if posteriorArray is not None:
+    # only the slab of the posterior volume inside the box is read
+    posteriorRegion = getArrayRegion(posteriorArray, size, index)
+    # like sitk.BinaryThreshold(posterior, posteriorThreshold), whose upper threshold is 255
+    mergeMask = mergeMask & (posteriorRegion >= posteriorThreshold) & (posteriorRegion <= 255)
+  return size, index, mergeMask
+
+def mergeLabelArray(labelArray, targetLabel, suspiciousLabel, mergeAllIslands=False,
+                    posteriorArray=None, posteriorThreshold=None):
+  """
+  Merges suspiciousLabel into targetLabel in labelArray, in place, and returns the (N, 3) array of
+  (x, y, z) indices of the voxels that changed label together with their labels before the merge.
+  """
+  size, index, mergeMask = getMergeRegion(labelArray, targetLabel, suspiciousLabel, mergeAllIslands,
+                                          posteriorArray, posteriorThreshold)
+  if size is None:
+    return np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=labelArray.dtype)
+  labelArrayRegion = getArrayRegion(labelArray, size, index)
+  changedMask = mergeMask & np.not_equal(labelArrayRegion, targetLabel)
+  oldLabels = labelArrayRegion[changedMask]
+  relabelArrayInPlace(labelArrayRegion, targetLabel, mask=changedMask)
+  return np.argwhere(changedMask)[:, ::-1] + np.array(index), oldLabels
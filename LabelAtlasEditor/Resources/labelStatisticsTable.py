@@ -0,0 +1,154 @@
+import numpy as np
+
+class LabelStatisticsTable():
+  """
+  Running per-label intensity statistics for one or more intensity volumes.
+
+  For every label of the atlas the table holds the voxel count and, for each intensity volume,
+  the sum and the sum of squares of the intensity values under that label. The table is built
+  from the label array and the intensity arrays (indexed (z, y, x)) a slab of slices at a time,
+  so memory-mapped volumes are read in pieces, and is then kept up to date with relabelIsland()
+  as islands are moved from one label to another, so that label means can be looked up without
+  running another full-volume statistics pass. With trackExtrema the table also holds the minimum
+  and the maximum intensity under every label of the atlas it was built from; these are not
+  updated when voxels are moved between labels.
+  """
+
+  slabVoxelCount = 1 << 22
+
+  def __init__(self, labelArray, volumeArrays, trackExtrema=False):
+    self.numberOfVolumes = len(volumeArrays)
+    self.counts = dict()
+    self.sums = dict()
+    self.sumsOfSquares = dict()
+    self.minimums = dict()
+    self.maximums = dict()
+
+    minimumLabel = int(labelArray.min())
+    numberOfBins = int(labelArray.max()) - minimumLabel + 1
+    counts = np.zeros(numberOfBins, dtype=np.int64)
+    sums = np.zeros((self.numberOfVolumes, numberOfBins))
+    sumsOfSquares = np.zeros((self.numberOfVolumes, numberOfBins))
+    minimums = np.full((self.numberOfVolumes, numberOfBins), np.inf)
+    maximums = np.full((self.numberOfVolumes, numberOfBins), -np.inf)
+    slabSliceCount = max(1, self.slabVoxelCount // max(1, labelArray[0].size))
+    for firstSlice in range(0, labelArray.shape[0], slabSliceCount):
+      slab = slice(firstSlice, firstSlice + slabSliceCount)
+      bins = labelArray[slab].ravel().astype(np.int64) - minimumLabel
+      counts += np.bincount(bins, minlength=numberOfBins)
+      if trackExtrema:
+        # the voxels of the slab grouped by label, for minimum.reduceat and maximum.reduceat
+        order = np.argsort(bins)
+        sortedBins = bins[order]
+        starts = np.flatnonzero(np.concatenate(([True], sortedBins[1:] != sortedBins[:-1])))
+        slabBins = sortedBins[starts]
+      for volumeIndex, volumeArray in enumerate(volumeArrays):
+        values = volumeArray[slab].ravel().astype(np.float64)
+        sums[volumeIndex] += np.bincount(bins, weights=values, minlength=numberOfBins)
+        sumsOfSquares[volumeIndex] += np.bincount(bins, weights=values * values, minlength=numberOfBins)
+        if trackExtrema:
+          sortedValues = values[order]
+          minimums[volumeIndex, slabBins] = np.minimum(minimums[volumeIndex, slabBins],
+                                                       np.minimum.reduceat(sortedValues, starts))
+          maximums[volumeIndex, slabBins] = np.maximum(maximums[volumeIndex, slabBins],
+                                                       np.maximum.reduceat(sortedValues, starts))
+
+    for labelBin in np.flatnonzero(counts):
+      label = int(labelBin) + minimumLabel
+      self.counts[label] = int(counts[labelBin])
+      self.sums[label] = [float(total) for total in sums[:, labelBin]]
+      self.sumsOfSquares[label] = [float(sumOfSquares) for sumOfSquares in sumsOfSquares[:, labelBin]]
+      if trackExtrema:
+        self.minimums[label] = [float(minimum) for minimum in minimums[:, labelBin]]
+        self.maximums[label] = [float(maximum) for maximum in maximums[:, labelBin]]
+
+  def addLabel(self, label):
+    self.counts[label] = 0
+    self.sums[label] = [0.0] * self.numberOfVolumes
+    self.sumsOfSquares[label] = [0.0] * self.numberOfVolumes
+
+  def getIslandStatistics(self, labelStatsObject, label):
+    """
+    Returns the count, sum and sum of squares of one label of a LabelStatisticsImageFilter.
+    The sum of squares is recovered from the (unbiased) variance reported by the filter.
+    """
+    count = labelStatsObject.GetCount(label)
+    total = labelStatsObject.GetSum(label)
+    sumOfSquares = labelStatsObject.GetVariance(label) * (count - 1) + total * total / count
+    return count, total, sumOfSquares
+
+  def getLabels(self):
+    return sorted(label for label in self.counts if self.counts[label] > 0)
+
+  def getCount(self, label):
+    return self.counts.get(label, 0)
+
+  def getMean(self, label, volumeIndex):
+    return self.sums[label][volumeIndex] / self.counts[label]
+
+  def getMinimum(self, label, volumeIndex):
+    """
+    Returns the minimum intensity under label in the atlas the table was built from, or None if
+    the table does not track extrema or had no voxels of label.
+    """
+    if label not in self.minimums:
+      return None
+    return self.minimums[label][volumeIndex]
+
+  def getMaximum(self, label, volumeIndex):
+    if label not in self.maximums:
+      return None
+    return self.maximums[label][volumeIndex]
+
+  def getVariance(self, label, volumeIndex):
+    count = self.counts[label]
+    if count < 2:
+      return 0.0
+    total = self.sums[label][volumeIndex]
+    return (self.sumsOfSquares[label][volumeIndex] - total * total / count) / (count - 1)
+
+  def getMoments(self, labels):
+    """
+    Returns the means and the variances of labels as (numberOfLabels, numberOfVolumes) arrays,
+    computed like getMean and getVariance.
+    """
+    counts = np.array([self.counts[label] for label in labels], dtype=np.float64).reshape(-1, 1)
+    sums = np.array([self.sums[label] for label in labels], dtype=np.float64).reshape(len(counts), -1)
+    sumsOfSquares = np.array([self.sumsOfSquares[label] for label in labels], dtype=np.float64).reshape(len(counts), -1)
+    means = sums / counts
+    variances = np.zeros(sums.shape)
+    hasVariance = (counts >= 2).ravel()
+    variances[hasVariance] = ((sumsOfSquares[hasVariance] - sums[hasVariance] * sums[hasVariance] / counts[hasVariance]) /
+                              (counts[hasVariance] - 1))
+    return means, variances
+
+  def relabelIsland(self, fromLabel, toLabel, islandLabelStatsObjects, islandLabel):
+    """
+    Moves the voxels of an island from fromLabel to toLabel. islandLabelStatsObjects holds one
+    LabelStatisticsImageFilter per intensity volume (in the order used to build the table) that
+    was run on the labelled islands, and islandLabel is the island value in those objects.
+    """
+    sums = list()
+    sumsOfSquares = list()
+    for labelStatsObject in islandLabelStatsObjects:
+      count, total, sumOfSquares = self.getIslandStatistics(labelStatsObject, islandLabel)
+      sums.append(total)
+      sumsOfSquares.append(sumOfSquares)
+    self.relabelVoxels(fromLabel, toLabel, count, sums, sumsOfSquares)
+
+  def relabelVoxels(self, fromLabel, toLabel, count, sums, sumsOfSquares):
+    """
+    Moves count voxels from fromLabel to toLabel, where sums and sumsOfSquares hold the sum and
+    the sum of squares of their intensity values for each intensity volume.
+    """
+    if fromLabel == toLabel:
+      return
+    if toLabel not in self.counts:
+      self.addLabel(toLabel)
+    for volumeIndex in range(self.numberOfVolumes):
+      self.sums[fromLabel][volumeIndex] -= sums[volumeIndex]
+      self.sums[toLabel][volumeIndex] += sums[volumeIndex]
+      self.sumsOfSquares[fromLabel][volumeIndex] -= sumsOfSquares[volumeIndex]
+      self.sumsOfSquares[toLabel][volumeIndex] += sumsOfSquares[volumeIndex]
+    self.counts[fromLabel] -= count
+    self.counts[toLabel] += count
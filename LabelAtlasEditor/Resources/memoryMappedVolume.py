@@ -0,0 +1,242 @@
+"""
+Read-only access to uncompressed NRRD and NIfTI volumes through numpy.memmap.
+
+readVolume opens the voxel data of a raw encoded NRRD file (attached or detached data) or of an
+uncompressed single file NIfTI-1 image as a memory-mapped array, so that intensity values are
+only paged in when they are used. The spacing, origin and direction are read from the header in
+the LPS convention used by SimpleITK. Any other file (compressed data, more than three
+dimensions, scaled NIfTI values, ...) is read with SimpleITK instead, and readMemoryMappedVolume
+then moves its voxels to a temporary file so that they are not kept in memory either.
+"""
+
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+
+import SimpleITK as sitk
+import numpy as np
+from labelArrayTools import getArrayViewFromImage, getImageFromLabelArray
+
+nrrdTypes = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'float': 'f4', 'double': 'f8',
+}
+
+niftiTypes = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 512: 'u2', 768: 'u4'}
+
+class MemoryMappedVolume():
+  """
+  A volume as an array indexed (z, y, x) together with its spacing, origin and direction (all
+  in the SimpleITK layout). isMemoryMapped is False if the array was read into memory.
+  """
+
+  def __init__(self, array, spacing, origin, direction, isMemoryMapped=True):
+    self.array = array
+    self.spacing = tuple(float(value) for value in spacing)
+    self.origin = tuple(float(value) for value in origin)
+    self.direction = tuple(float(value) for value in direction)
+    self.isMemoryMapped = isMemoryMapped
+
+  def getImageFromArray(self, array):
+    """
+    Returns array, which must have the shape of this volume, as an image with this geometry.
+    """
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(self.spacing)
+    image.SetOrigin(self.origin)
+    image.SetDirection(self.direction)
+    return image
+
+def readVolume(path):
+  lowerPath = path.lower()
+  volume = None
+  if lowerPath.endswith('.nrrd') or lowerPath.endswith('.nhdr'):
+    volume = readNrrdVolume(path)
+  elif lowerPath.endswith('.nii'):
+    volume = readNiftiVolume(path)
+  if volume is None:
+    image = sitk.ReadImage(path)
+    volume = MemoryMappedVolume(sitk.GetArrayFromImage(image), image.GetSpacing(), image.GetOrigin(),
+                                image.GetDirection(), isMemoryMapped=False)
+  return volume
+
+def readMemoryMappedVolume(path):
+  """
+  Reads path like readVolume, but writes a volume that was read with SimpleITK to a temporary
+  file and returns it memory-mapped from there.
+  """
+  volume = readVolume(path)
+  if volume.isMemoryMapped:
+    return volume
+  temporaryDirectory = tempfile.mkdtemp(prefix='memoryMappedVolume')
+  try:
+    arrayPath = os.path.join(temporaryDirectory, 'volume.npy')
+    np.save(arrayPath, volume.array)
+    array = np.load(arrayPath, mmap_mode='r')
+  finally:
+    # the memory map keeps the data of the removed file readable on POSIX systems
+    shutil.rmtree(temporaryDirectory, ignore_errors=True)
+  return MemoryMappedVolume(array, volume.spacing, volume.origin, volume.direction)
+
+def getVolumeGeometry(volume):
+  """
+  Returns the spacing, origin and direction of a MemoryMappedVolume or of a SimpleITK image.
+  """
+  if isinstance(volume, MemoryMappedVolume):
+    return volume.spacing, volume.origin, volume.direction
+  return volume.GetSpacing(), volume.GetOrigin(), volume.GetDirection()
+
+def getVolumeArray(volume):
+  """
+  Returns the (z, y, x) array of a MemoryMappedVolume or of a SimpleITK image.
+  """
+  if isinstance(volume, MemoryMappedVolume):
+    return volume.array
+  return getArrayViewFromImage(volume)
+
+def getImageFromVolumeArray(array, volume):
+  """
+  Returns array as an image with the geometry of volume, a MemoryMappedVolume or an image.
+  """
+  if isinstance(volume, MemoryMappedVolume):
+    return volume.getImageFromArray(array)
+  return getImageFromLabelArray(array, volume)
+
+def getVolumeBytes(path):
+  """
+  Returns the bytes that readVolume keeps in memory for path, from the header of the file: none
+  for a volume that it memory-maps, else the bytes of its voxels. The voxels of files that are
+  neither NRRD nor NIfTI are estimated from the size of the file.
+  """
+  lowerPath = path.lower()
+  if lowerPath.endswith('.nrrd') or lowerPath.endswith('.nhdr'):
+    if readNrrdVolume(path) is not None:
+      return 0
+    fields, _ = readNrrdHeader(path)
+    if fields is not None and 'sizes' in fields and fields.get('type') in nrrdTypes:
+      voxelCount = np.prod([int(value) for value in fields['sizes'].split()])
+      return int(voxelCount) * np.dtype(nrrdTypes[fields['type']]).itemsize
+  elif lowerPath.endswith('.nii') or lowerPath.endswith('.nii.gz'):
+    if lowerPath.endswith('.nii') and readNiftiVolume(path) is not None:
+      return 0
+    openFile = gzip.open if lowerPath.endswith('.gz') else open
+    with openFile(path, 'rb') as niftiFile:
+      header = niftiFile.read(348)
+    if len(header) == 348:
+      endian = '<' if struct.unpack('<i', header[0:4])[0] == 348 else '>'
+      dim = struct.unpack(endian + '8h', header[40:56])
+      bitpix = struct.unpack(endian + 'h', header[72:74])[0]
+      if 1 <= dim[0] <= 7:
+        return int(np.prod(dim[1:dim[0] + 1])) * bitpix // 8
+  return os.path.getsize(path)
+
+def readNrrdHeader(path):
+  """
+  Returns the fields of a NRRD header as a dict and the file offset of the attached data.
+  """
+  fields = dict()
+  with open(path, 'rb') as nrrdFile:
+    if not nrrdFile.readline().startswith(b'NRRD'):
+      return None, None
+    for line in iter(nrrdFile.readline, b''):
+      line = line.decode('latin-1').rstrip('\r\n')
+      if not line:
+        break
+      if line.startswith('#') or ':=' in line:
+        continue
+      key, _, value = line.partition(':')
+      fields[key.strip().lower()] = value.strip()
+    return fields, nrrdFile.tell()
+
+def readNrrdVolume(path):
+  fields, dataOffset = readNrrdHeader(path)
+  if fields is None or fields.get('encoding') != 'raw' or fields.get('dimension') != '3':
+    return None
+  if fields.get('type') not in nrrdTypes or int(fields.get('line skip', 0)) != 0:
+    return None
+  size = [int(value) for value in fields['sizes'].split()]
+  dataType = np.dtype(nrrdTypes[fields['type']])
+  if dataType.itemsize > 1:
+    dataType = dataType.newbyteorder('>' if fields.get('endian') == 'big' else '<')
+
+  dataPath = path
+  if 'data file' in fields:
+    dataPath = os.path.join(os.path.dirname(path), fields['data file'])
+    dataOffset = 0
+  byteSkip = int(fields.get('byte skip', 0))
+  if byteSkip == -1:
+    dataOffset = os.path.getsize(dataPath) - dataType.itemsize * size[0] * size[1] * size[2]
+  else:
+    dataOffset += byteSkip
+  array = np.memmap(dataPath, dtype=dataType, mode='r', offset=dataOffset, shape=(size[2], size[1], size[0]))
+
+  if 'space directions' in fields:
+    axes = [[float(value) for value in vector.strip('()').split(',')]
+            for vector in fields['space directions'].split()]
+  else:
+    spacings = [float(value) for value in fields.get('spacings', '1 1 1').split()]
+    axes = [[spacings[i] if i == j else 0.0 for i in range(3)] for j in range(3)]
+  if 'space origin' in fields:
+    origin = [float(value) for value in fields['space origin'].strip('()').split(',')]
+  else:
+    origin = [0.0, 0.0, 0.0]
+  if fields.get('space') in ('right-anterior-superior', 'RAS'):
+    axes = [[-axis[0], -axis[1], axis[2]] for axis in axes]
+    origin = [-origin[0], -origin[1], origin[2]]
+  spacing = [np.linalg.norm(axis) for axis in axes]
+  direction = [axes[column][row] / spacing[column] for row in range(3) for column in range(3)]
+  return MemoryMappedVolume(array, spacing, origin, direction)
+
+def readNiftiVolume(path):
+  with open(path, 'rb') as niftiFile:
+    header = niftiFile.read(348)
+  if len(header) < 348:
+    return None
+  endian = '<' if struct.unpack('<i', header[0:4])[0] == 348 else '>'
+  if struct.unpack(endian + 'i', header[0:4])[0] != 348 or header[344:347] != b'n+1':
+    return None
+  dim = struct.unpack(endian + '8h', header[40:56])
+  datatype = struct.unpack(endian + 'h', header[70:72])[0]
+  pixdim = struct.unpack(endian + '8f', header[76:108])
+  voxOffset = int(struct.unpack(endian + 'f', header[108:112])[0])
+  sclSlope, sclInter = struct.unpack(endian + '2f', header[112:120])
+  qformCode, sformCode = struct.unpack(endian + '2h', header[252:256])
+  quaternion = struct.unpack(endian + '3f', header[256:268])
+  qoffset = struct.unpack(endian + '3f', header[268:280])
+  srow = struct.unpack(endian + '12f', header[280:328])
+  if dim[0] != 3 or datatype not in niftiTypes or (sclSlope not in (0.0, 1.0)) or sclInter != 0.0:
+    return None
+
+  dataType = np.dtype(niftiTypes[datatype])
+  if dataType.itemsize > 1:
+    dataType = dataType.newbyteorder(endian)
+  array = np.memmap(path, dtype=dataType, mode='r', offset=voxOffset, shape=(dim[3], dim[2], dim[1]))
+
+  spacing = [abs(value) for value in pixdim[1:4]]
+  if sformCode > 0:
+    matrix = np.array(srow).reshape(3, 4)
+    origin = matrix[:, 3]
+    rotation = matrix[:, :3] / np.linalg.norm(matrix[:, :3], axis=0)
+  elif qformCode > 0:
+    b, c, d = quaternion
+    a = np.sqrt(max(1.0 - (b * b + c * c + d * d), 0.0))
+    rotation = np.array([[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                         [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                         [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]])
+    if pixdim[0] < 0:
+      rotation[:, 2] = -rotation[:, 2]
+    origin = np.array(qoffset)
+  else:
+    rotation = np.eye(3)
+    origin = np.zeros(3)
+  # NIfTI stores RAS coordinates, SimpleITK uses LPS
+  rotation[:2] = -rotation[:2]
+  origin = [-origin[0], -origin[1], origin[2]]
+  return MemoryMappedVolume(array, spacing, origin, rotation.ravel())
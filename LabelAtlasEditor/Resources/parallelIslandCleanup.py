@@ -0,0 +1,93 @@
+"""
+Process pool that runs the island size sweep of atlasSmallIslandCleanup for many labels at once.
+
+Each worker runs the sweep of one label on the input atlas and returns, for every island size,
+the islands it found and whether each island was moved to another label. The input atlas and
+the intensity volumes are written once to a temporary directory and every worker opens them as
+read-only memory-mapped arrays, so the volumes are not copied into each process. A
+RunLengthLabelMap atlas is saved as an NPZ file and loaded by every worker instead. The workers
+never write to the atlas: DustCleanup.cleanupLabelImageInParallel replays their label passes in
+the serial label order and recomputes everything that does not match the serial run.
+"""
+
+import copy
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from labelAdjacencyGraph import getIslandContacts
+from runLengthLabelMap import RunLengthLabelMap, loadRunLengthLabelMap
+
+workerState = dict()
+
+def initializeWorker(cleanupArguments, labelArrayPath, volumeArrayPaths, labelStatisticsTable):
+  from atlasSmallIslandCleanup import DustCleanup
+  cleanup = DustCleanup(cleanupArguments)
+  # the profile of a worker is never reported, the main process times the label passes
+  cleanup.profiler.isEnabled = False
+  cleanup.volumeArrays = [np.load(path, mmap_mode='r') for path in volumeArrayPaths]
+  workerState['cleanup'] = cleanup
+  if labelArrayPath.endswith('.npz'):
+    workerState['labelArray'] = loadRunLengthLabelMap(labelArrayPath)
+  else:
+    workerState['labelArray'] = np.load(labelArrayPath, mmap_mode='r')
+  workerState['labelStatisticsTable'] = labelStatisticsTable
+
+def getLabelPass(label):
+  """
+  Runs the island size sweep of label on the input atlas. Bordering labels are looked up in the
+  input atlas and the islands are scored against a private copy of the label statistics table,
+  so the result is a guess of the serial run that DustCleanup checks island by island.
+  """
+  cleanup = workerState['cleanup']
+  labelArray = workerState['labelArray']
+  labelStatisticsTable = copy.deepcopy(workerState['labelStatisticsTable'])
+  islandSizeSchedule = cleanup.getIslandSizeSchedule(labelArray, label)
+
+  labelPass = list()
+  for currentIslandSize in range(1, cleanup.maximumIslandVoxelCount + 1):
+    numberOfIslands, islands = islandSizeSchedule.getIslands(currentIslandSize)
+    islandsMoved = list()
+    for voxelIndices in islands:
+      voxelStatistics = cleanup.getVoxelStatistics(voxelIndices)
+      islandContacts = getIslandContacts(labelArray, voxelIndices, cleanup.useFullyConnectedInConnectedComponentFilter)
+      newLabel = cleanup.selectNewLabel(voxelStatistics, islandContacts, label, labelStatisticsTable)[0]
+      if newLabel != label:
+        islandSizeSchedule.removeIsland(voxelIndices)
+        labelStatisticsTable.relabelVoxels(label, newLabel, *voxelStatistics)
+      islandsMoved.append(newLabel != label)
+    labelPass.append((numberOfIslands, islands, islandsMoved))
+  return labelPass
+
+class LabelPassPool():
+
+  def __init__(self, cleanupArguments, labelArray, volumeArrays, labelStatisticsTable, numberOfJobs):
+    self.temporaryDirectory = tempfile.mkdtemp(prefix='atlasSmallIslandCleanup')
+    labelArrayPath = self.saveArray(labelArray, 'labelImage')
+    volumeArrayPaths = [self.saveArray(volumeArray, 'volumeImage%d' % volumeIndex)
+                        for volumeIndex, volumeArray in enumerate(volumeArrays)]
+    self.pool = multiprocessing.Pool(numberOfJobs, initializeWorker,
+                                     (cleanupArguments, labelArrayPath, volumeArrayPaths, labelStatisticsTable))
+
+  def saveArray(self, array, name):
+    if isinstance(array, RunLengthLabelMap):
+      path = os.path.join(self.temporaryDirectory, name + '.npz')
+      array.save(path)
+    else:
+      path = os.path.join(self.temporaryDirectory, name + '.npy')
+      np.save(path, array)
+    return path
+
+  def getLabelPasses(self, labelsList):
+    """
+    Returns an iterator over the label passes of labelsList, in order, while the pool keeps
+    working on the labels that follow.
+    """
+    return self.pool.imap(getLabelPass, labelsList)
+
+  def close(self):
+    self.pool.terminate()
+    self.pool.join()
+    shutil.rmtree(self.temporaryDirectory, ignore_errors=True)
@@ -0,0 +1,172 @@
+"""
+Thread and memory budget shared by the cleanup tools of a process.
+
+The budget comes from the --threads and --memoryMegabytes options of the tools, else from the
+LABEL_ATLAS_EDITOR_THREADS and LABEL_ATLAS_EDITOR_MEMORY_MB environment variables, else from the
+machine: the number of CPUs, limited by the cgroup CPU quota of the container, and the cgroup
+memory limit, with no memory budget outside a memory cgroup. The Slicer module keeps the same
+two settings in its Resources section.
+
+The thread budget is applied to every SimpleITK filter as the global default number of threads
+and is split between the processes of a worker pool. The memory budget limits the full-volume
+temporaries that are alive at once: a tool reserves the bytes of a volume that it keeps beyond
+the current step, like an output image that is written in the background or the images of the
+next subject that are read ahead. The reservation of a volume that is about to be read waits
+until the earlier reservations leave room for it, while a volume that is already in memory is
+counted at once, so that waiting for it cannot hold up the work that would free the budget.
+"""
+
+import math
+import multiprocessing
+import os
+import re
+import threading
+
+import SimpleITK as sitk
+
+threadsEnvironmentVariable = 'LABEL_ATLAS_EDITOR_THREADS'
+memoryEnvironmentVariable = 'LABEL_ATLAS_EDITOR_MEMORY_MB'
+
+# cgroup v1 reports "no limit" as a huge page-aligned number
+unlimitedCgroupMemoryBytes = 1 << 60
+
+def readCgroupValues(paths):
+  """
+  Returns the whitespace separated values of the first of paths that can be read, or None.
+  """
+  for path in paths:
+    try:
+      with open(path) as cgroupFile:
+        return cgroupFile.read().split()
+    except (IOError, OSError):
+      continue
+  return None
+
+def getCgroupCpuLimit():
+  """
+  Returns the number of CPUs allowed by the cgroup CPU quota, or None without a quota.
+  """
+  values = readCgroupValues(['/sys/fs/cgroup/cpu.max'])
+  if values is not None:
+    if values[0] == 'max':
+      return None
+    return float(values[0]) / float(values[1])
+  quota = readCgroupValues(['/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us'])
+  period = readCgroupValues(['/sys/fs/cgroup/cpu/cpu.cfs_period_us', '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us'])
+  if not quota or not period or int(quota[0]) <= 0:
+    return None
+  return float(quota[0]) / float(period[0])
+
+def getCgroupMemoryLimit():
+  """
+  Returns the memory limit of the cgroup in bytes, or None without a limit.
+  """
+  values = readCgroupValues(['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'])
+  if not values or values[0] == 'max' or int(values[0]) >= unlimitedCgroupMemoryBytes:
+    return None
+  return int(values[0])
+
+def getAvailableCpuCount():
+  cpuCount = multiprocessing.cpu_count()
+  cpuLimit = getCgroupCpuLimit()
+  if cpuLimit is not None:
+    cpuCount = min(cpuCount, int(math.ceil(cpuLimit)))
+  return max(1, cpuCount)
+
+def getImageBytes(image):
+  # the pixel type names the bits of a component, e.g. "vector of 32-bit float"
+  componentBits = int(re.search(r'(\d+)-bit', image.GetPixelIDTypeAsString()).group(1))
+  return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * componentBits // 8
+
+class MemoryReservation():
+  """
+  Bytes reserved in a ResourceBudget until release is called or the with block ends.
+  """
+
+  def __init__(self, resourceBudget, numberOfBytes):
+    self.resourceBudget = resourceBudget
+    self.numberOfBytes = numberOfBytes
+
+  def release(self):
+    if self.numberOfBytes:
+      self.resourceBudget.release(self.numberOfBytes)
+      self.numberOfBytes = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, exceptionTraceback):
+    self.release()
+    return False
+
+class ResourceBudget():
+
+  def __init__(self, numberOfThreads=None, memoryMegabytes=None):
+    self.numberOfThreads = max(1, int(numberOfThreads or os.environ.get(threadsEnvironmentVariable) or
+                                      getAvailableCpuCount()))
+    memoryMegabytes = memoryMegabytes or os.environ.get(memoryEnvironmentVariable)
+    if memoryMegabytes and float(memoryMegabytes) > 0:
+      self.memoryBytes = int(float(memoryMegabytes) * 1048576)
+    else:
+      self.memoryBytes = getCgroupMemoryLimit()
+    self.reservedBytes = 0
+    self.condition = threading.Condition()
+
+  def applyToSimpleITK(self):
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(self.numberOfThreads)
+
+  def getNumberOfWorkers(self, numberOfJobs, bytesPerWorker=0):
+    """
+    Returns numberOfJobs limited by the thread budget and, when the bytes that every worker
+    keeps are given, by the memory budget.
+    """
+    numberOfWorkers = min(numberOfJobs, self.numberOfThreads)
+    if self.memoryBytes and bytesPerWorker:
+      numberOfWorkers = min(numberOfWorkers, self.memoryBytes // bytesPerWorker)
+    return max(1, int(numberOfWorkers))
+
+  def getWorkerArguments(self, arguments, numberOfWorkers):
+    """
+    Returns a copy of the arguments of a tool for one of numberOfWorkers worker processes, with
+    its share of the budget.
+    """
+    workerArguments = dict(arguments)
+    workerArguments['--threads'] = str(max(1, self.numberOfThreads // numberOfWorkers))
+    if self.memoryBytes:
+      workerArguments['--memoryMegabytes'] = str(self.memoryBytes / 1048576.0 / numberOfWorkers)
+    return workerArguments
+
+  def reserve(self, numberOfBytes, wait=True):
+    """
+    Waits until numberOfBytes fit in the memory budget and returns their MemoryReservation. A
+    reservation larger than the whole budget is granted once nothing else is reserved. With
+    wait False the bytes, which must already be in memory, are reserved at once.
+    """
+    with self.condition:
+      while (wait and self.memoryBytes and self.reservedBytes and
+             self.reservedBytes + numberOfBytes > self.memoryBytes):
+        self.condition.wait()
+      self.reservedBytes += numberOfBytes
+    return MemoryReservation(self, numberOfBytes)
+
+  def release(self, numberOfBytes):
+    with self.condition:
+      self.reservedBytes -= numberOfBytes
+      self.condition.notify_all()
+
+resourceBudgetState = dict()
+
+def getResourceBudget(numberOfThreads=None, memoryMegabytes=None):
+  """
+  Returns the budget of the process for the given settings, with its thread budget applied to
+  SimpleITK. The tools of a process that use the same settings share one budget, so that their
+  reservations count against each other.
+  """
+  settings = (str(numberOfThreads or ''), str(memoryMegabytes or ''),
+              os.environ.get(threadsEnvironmentVariable), os.environ.get(memoryEnvironmentVariable))
+  if resourceBudgetState.get('settings') != settings:
+    resourceBudgetState['budget'] = ResourceBudget(numberOfThreads, memoryMegabytes)
+    resourceBudgetState['settings'] = settings
+  resourceBudget = resourceBudgetState['budget']
+  resourceBudget.applyToSimpleITK()
+  return resourceBudget
@@ -0,0 +1,454 @@
+"""
+Run-length encoded label map.
+
+A label atlas is mostly long runs of voxels with the same label along every row (the x axis of
+the (z, y, x) array). RunLengthLabelMap keeps, for every row, the x index at which each run
+starts and the label of the run, with the rows back to back in two flat arrays and an offsets
+array per row (the layout of cleanupChangeLog), so an atlas takes a few bytes per run instead
+of two bytes per voxel.
+
+The map is indexed like the Int16 label array of the cleanup: labelMap[z0:z1, y0:y1, x0:x1]
+decodes a region, labelMap[z, y, x] is the label of a voxel and labelMap[zIndices, yIndices,
+xIndices] = label relabels voxels in place. Edited rows are encoded again and kept apart until
+enough rows have been edited, or until a query over the whole map, and are then folded back into
+the flat arrays. The queries over the whole map work on the runs, so they take time in the
+number of runs instead of the number of voxels: the labels, the mask of a label around its
+bounding box, the contacts between labels (see labelAdjacencyGraph) and the islands of the labels
+(see atlasIslandTable), which are found by joining the overlapping runs of neighbouring rows.
+"""
+
+import itertools
+
+import numpy as np
+from labelArrayTools import getPaddedRegion
+
+def getOffsets(counts):
+  return np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+
+def getRaggedRanges(begins, ends):
+  """
+  Returns the values of the ranges begin..end-1 for every begin and end, back to back, and the
+  index of the range of every value.
+  """
+  lengths = np.asarray(ends, dtype=np.int64) - begins
+  if not len(lengths):
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+  owners = np.repeat(np.arange(len(lengths)), lengths)
+  firstPositions = getOffsets(lengths)[:-1]
+  return np.arange(lengths.sum()) - np.repeat(firstPositions - begins, lengths), owners
+
+def encodeRows(rows):
+  """
+  Returns the number of runs of every row of a 2D array, and the x index at which each run
+  starts and the label of each run, row after row.
+  """
+  isRunStart = np.ones(rows.shape, dtype=bool)
+  isRunStart[:, 1:] = rows[:, 1:] != rows[:, :-1]
+  starts = np.nonzero(isRunStart)[1]
+  return isRunStart.sum(axis=1), starts, rows[isRunStart]
+
+def getConnectedComponents(numberOfNodes, firstNodes, secondNodes):
+  """
+  Returns the component of every node of the graph with the edges firstNodes to secondNodes,
+  as the smallest node of the component. Roots are hooked under smaller roots, and the paths
+  are then shortened, until no edge joins two components.
+  """
+  components = np.arange(numberOfNodes)
+  while True:
+    firstRoots = components[firstNodes]
+    secondRoots = components[secondNodes]
+    isJoining = firstRoots != secondRoots
+    if not isJoining.any():
+      return components
+    np.minimum.at(components, np.maximum(firstRoots, secondRoots)[isJoining],
+                  np.minimum(firstRoots, secondRoots)[isJoining])
+    while True:
+      nextComponents = components[components]
+      if np.array_equal(nextComponents, components):
+        break
+      components = nextComponents
+
+def getNeighbourRowOffsets(fullyConnected):
+  """
+  Returns the (dz, dy, dx) offsets between the voxels of a row and their neighbours in the
+  following rows, so that every pair of neighbours in different rows is counted once.
+  """
+  if not fullyConnected:
+    return [(0, 1, 0), (1, 0, 0)]
+  return ([(0, 1, dx) for dx in (-1, 0, 1)] +
+          [(1, dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+
+class RunLengthLabelMap():
+
+  slabRunCount = 1 << 22
+
+  def __init__(self, shape, runCounts, runStarts, runLabels):
+    self.shape = tuple(int(value) for value in shape)
+    self.size = self.shape[0] * self.shape[1] * self.shape[2]
+    self.ndim = 3
+    self.dtype = np.dtype(np.int16)
+    self.numberOfRows = self.shape[0] * self.shape[1]
+    self.startType = np.uint16 if self.shape[2] <= np.iinfo(np.uint16).max else np.int32
+    self.rowOffsets = getOffsets(runCounts)
+    self.runStarts = np.asarray(runStarts).astype(self.startType)
+    self.runLabels = np.asarray(runLabels).astype(np.int16)
+    self.editedRows = dict()
+    self.isRowEdited = np.zeros(self.numberOfRows, dtype=bool)
+    self.maximumNumberOfEditedRows = max(1024, self.numberOfRows // 16)
+    self.runKeys = None
+
+  def getNumberOfRuns(self):
+    self.compact()
+    return len(self.runLabels)
+
+  def getNumberOfBytes(self):
+    return (self.rowOffsets.nbytes + self.runStarts.nbytes + self.runLabels.nbytes + self.isRowEdited.nbytes +
+            sum(starts.nbytes + labels.nbytes for starts, labels in self.editedRows.values()))
+
+  def getRow(self, row):
+    """
+    Returns the run starts and the run labels of a row.
+    """
+    if self.isRowEdited[row]:
+      return self.editedRows[row]
+    begin, end = self.rowOffsets[row], self.rowOffsets[row + 1]
+    return self.runStarts[begin:end], self.runLabels[begin:end]
+
+  def decodeRow(self, row):
+    starts, labels = self.getRow(row)
+    return np.repeat(labels, np.diff(np.append(starts.astype(np.int64), self.shape[2])))
+
+  def decodeRows(self, firstRow, lastRow):
+    """
+    Returns the (lastRow - firstRow, sizeX) array of the labels of the rows firstRow to
+    lastRow - 1.
+    """
+    begin, end = self.rowOffsets[firstRow], self.rowOffsets[lastRow]
+    starts = self.runStarts[begin:end].astype(np.int64)
+    ends = np.empty_like(starts)
+    ends[:-1] = starts[1:]
+    # the last run of every row ends at the end of the row
+    ends[self.rowOffsets[firstRow + 1:lastRow + 1] - begin - 1] = self.shape[2]
+    rows = np.repeat(self.runLabels[begin:end], ends - starts).reshape(lastRow - firstRow, self.shape[2])
+    for row in np.flatnonzero(self.isRowEdited[firstRow:lastRow]) + firstRow:
+      rows[row - firstRow] = self.decodeRow(row)
+    return rows
+
+  def setRow(self, row, rowLabels):
+    runCounts, starts, labels = encodeRows(rowLabels[np.newaxis])
+    self.editedRows[row] = (starts.astype(self.startType), labels.astype(np.int16))
+    self.isRowEdited[row] = True
+
+  def compact(self):
+    """
+    Folds the edited rows back into the flat arrays.
+    """
+    if not self.editedRows:
+      return
+    runCounts = np.diff(self.rowOffsets)
+    startPieces = list()
+    labelPieces = list()
+    nextRow = 0
+    for row in sorted(self.editedRows):
+      startPieces.append(self.runStarts[self.rowOffsets[nextRow]:self.rowOffsets[row]])
+      labelPieces.append(self.runLabels[self.rowOffsets[nextRow]:self.rowOffsets[row]])
+      starts, labels = self.editedRows[row]
+      startPieces.append(starts)
+      labelPieces.append(labels)
+      runCounts[row] = len(labels)
+      nextRow = row + 1
+    startPieces.append(self.runStarts[self.rowOffsets[nextRow]:])
+    labelPieces.append(self.runLabels[self.rowOffsets[nextRow]:])
+    self.runStarts = np.concatenate(startPieces)
+    self.runLabels = np.concatenate(labelPieces)
+    self.rowOffsets = getOffsets(runCounts)
+    self.editedRows = dict()
+    self.isRowEdited[:] = False
+    self.runKeys = None
+
+  def getRegionSlices(self, key):
+    """
+    Returns the (z, y, x) slices of an index made of integers and slices, and the axes given by
+    an integer, which are dropped from the decoded region.
+    """
+    if not isinstance(key, tuple):
+      key = (key,)
+    if len(key) > 3:
+      raise IndexError("Too many indices for a RunLengthLabelMap: %s" % (key,))
+    key = key + (slice(None),) * (3 - len(key))
+    slices = list()
+    droppedAxes = list()
+    for axis, axisKey in enumerate(key):
+      if isinstance(axisKey, (int, long, np.integer)):
+        index = int(axisKey) + self.shape[axis] if axisKey < 0 else int(axisKey)
+        if not 0 <= index < self.shape[axis]:
+          raise IndexError("Index %d is out of bounds for axis %d of size %d" % (axisKey, axis, self.shape[axis]))
+        slices.append((index, index + 1))
+        droppedAxes.append(axis)
+      elif isinstance(axisKey, slice):
+        start, stop, step = axisKey.indices(self.shape[axis])
+        if step != 1:
+          raise IndexError("A RunLengthLabelMap is only indexed with slices of step 1")
+        slices.append((start, max(start, stop)))
+      else:
+        raise IndexError("A RunLengthLabelMap is indexed with integers and slices, not %r" % (axisKey,))
+    return slices, droppedAxes
+
+  def __getitem__(self, key):
+    ((z0, z1), (y0, y1), (x0, x1)), droppedAxes = self.getRegionSlices(key)
+    if len(droppedAxes) == 3:
+      starts, labels = self.getRow(z0 * self.shape[1] + y0)
+      return labels[np.searchsorted(starts, x0, 'right') - 1]
+    region = np.empty((z1 - z0, y1 - y0, x1 - x0), dtype=np.int16)
+    if y1 > y0:
+      for z in range(z0, z1):
+        region[z - z0] = self.decodeRows(z * self.shape[1] + y0, z * self.shape[1] + y1)[:, x0:x1]
+    return region.reshape([length for axis, length in enumerate(region.shape) if axis not in droppedAxes])
+
+  def __setitem__(self, key, label):
+    """
+    Writes label at the voxels given by a tuple of three integer arrays (or integers) of z, y
+    and x indices, in place.
+    """
+    zIndices, yIndices, xIndices = [np.atleast_1d(np.asarray(indices, dtype=np.int64)) for indices in key]
+    rows = zIndices * self.shape[1] + yIndices
+    order = np.argsort(rows, kind='mergesort')
+    rows = rows[order]
+    xIndices = xIndices[order]
+    rowBegins = np.flatnonzero(np.append(True, rows[1:] != rows[:-1]))
+    rowEnds = np.append(rowBegins[1:], len(rows))
+    for begin, end in zip(rowBegins, rowEnds):
+      rowLabels = self.decodeRow(rows[begin])
+      rowLabels[xIndices[begin:end]] = label
+      self.setRow(rows[begin], rowLabels)
+    if len(self.editedRows) > self.maximumNumberOfEditedRows:
+      self.compact()
+
+  def min(self):
+    self.compact()
+    return self.runLabels.min()
+
+  def max(self):
+    self.compact()
+    return self.runLabels.max()
+
+  def getLabels(self):
+    self.compact()
+    return [int(label) for label in np.unique(self.runLabels)]
+
+  def getRunRows(self):
+    return np.repeat(np.arange(self.numberOfRows), np.diff(self.rowOffsets))
+
+  def getRunEnds(self):
+    ends = np.empty(len(self.runStarts), dtype=np.int64)
+    ends[:-1] = self.runStarts[1:]
+    ends[self.rowOffsets[1:] - 1] = self.shape[2]
+    return ends
+
+  def findRuns(self, rows, xIndices):
+    """
+    Returns the index of the run of every voxel given by its row and x index.
+    """
+    if self.runKeys is None:
+      self.runKeys = self.getRunRows() * self.shape[2] + self.runStarts
+    return np.searchsorted(self.runKeys, rows * self.shape[2] + xIndices, 'right') - 1
+
+  def getRunVoxels(self, runIndices):
+    """
+    Returns the (z, y, x) indices of the voxels of runIndices, in the order of the runs.
+    """
+    rows = np.searchsorted(self.rowOffsets, runIndices, 'right') - 1
+    xIndices, owners = getRaggedRanges(self.runStarts[runIndices].astype(np.int64), self.getRunEnds()[runIndices])
+    return rows[owners] // self.shape[1], rows[owners] % self.shape[1], xIndices
+
+  def getLabelBoundingBox(self, label):
+    """
+    Returns the bounding box of label in the SimpleITK (x, y, z, sizeX, sizeY, sizeZ) layout, or
+    None if the label has no voxel.
+    """
+    self.compact()
+    runIndices = np.flatnonzero(self.runLabels == label)
+    if not len(runIndices):
+      return None
+    rows = np.searchsorted(self.rowOffsets, runIndices, 'right') - 1
+    lower = [int(self.runStarts[runIndices].min()), int((rows % self.shape[1]).min()), int(rows[0] // self.shape[1])]
+    upper = [int(self.getRunEnds()[runIndices].max()), int((rows % self.shape[1]).max()) + 1,
+             int(rows[-1] // self.shape[1]) + 1]
+    return tuple(lower) + tuple(upper[axis] - lower[axis] for axis in range(3))
+
+  def getLabelMaskRegion(self, label, padding):
+    """
+    Returns the uint8 mask of label inside its bounding box padded by padding voxels (and
+    clipped to the map), and the (x, y, z) index of that region, or None and [0, 0, 0] if the
+    label has no voxel.
+    """
+    boundingBox = self.getLabelBoundingBox(label)
+    if boundingBox is None:
+      return None, [0, 0, 0]
+    runIndices = np.flatnonzero(self.runLabels == label)
+    zIndices, yIndices, xIndices = self.getRunVoxels(runIndices)
+    size, index = getPaddedRegion(boundingBox, self.shape[::-1], padding)
+    maskArray = np.zeros(size[::-1], dtype=np.uint8)
+    maskArray[zIndices - index[2], yIndices - index[1], xIndices - index[0]] = 1
+    return maskArray, index
+
+  def getSlabs(self):
+    """
+    Returns the (firstSlice, lastSlice) ranges of slabs of slices that hold about slabRunCount
+    runs each, which bound the temporaries of the queries over the whole map.
+    """
+    self.compact()
+    sliceOffsets = self.rowOffsets[::self.shape[1]]
+    slabs = list()
+    firstSlice = 0
+    while firstSlice < self.shape[0]:
+      lastSlice = int(np.searchsorted(sliceOffsets, sliceOffsets[firstSlice] + self.slabRunCount, 'right')) - 1
+      lastSlice = min(max(lastSlice, firstSlice + 1), self.shape[0])
+      slabs.append((firstSlice, lastSlice))
+      firstSlice = lastSlice
+    return slabs
+
+  def getRunOverlaps(self, dz, dy, dx, firstSlice=0, lastSlice=None):
+    """
+    Returns the pairs of runs (firstRuns, secondRuns) that hold neighbouring voxels (x, y, z)
+    and (x + dx, y + dy, z + dz), with z in firstSlice..lastSlice-1 and (dz, dy) other than
+    (0, 0), and the number of such pairs of voxels for every pair of runs. The overlap of two
+    rows is cut into segments at the run starts of both rows, and every segment is one pair of
+    runs.
+    """
+    self.compact()
+    sizeZ, sizeY, sizeX = self.shape
+    if lastSlice is None:
+      lastSlice = sizeZ
+    zIndices = np.arange(max(firstSlice, -dz), min(lastSlice, sizeZ - dz))
+    yIndices = np.arange(max(0, -dy), min(sizeY, sizeY - dy))
+    firstRows = (zIndices[:, np.newaxis] * sizeY + yIndices).ravel()
+    secondRows = firstRows + dz * sizeY + dy
+    lower, upper = max(0, -dx), min(sizeX, sizeX - dx)
+    if not len(firstRows) or upper <= lower:
+      empty = np.zeros(0, dtype=np.int64)
+      return empty, empty, empty
+
+    firstRunIndices, firstOwners = getRaggedRanges(self.rowOffsets[firstRows], self.rowOffsets[firstRows + 1])
+    secondRunIndices, secondOwners = getRaggedRanges(self.rowOffsets[secondRows], self.rowOffsets[secondRows + 1])
+    xIndices = np.concatenate((self.runStarts[firstRunIndices].astype(np.int64),
+                               self.runStarts[secondRunIndices].astype(np.int64) - dx,
+                               np.full(len(firstRows), lower, dtype=np.int64)))
+    owners = np.concatenate((firstOwners, secondOwners, np.arange(len(firstRows))))
+    inside = (xIndices >= lower) & (xIndices < upper)
+    segmentKeys = np.unique(owners[inside] * (sizeX + 1) + xIndices[inside])
+    pairs = segmentKeys // (sizeX + 1)
+    segmentStarts = segmentKeys % (sizeX + 1)
+    segmentEnds = np.append(segmentStarts[1:], upper)
+    segmentEnds[np.flatnonzero(pairs[1:] != pairs[:-1])] = upper
+    return (self.findRuns(firstRows[pairs], segmentStarts), self.findRuns(secondRows[pairs], segmentStarts + dx),
+            segmentEnds - segmentStarts)
+
+  def getContactCounts(self, fullyConnected):
+    """
+    Returns a list of (firstLabel, secondLabel, count) with the number of pairs of neighbouring
+    voxels of every pair of different labels, every pair of voxels counted once.
+    """
+    self.compact()
+    # neighbouring runs of a row always have different labels
+    isRowEnd = np.zeros(len(self.runLabels), dtype=bool)
+    isRowEnd[self.rowOffsets[1:] - 1] = True
+    rowRuns = np.flatnonzero(~isRowEnd)
+    minimumLabel = int(self.runLabels.min())
+    numberOfBins = int(self.runLabels.max()) - minimumLabel + 1
+    contactCounts = dict()
+
+    def addContacts(firstRuns, secondRuns, counts):
+      different = self.runLabels[firstRuns] != self.runLabels[secondRuns]
+      pairBins = ((self.runLabels[firstRuns[different]].astype(np.int64) - minimumLabel) * numberOfBins +
+                  self.runLabels[secondRuns[different]] - minimumLabel)
+      pairBins, inverse = np.unique(pairBins, return_inverse=True)
+      for pairBin, count in zip(pairBins, np.bincount(inverse, weights=counts[different])):
+        contactCounts[int(pairBin)] = contactCounts.get(int(pairBin), 0) + int(count)
+
+    addContacts(rowRuns, rowRuns + 1, np.ones(len(rowRuns), dtype=np.int64))
+    for firstSlice, lastSlice in self.getSlabs():
+      for dz, dy, dx in getNeighbourRowOffsets(fullyConnected):
+        addContacts(*self.getRunOverlaps(dz, dy, dx, firstSlice, lastSlice))
+    return [(pairBin // numberOfBins + minimumLabel, pairBin % numberOfBins + minimumLabel, count)
+            for pairBin, count in sorted(contactCounts.items())]
+
+  def getIslands(self, fullyConnected, label=None):
+    """
+    Returns the islands of every label, or of label, as a list of (firstRun, label, voxelCount,
+    boundingBox, runIndices), where firstRun, the first run of the island in scan order, orders
+    islands like the labels of the connected component filters, and boundingBox is in the
+    SimpleITK (x, y, z, sizeX, sizeY, sizeZ) layout.
+    """
+    self.compact()
+    firstRuns = list()
+    secondRuns = list()
+    for (firstSlice, lastSlice), (dz, dy, dx) in itertools.product(self.getSlabs(),
+                                                                   getNeighbourRowOffsets(fullyConnected)):
+      overlapFirstRuns, overlapSecondRuns, lengths = self.getRunOverlaps(dz, dy, dx, firstSlice, lastSlice)
+      joined = self.runLabels[overlapFirstRuns] == self.runLabels[overlapSecondRuns]
+      if label is not None:
+        joined &= self.runLabels[overlapFirstRuns] == label
+      firstRuns.append(overlapFirstRuns[joined])
+      secondRuns.append(overlapSecondRuns[joined])
+    components = getConnectedComponents(len(self.runLabels), np.concatenate(firstRuns), np.concatenate(secondRuns))
+
+    if label is None:
+      runIndices = np.arange(len(self.runLabels))
+    else:
+      runIndices = np.flatnonzero(self.runLabels == label)
+    if not len(runIndices):
+      return list()
+    runIndices = runIndices[np.argsort(components[runIndices], kind='mergesort')]
+    roots = components[runIndices]
+    islandBegins = np.flatnonzero(np.append(True, roots[1:] != roots[:-1]))
+    rows = np.searchsorted(self.rowOffsets, runIndices, 'right') - 1
+    zIndices = rows // self.shape[1]
+    yIndices = rows % self.shape[1]
+    starts = self.runStarts[runIndices].astype(np.int64)
+    ends = self.getRunEnds()[runIndices]
+    voxelCounts = np.add.reduceat(ends - starts, islandBegins)
+    lower = [np.minimum.reduceat(indices, islandBegins) for indices in (starts, yIndices, zIndices)]
+    upper = [np.maximum.reduceat(indices, islandBegins) + 1 for indices in (ends - 1, yIndices, zIndices)]
+    islandEnds = np.append(islandBegins[1:], len(runIndices))
+    return [(int(roots[begin]), int(self.runLabels[runIndices[begin]]), int(voxelCounts[islandIndex]),
+             tuple(int(bound[islandIndex]) for bound in lower) +
+             tuple(int(upper[axis][islandIndex] - lower[axis][islandIndex]) for axis in range(3)),
+             runIndices[begin:end])
+            for islandIndex, (begin, end) in enumerate(zip(islandBegins, islandEnds))]
+
+  def toArray(self):
+    self.compact()
+    return self.decodeRows(0, self.numberOfRows).reshape(self.shape)
+
+  def save(self, path):
+    self.compact()
+    np.savez(path, shape=np.array(self.shape), runCounts=np.diff(self.rowOffsets), runStarts=self.runStarts,
+             runLabels=self.runLabels)
+
+def loadRunLengthLabelMap(path):
+  labelMapFile = np.load(path)
+  try:
+    return RunLengthLabelMap(labelMapFile['shape'], labelMapFile['runCounts'], labelMapFile['runStarts'],
+                             labelMapFile['runLabels'])
+  finally:
+    labelMapFile.close()
+
+def getRunLengthLabelMap(labelArray, slabVoxelCount=1 << 22):
+  """
+  Encodes a (z, y, x) label array, which can be memory-mapped, a slab of slices at a time, so
+  no Int16 copy of the whole array is made.
+  """
+  sizeZ, sizeY, sizeX = labelArray.shape
+  slabSliceCount = max(1, slabVoxelCount // max(1, sizeY * sizeX))
+  runCounts = list()
+  runStarts = list()
+  runLabels = list()
+  for firstSlice in range(0, sizeZ, slabSliceCount):
+    rows = np.asarray(labelArray[firstSlice:firstSlice + slabSliceCount]).astype(np.int16).reshape(-1, sizeX)
+    slabRunCounts, slabRunStarts, slabRunLabels = encodeRows(rows)
+    runCounts.append(slabRunCounts)
+    runStarts.append(slabRunStarts.astype(np.int32))
+    runLabels.append(slabRunLabels)
+  return RunLengthLabelMap(labelArray.shape, np.concatenate(runCounts), np.concatenate(runStarts),
+                           np.concatenate(runLabels))
@@ -0,0 +1,72 @@
+"""
+Least recently used cache of the images and statistics derived from volume nodes.
+
+Every product is stored under a slot, which names the product and the nodes it was computed
+from, together with the version of those nodes (their image data modification times). A lookup
+with a newer version recomputes the product and replaces the stale one, and the least recently
+used products are dropped when the cached products need more than maximumBytes.
+"""
+
+import collections
+
+import SimpleITK as sitk
+import numpy as np
+from labelStatisticsTable import LabelStatisticsTable
+
+pixelSizes = {sitk.sitkUInt8: 1, sitk.sitkInt8: 1, sitk.sitkUInt16: 2, sitk.sitkInt16: 2,
+              sitk.sitkUInt32: 4, sitk.sitkInt32: 4, sitk.sitkFloat32: 4}
+
+def getNumberOfBytes(value):
+  """
+  Returns an estimate of the memory held by a cached product.
+  """
+  if isinstance(value, np.ndarray):
+    return value.nbytes
+  if isinstance(value, sitk.Image):
+    pixelSize = pixelSizes.get(value.GetPixelID(), 8)
+    return value.GetNumberOfPixels() * value.GetNumberOfComponentsPerPixel() * pixelSize
+  if isinstance(value, LabelStatisticsTable):
+    return len(value.counts) * (1 + 2 * value.numberOfVolumes) * 8
+  return 0
+
+class SessionCache():
+
+  def __init__(self, maximumBytes):
+    self.maximumBytes = maximumBytes
+    self.entries = collections.OrderedDict()
+    self.numberOfBytes = 0
+    self.numberOfHits = 0
+    self.numberOfMisses = 0
+
+  def get(self, slot, version, computeValue):
+    """
+    Returns the product of slot for version, calling computeValue() if it is not cached.
+    """
+    if slot in self.entries:
+      entryVersion, value, numberOfBytes = self.entries.pop(slot)
+      if entryVersion == version:
+        self.entries[slot] = (entryVersion, value, numberOfBytes)
+        self.numberOfHits += 1
+        return value
+      self.numberOfBytes -= numberOfBytes
+    self.numberOfMisses += 1
+    value = computeValue()
+    numberOfBytes = getNumberOfBytes(value)
+    self.entries[slot] = (version, value, numberOfBytes)
+    self.numberOfBytes += numberOfBytes
+    self.evict()
+    return value
+
+  def evict(self):
+    # the most recent product is kept even if it is larger than the budget on its own
+    while self.numberOfBytes > self.maximumBytes and len(self.entries) > 1:
+      entryVersion, value, numberOfBytes = self.entries.popitem(last=False)[1]
+      self.numberOfBytes -= numberOfBytes
+
+  def setMaximumBytes(self, maximumBytes):
+    self.maximumBytes = maximumBytes
+    self.evict()
+
+  def clear(self):
+    self.entries.clear()
+    self.numberOfBytes = 0
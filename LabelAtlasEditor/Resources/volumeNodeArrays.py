@@ -0,0 +1,107 @@
+"""
+Zero-copy access to the voxels of MRML volume nodes.
+
+getVolumeNodeArray returns the scalars of the vtkImageData of a volume node as a NumPy array
+indexed (z, y, x) that shares its memory with the node, so looking at a volume neither copies
+nor casts it. An array that was changed in place is announced to the scene once, with
+volumeNodeArrayModified, when the whole edit is done; edits made in several steps can be
+wrapped in StartModify() and EndModify() of the node so that the scene still sees one change.
+getVolumeNodeVolume wraps a node as a MemoryMappedVolume with the LPS geometry used by
+SimpleITK, for the cleanup code that takes MemoryMappedVolumes or SimpleITK images, or copies
+its voxels for code that reads them in a worker thread, and updateVolumeNodeFromArray writes
+an array computed elsewhere into a node. Only usable inside 3D Slicer.
+"""
+
+import numpy as np
+import vtk
+import slicer
+from vtk.util import numpy_support
+from memoryMappedVolume import MemoryMappedVolume
+
+def getVolumeNodeArray(volumeNode):
+  """
+  Returns the voxels of volumeNode as an array that shares the memory of its image data. The
+  array is only valid as long as the node keeps the same image data.
+  """
+  imageData = volumeNode.GetImageData()
+  scalars = imageData.GetPointData().GetScalars()
+  shape = imageData.GetDimensions()[::-1]
+  if scalars.GetNumberOfComponents() > 1:
+    shape += (scalars.GetNumberOfComponents(),)
+  return numpy_support.vtk_to_numpy(scalars).reshape(shape)
+
+def volumeNodeArrayModified(volumeNode):
+  """
+  Tells the views and the other modules that the voxels of volumeNode were changed in place.
+  """
+  imageData = volumeNode.GetImageData()
+  wasModifying = volumeNode.StartModify()
+  imageData.GetPointData().GetScalars().Modified()
+  imageData.Modified()
+  volumeNode.Modified()
+  volumeNode.EndModify(wasModifying)
+
+def getVolumeNodeVersion(volumeNode):
+  """
+  Returns a value that changes whenever the voxels of volumeNode are modified or replaced.
+  """
+  return volumeNode.GetImageData().GetMTime()
+
+def getVolumeNodeVolume(volumeNode, copy=False):
+  """
+  Returns volumeNode as a MemoryMappedVolume whose array is the array of getVolumeNodeArray, or
+  with copy a read-only copy of it that stays valid when the node is changed or removed.
+  """
+  array = getVolumeNodeArray(volumeNode)
+  if copy:
+    array = array.copy()
+    array.flags.writeable = False
+  ijkToRASDirections = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASDirectionMatrix(ijkToRASDirections)
+  # Slicer works in RAS coordinates, SimpleITK in LPS
+  flip = (-1.0, -1.0, 1.0)
+  direction = [flip[row] * ijkToRASDirections.GetElement(row, column) for row in range(3) for column in range(3)]
+  origin = [flip[axis] * value for axis, value in enumerate(volumeNode.GetOrigin())]
+  return MemoryMappedVolume(array, volumeNode.GetSpacing(), origin, direction, isMemoryMapped=False)
+
+def getImageFromVolumeNode(volumeNode):
+  """
+  Returns a SimpleITK image with a copy of the voxels of volumeNode, for the code that still
+  needs SimpleITK filters.
+  """
+  volume = getVolumeNodeVolume(volumeNode)
+  return volume.getImageFromArray(volume.array)
+
+def getVolumeNodeByName(volumeNodeName):
+  return slicer.mrmlScene.GetFirstNodeByName(volumeNodeName)
+
+def getOrAddLabelVolumeNode(volumeNodeName):
+  volumeNode = getVolumeNodeByName(volumeNodeName)
+  if volumeNode is None:
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', volumeNodeName)
+  return volumeNode
+
+def updateVolumeNodeFromArray(volumeNode, array, referenceNode=None):
+  """
+  Copies array, indexed (z, y, x), into the voxels of volumeNode and gives volumeNode the
+  geometry of referenceNode. The existing image data of volumeNode is reused when it has the
+  shape and the scalar type of array, and the scene is notified once.
+  """
+  wasModifying = volumeNode.StartModify()
+  if referenceNode is not None and referenceNode is not volumeNode:
+    volumeNode.CopyOrientation(referenceNode)
+  scalarType = numpy_support.get_vtk_array_type(array.dtype)
+  imageData = volumeNode.GetImageData()
+  if (imageData is None or imageData.GetDimensions() != array.shape[::-1] or
+      imageData.GetScalarType() != scalarType or imageData.GetNumberOfScalarComponents() != 1):
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(array.shape[::-1])
+    imageData.AllocateScalars(scalarType, 1)
+    volumeNode.SetAndObserveImageData(imageData)
+  nodeArray = getVolumeNodeArray(volumeNode)
+  if not np.may_share_memory(nodeArray, array):
+    nodeArray[...] = array
+  volumeNodeArrayModified(volumeNode)
+  if volumeNode.GetDisplayNode() is None:
+    volumeNode.CreateDefaultDisplayNodes()
+  volumeNode.EndModify(wasModifying)
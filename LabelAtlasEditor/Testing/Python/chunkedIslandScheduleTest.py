@@ -0,0 +1,106 @@
+"""
+Tests of the out-of-core island size sweep (ChunkedIslandSchedule) against IslandSizeSchedule,
+on small synthetic atlases tiled into blocks of a few voxels so that islands and their dilations
+cross the block borders. Runs with python -m unittest from this directory or as a ctest.
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Resources'))
+
+import chunkedIslandSchedule
+from atlasCleanupBenchmark import makeSyntheticAtlas
+from atlasSmallIslandCleanup import DustCleanup
+from chunkedIslandSchedule import ChunkedIslandSchedule
+from islandSizeSchedule import IslandSizeSchedule
+from labelAdjacencyGraph import getIslandContacts
+from runLengthLabelMap import getRunLengthLabelMap
+
+def getTestAtlas(seed):
+  """
+  Returns the label, T1 and T2 arrays of a synthetic atlas with a different length along every
+  axis and a dense dust of small islands.
+  """
+  return [np.ascontiguousarray(array[:19, 3:, 1:]) for array in makeSyntheticAtlas(24, 6, 0.05, seed)]
+
+def getCleanup(fullyConnected, outOfCore=False):
+  # the islands of the synthetic atlases are only moved when suspicious label changes are forced
+  return DustCleanup({'--inputAtlasPath': 'atlas.nrrd', '--outputAtlasPath': 'cleanAtlas.nrrd',
+                      '--inputT1Path': 't1.nrrd', '--inputT2Path': 't2.nrrd',
+                      '--includeLabelsList': None, '--excludeLabelsList': None,
+                      '--maximumIslandVoxelCount': '6',
+                      '--useFullyConnectedInConnectedComponentFilter': fullyConnected,
+                      '--forceSuspiciousLabelChange': True, '--noDilation': False,
+                      '--memoryMegabytes': '0.01', '--outOfCore': outOfCore})
+
+class ChunkedIslandScheduleTest(unittest.TestCase):
+
+  def setUp(self):
+    self.minimumBlockEdgeLength = chunkedIslandSchedule.minimumBlockEdgeLength
+    chunkedIslandSchedule.minimumBlockEdgeLength = 4
+
+  def tearDown(self):
+    chunkedIslandSchedule.minimumBlockEdgeLength = self.minimumBlockEdgeLength
+
+  def crossesBlockBorder(self, schedule, voxelIndices):
+    blockIndices = [np.searchsorted(schedule.blockBoundaries[axis], voxelIndices[:, 2 - axis], 'right')
+                    for axis in range(3)]
+    return any(len(np.unique(indices)) > 1 for indices in blockIndices)
+
+  def test_islandSizeSweep(self):
+    """
+    Runs both schedules of every label in lockstep over the island sizes, moving every other
+    island to its most bordering label like the cleanup does.
+    """
+    for seed, fullyConnected in ((6, False), (7, True)):
+      cleanup = getCleanup(fullyConnected)
+      labelArray = getTestAtlas(seed)[0]
+      labelMap = getRunLengthLabelMap(labelArray)
+      numberOfIslandsMoved = 0
+      numberOfIslandsAcrossBlocks = 0
+      for label in labelMap.getLabels():
+        denseSchedule = IslandSizeSchedule(cleanup, labelArray, label)
+        chunkedSchedule = ChunkedIslandSchedule(cleanup, labelMap, label)
+        self.assertGreater(np.prod(chunkedSchedule.blockGridShape), 8)
+        for islandSize in range(1, cleanup.maximumIslandVoxelCount + 1):
+          numberOfIslands, denseIslands = denseSchedule.getIslands(islandSize)
+          self.assertEqual(chunkedSchedule.getIslands(islandSize)[0], numberOfIslands)
+          chunkedIslands = chunkedSchedule.getIslands(islandSize)[1]
+          self.assertEqual(len(chunkedIslands), len(denseIslands))
+          for islandNumber, (denseIsland, chunkedIsland) in enumerate(zip(denseIslands, chunkedIslands)):
+            np.testing.assert_array_equal(chunkedIsland, denseIsland)
+            numberOfIslandsAcrossBlocks += self.crossesBlockBorder(chunkedSchedule, chunkedIsland)
+            if islandNumber % 2:
+              continue
+            islandContacts = getIslandContacts(labelArray, denseIsland, fullyConnected)
+            islandContacts.pop(label, None)
+            if not islandContacts:
+              continue
+            newLabel = max(sorted(islandContacts), key=islandContacts.get)
+            labelArray[denseIsland[:, 2], denseIsland[:, 1], denseIsland[:, 0]] = newLabel
+            labelMap[denseIsland[:, 2], denseIsland[:, 1], denseIsland[:, 0]] = newLabel
+            denseSchedule.removeIsland(denseIsland)
+            chunkedSchedule.removeIsland(chunkedIsland)
+            numberOfIslandsMoved += 1
+      self.assertGreater(numberOfIslandsMoved, 0)
+      self.assertGreater(numberOfIslandsAcrossBlocks, 0)
+      np.testing.assert_array_equal(labelMap.toArray(), labelArray)
+
+  def test_cleanupLabelArray(self):
+    for seed, fullyConnected in ((10, False), (11, True)):
+      labelArray, t1Array, t2Array = getTestAtlas(seed)
+      images = [sitk.GetImageFromArray(array) for array in (labelArray, t1Array, t2Array)]
+      cleanup = getCleanup(fullyConnected)
+      cleanup.cleanupLabelArray(*images)
+      outOfCoreCleanup = getCleanup(fullyConnected, outOfCore=True)
+      outOfCoreCleanup.cleanupLabelArray(*images)
+      self.assertFalse(np.array_equal(cleanup.labelArray, labelArray))
+      np.testing.assert_array_equal(outOfCoreCleanup.labelArray.toArray(), cleanup.labelArray)
+
+if __name__ == '__main__':
+  unittest.main()
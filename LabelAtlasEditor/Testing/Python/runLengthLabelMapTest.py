@@ -0,0 +1,123 @@
+"""
+Tests of RunLengthLabelMap against the dense label arrays that the cleanup uses without
+--runLengthEncoding, on small synthetic atlases (see atlasCleanupBenchmark). Runs with
+python -m unittest from this directory or as a ctest.
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Resources'))
+
+from atlasCleanupBenchmark import makeSyntheticAtlas
+from atlasIslandTable import AtlasIslandTable
+from labelAdjacencyGraph import LabelAdjacencyGraph, getIslandContacts
+from runLengthLabelMap import getRunLengthLabelMap, loadRunLengthLabelMap
+
+def getTestAtlas(seed):
+  """
+  Returns a synthetic atlas with a different length along every axis and a dense dust of small
+  islands.
+  """
+  labelArray = makeSyntheticAtlas(24, 6, 0.05, seed)[0]
+  return np.ascontiguousarray(labelArray[:19, 3:, 1:])
+
+class RunLengthLabelMapTest(unittest.TestCase):
+
+  def assertSameIslands(self, denseIslandTable, runLengthIslandTable):
+    self.assertEqual(denseIslandTable.getLabels(), runLengthIslandTable.getLabels())
+    for label in denseIslandTable.getLabels():
+      denseIslands = denseIslandTable.getIslandsForLabel(label)
+      runLengthIslands = runLengthIslandTable.getIslandsForLabel(label)
+      self.assertEqual([(island.label, island.voxelCount, tuple(island.boundingBox)) for island in denseIslands],
+                       [(island.label, island.voxelCount, tuple(island.boundingBox)) for island in runLengthIslands])
+      for denseIsland, runLengthIsland in zip(denseIslands, runLengthIslands):
+        if denseIsland.voxelIndices is None:
+          self.assertIsNone(runLengthIsland.voxelIndices)
+        else:
+          np.testing.assert_array_equal(denseIsland.voxelIndices, runLengthIsland.voxelIndices)
+
+  def test_encoding(self):
+    labelArray = getTestAtlas(0)
+    labelMap = getRunLengthLabelMap(labelArray, slabVoxelCount=1000)
+    np.testing.assert_array_equal(labelMap.toArray(), labelArray)
+    np.testing.assert_array_equal(labelMap[2:9, 5:17, 4:20], labelArray[2:9, 5:17, 4:20])
+    np.testing.assert_array_equal(labelMap[7, :, 3:], labelArray[7, :, 3:])
+    self.assertEqual(labelMap[4, 5, 6], labelArray[4, 5, 6])
+    self.assertEqual(labelMap.getLabels(), sorted(int(label) for label in np.unique(labelArray)))
+
+    randomState = np.random.RandomState(1)
+    for label in range(3):
+      zyxIndices = tuple(randomState.randint(0, length, 50) for length in labelArray.shape)
+      labelArray[zyxIndices] = label
+      labelMap[zyxIndices] = label
+    np.testing.assert_array_equal(labelMap.toArray(), labelArray)
+
+  def test_saveAndLoad(self):
+    labelArray = getTestAtlas(1)
+    labelMap = getRunLengthLabelMap(labelArray)
+    labelMap[[0, 5], [1, 2], [3, 4]] = 2
+    labelArray[[0, 5], [1, 2], [3, 4]] = 2
+    temporaryPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runLengthLabelMapTest.npz')
+    try:
+      labelMap.save(temporaryPath)
+      np.testing.assert_array_equal(loadRunLengthLabelMap(temporaryPath).toArray(), labelArray)
+    finally:
+      os.remove(temporaryPath)
+
+  def test_atlasIslandTable(self):
+    for seed, fullyConnected in ((2, False), (3, True)):
+      labelArray = getTestAtlas(seed)
+      labelImage = sitk.GetImageFromArray(labelArray)
+      labelMap = getRunLengthLabelMap(labelArray)
+      self.assertSameIslands(AtlasIslandTable(labelImage, fullyConnected, 6),
+                             AtlasIslandTable(labelMap, fullyConnected, 6))
+      for label in (0, 4):
+        self.assertSameIslands(AtlasIslandTable(labelImage, fullyConnected, 6, label),
+                               AtlasIslandTable(labelMap, fullyConnected, 6, label))
+
+  def test_labelAdjacencyGraph(self):
+    for seed, fullyConnected in ((4, False), (5, True)):
+      labelArray = getTestAtlas(seed)
+      labelMap = getRunLengthLabelMap(labelArray)
+      denseGraph = LabelAdjacencyGraph(labelArray, fullyConnected)
+      runLengthGraph = LabelAdjacencyGraph(labelMap, fullyConnected)
+      self.assertEqual(denseGraph.contacts, runLengthGraph.contacts)
+
+      # move the small islands of label 3 to a bordering label in both graphs
+      islandTable = AtlasIslandTable(sitk.GetImageFromArray(labelArray), fullyConnected, 6, 3)
+      for island in islandTable.getIslandsForLabel(3)[1:]:
+        islandContacts = getIslandContacts(labelArray, island.voxelIndices, fullyConnected)
+        self.assertEqual(islandContacts, getIslandContacts(labelMap, island.voxelIndices, fullyConnected))
+        newLabel = max(islandContacts, key=islandContacts.get)
+        denseGraph.relabelIsland(island.voxelIndices, newLabel, islandContacts)
+        runLengthGraph.relabelIsland(island.voxelIndices, newLabel)
+      self.assertEqual(denseGraph.contacts, runLengthGraph.contacts)
+      self.assertEqual(denseGraph.contacts, LabelAdjacencyGraph(labelArray, fullyConnected).contacts)
+      np.testing.assert_array_equal(labelMap.toArray(), labelArray)
+
+  def test_slabs(self):
+    """
+    Finds the islands and the contacts of a RunLengthLabelMap in slabs of a few slices.
+    """
+    for seed, fullyConnected in ((8, False), (9, True)):
+      labelArray = getTestAtlas(seed)
+      labelMap = getRunLengthLabelMap(labelArray)
+      slabMap = getRunLengthLabelMap(labelArray)
+      slabMap.slabRunCount = 100
+      self.assertGreater(len(slabMap.getSlabs()), 2)
+      self.assertEqual(slabMap.getContactCounts(fullyConnected), labelMap.getContactCounts(fullyConnected))
+      for label in (None, 2):
+        islands = labelMap.getIslands(fullyConnected, label)
+        slabIslands = slabMap.getIslands(fullyConnected, label)
+        self.assertEqual(len(slabIslands), len(islands))
+        for island, slabIsland in zip(islands, slabIslands):
+          for value, slabValue in zip(island, slabIsland):
+            np.testing.assert_array_equal(slabValue, value)
+
+if __name__ == '__main__':
+  unittest.main()